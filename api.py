@@ -123,6 +123,54 @@ Some Examples:
       }
     }}
 
+- Combine ranges, lists and boolean groups of conditions on columns
+  in one `filter`, e.g. reactions with an energy between -1 and 0.5
+  eV and an activation energy below 1 eV, on any facet but 111::
+
+    {reactions(filter: {reactionEnergy: {ge: -1, le: 0.5},
+                        or: [{activationEnergy: {lt: 1}},
+                             {activationEnergy: {isNull: true}}],
+                        not: {facet: {in: ["111"]}}}, first: 10) {
+      edges {
+        node {
+          reactionEnergy
+          activationEnergy
+          facet
+        }
+      }
+    }}
+
+- Look up many rows in one query by `uniqueIds`, `ids` (the integer
+  ids of all tables) or `pubIds`. The rows are returned in the order
+  of the ids unless `order` or `keyset` is given::
+
+    {systems(uniqueIds: ["1f3bb0d2fc07bca2ab6cc6bb0e3a1bb5",
+                         "6f2a1b6f2c5e1ad7ba1b2bd5bd6d5fc3"]) {
+      edges {
+        node {
+          uniqueId
+          energy
+        }
+      }
+    }}
+
+- Page through large tables with keyset cursors, which stay fast
+  for deep pages. Pass the returned endCursor as `after` to get
+  the next page::
+
+    {reactions(first: 100, keyset: true, order: "reactionEnergy") {
+      pageInfo {
+        endCursor
+        hasNextPage
+      }
+      edges {
+        node {
+          id
+          reactionEnergy
+        }
+      }
+    }}
+
 - Get all entries published since (and including) 2015::
 
     {publications(year: 2015, op: "ge", last:1) {
@@ -137,6 +185,31 @@ Some Examples:
      }
    }}
 
+- Statistics and histogram of reaction energies for each surface and
+  facet, computed by the database instead of fetching all rows::
+
+    {reactionAggregates(reactants: "CO",
+                        groupBy: ["surfaceComposition", "facet"],
+                        percentiles: [0.1, 0.5, 0.9],
+                        bins: [-2, -1, 0, 1, 2]) {
+      group
+      count
+      min
+      max
+      avg
+      percentiles
+      histogram
+    }}
+
+- Distinct values of an attribute for dropdowns, most frequent first.
+  JSONB attributes like reactants list their keys::
+
+    {distinctValues(source: "reactions", attribute: "reactants",
+                    prefix: "CO", first: 10) {
+      value
+      count
+    }}
+
 """
 try:
     import io as StringIO
@@ -146,29 +219,108 @@ except ImportError:
 
 
 # global imports
+import base64
+import collections
+import functools
+import os
 import re
 import json
 import graphene
 import graphene.relay
 import graphene_sqlalchemy
-#import promise.dataloader
+import graphene_sqlalchemy.utils
+import graphql.language.ast
+import graphql_relay.utils
 import promise
+import promise.dataloader
 import sqlalchemy
+import sqlalchemy.ext.compiler
+import sqlalchemy.orm
+import sqlalchemy.sql.expression
+from sqlalchemy.dialects import postgresql
 import six
+from graphql_relay.connection.arrayconnection import (
+    connection_from_list_slice, get_offset_with_default)
 
 # local imports
 import models
+import cache
+import facets
+
+
+COUNT_STRATEGIES = ['exact', 'cached', 'estimated']
+COUNT_STRATEGY = os.environ.get('COUNT_STRATEGY', 'exact')
+COUNT_CACHE = cache.register('count', cache.LRUCache(
+    maxsize=int(os.environ.get('COUNT_CACHE_SIZE', 1024)),
+    ttl=float(os.environ.get('COUNT_CACHE_TTL', 600))))
+
+
+class Explain(sqlalchemy.sql.expression.Executable,
+              sqlalchemy.sql.expression.ClauseElement):
+    """EXPLAIN (FORMAT JSON) of a select statement."""
+
+    def __init__(self, statement):
+        self.statement = statement
+
+
+@sqlalchemy.ext.compiler.compiles(Explain, 'postgresql')
+def _compile_explain(element, compiler, **kwargs):
+    return 'EXPLAIN (FORMAT JSON) ' + compiler.process(element.statement,
+                                                       **kwargs)
+
+
+def estimate_count(query):
+    """Number of rows of `query` as estimated by the query planner.
+
+    This only reads table statistics, so it is fast but may be
+    off after large uploads until the table is analyzed again.
+    """
+    plan = query.session.execute(Explain(query.order_by(None).statement)) \
+        .scalar()
+    if isinstance(plan, six.string_types):
+        plan = json.loads(plan)
+    return int(plan[0]['Plan']['Plan Rows'])
+
+
+def count_rows(query, strategy=None, key=None):
+    """Count the rows of `query` with one of COUNT_STRATEGIES:
+
+    - exact: run COUNT(*) over the filtered query
+    - cached: exact count, kept in COUNT_CACHE for each filter set `key`.
+      Uploads made outside of this app only show up after
+      COUNT_CACHE_TTL, so it has to be asked for explicitly.
+    - estimated: row estimate of the query planner
+    """
+    strategy = strategy or COUNT_STRATEGY
+    if strategy not in COUNT_STRATEGIES:
+        raise ValueError('Count strategy should be one of {}, not {}'
+                         .format(COUNT_STRATEGIES, strategy))
+
+    if strategy == 'estimated':
+        return estimate_count(query)
+    if strategy == 'cached' and key is not None:
+        count = COUNT_CACHE.get(key)
+        if count is None:
+            count = query.order_by(None).count()
+            COUNT_CACHE.set(key, count)
+        return count
+    return query.order_by(None).count()
 
 
 class CountableConnection(graphene.relay.Connection):
     class Meta:
         abstract = True
 
-    total_count = graphene.Int()
+    total_count = graphene.Int(mode=graphene.String())
 
     @staticmethod
-    def resolve_total_count(root, info):
-        return root.length
+    def resolve_total_count(root, info, mode=None):
+        """Total number of rows matching the filters. Set `mode` to
+        "exact", "cached" or "estimated" to trade accuracy for speed."""
+        if root.length is not None and mode in (None, 'exact'):
+            return root.length
+        return count_rows(root.count_query, mode,
+                          getattr(root, 'count_key', None))
 
 
 class CustomSQLAlchemyObjectType(graphene_sqlalchemy.SQLAlchemyObjectType):
@@ -199,6 +351,80 @@ class CustomSQLAlchemyObjectType(graphene_sqlalchemy.SQLAlchemyObjectType):
             **options)
 
 
+class RelationshipLoader(promise.dataloader.DataLoader):
+    """Batch load one relationship for many parent rows.
+
+    The primary keys of all parents requested while resolving one
+    nesting level are collected and fetched with a single
+    ``SELECT ... WHERE parent.id IN (...)`` joining the parent
+    to the related model.
+    """
+
+    def __init__(self, session, relationship, **kwargs):
+        super(RelationshipLoader, self).__init__(**kwargs)
+        self.session = session
+        self.relationship = relationship
+        self.prop = relationship.property
+        self.parent_key = self.prop.parent.primary_key[0]
+
+    def batch_load_fn(self, keys):
+        rows = self.session.query(self.parent_key, self.prop.mapper) \
+            .select_from(self.prop.parent) \
+            .join(self.relationship) \
+            .filter(self.parent_key.in_(keys)) \
+            .all()
+
+        children = {}
+        for key, child in rows:
+            children.setdefault(key, []).append(child)
+
+        if self.prop.uselist:
+            return promise.Promise.resolve(
+                [children.get(key, []) for key in keys])
+        return promise.Promise.resolve(
+            [children.get(key, [None])[0] for key in keys])
+
+
+def get_loader(info, relationship):
+    """Return the loader for `relationship` belonging to the current request.
+
+    Loaders live in the per-request GraphQL context, so neither their
+    session nor their cache is ever shared between requests.
+    """
+    loaders = info.context.setdefault('loaders', {})
+    key = str(relationship)
+    if key not in loaders:
+        loaders[key] = RelationshipLoader(
+            graphene_sqlalchemy.utils.get_session(info.context),
+            relationship)
+    return loaders[key]
+
+
+def load_relationship(root, info, relationship):
+    """Resolve `relationship` of `root` through the request's loader.
+
+    Relationships that were already eager loaded by the connection
+    query are returned as they are.
+    """
+    state = sqlalchemy.inspect(root)
+    if relationship.key not in state.unloaded:
+        return getattr(root, relationship.key)
+    loader = get_loader(info, relationship)
+    return loader.load(getattr(root, loader.parent_key.key))
+
+
+def resolve_derived(column):
+    """Resolver of a DERIVED_COLUMNS field, which falls back to the
+    hybrid property in schemas without the column.
+    """
+    def resolve(root, info):
+        session = graphene_sqlalchemy.utils.get_session(info.context)
+        if models.has_derived_columns(session):
+            return getattr(root, column)
+        return getattr(root, models.DERIVED_COLUMNS[type(root)][column])
+    return resolve
+
+
 class Publication(CustomSQLAlchemyObjectType):
 
     class Meta:
@@ -208,26 +434,11 @@ class Publication(CustomSQLAlchemyObjectType):
     reactions = graphene.List('api.Reaction')
     systems = graphene.List('api.System')
 
-    #def resolve_reactions(self, info):
-    #    return reaction_loader.load_many(
-    #            [x.id for x in self.reactions]
-    #            )
-
-    #def resolve_systems(self, info):
-    #    return system_loader.load_many(
-    #            [x.id for x in self.systems]
-    #            )
-
+    def resolve_reactions(self, info):
+        return load_relationship(self, info, models.Publication.reactions)
 
-#class PublicationLoader(promise.dataloader.DataLoader):
-#    def batch_load_fn(self, keys):
-#        return promise.Promise.resolve(
-#            models.db_session.query(models.Publication) \
-#                    .filter(models.Publication.id.in_(keys)).all()
-#            )
-
-
-#publication_loader = PublicationLoader()
+    def resolve_systems(self, info):
+        return load_relationship(self, info, models.Publication.systems)
 
 
 class ReactionSystem(CustomSQLAlchemyObjectType):
@@ -249,6 +460,7 @@ class Log(CustomSQLAlchemyObjectType):
 class System(CustomSQLAlchemyObjectType):
 
     _input_file = graphene.String(format=graphene.String())
+    _packed_array = graphene.String(array=graphene.String())
 
     class Meta:
         model = models.System
@@ -257,6 +469,36 @@ class System(CustomSQLAlchemyObjectType):
     publication = graphene.List('api.Publication')
     log = graphene.List('api.Log')
 
+    resolve_formula = resolve_derived('formula')
+    resolve_adsorbate = resolve_derived('adsorbate')
+    resolve_substrate = resolve_derived('substrate')
+    resolve_facet = resolve_derived('facet')
+    resolve_dft_functional = resolve_derived('dft_functional')
+
+    def resolve_publication(self, info):
+        return load_relationship(self, info, models.System.publication)
+
+    def resolve_log(self, info):
+        return load_relationship(self, info, models.System.log)
+
+    def resolve_reactions(self, info, **args):
+        return load_relationship(self, info, models.System.reactions)
+
+    def resolve_reaction_systems(self, info, **args):
+        return load_relationship(self, info, models.System.reaction_systems)
+
+    def resolve_keys(self, info, **args):
+        return load_relationship(self, info, models.System.keys)
+
+    def resolve_species(self, info, **args):
+        return load_relationship(self, info, models.System.species)
+
+    def resolve_text_keys(self, info, **args):
+        return load_relationship(self, info, models.System.text_keys)
+
+    def resolve_number_keys(self, info, **args):
+        return load_relationship(self, info, models.System.number_keys)
+
     @staticmethod
     def resolve__input_file(self, info, format="py"):
         """Return the structure as input for one of several
@@ -293,14 +535,42 @@ class System(CustomSQLAlchemyObjectType):
                 if value[1].find('F') > 0
                 ]
         if format in supported_fileformats:
-            mem_file = StringIO.StringIO()
-            mem_file.name = 'Export from http://catappdatabase.herokuapp.com/graphql'
-            ase.io.write(mem_file, self._toatoms(), format)
-            return mem_file.getvalue()
+            def render():
+                mem_file = StringIO.StringIO()
+                mem_file.name = 'Export from http://catappdatabase.herokuapp.com/graphql'
+                ase.io.write(mem_file, self._toatoms(), format)
+                return mem_file.getvalue()
+            return self._render('input:' + format, render)
         else:
             return 'Unsupported format. Should be one of %s'\
                 % str(supported_fileformats)
 
+    @staticmethod
+    def resolve__packed_array(self, info, array='positions'):
+        """Return one of the per-atom arrays positions, cell, forces,
+        magmoms or charges as base64 encoded little-endian float64
+        buffer, e.g.::
+
+            {systems(last: 10) {
+              edges {
+                node {
+                  natoms
+                  PackedArray(array:"forces")
+                }
+              }
+            }}
+
+        Decode with `np.frombuffer(base64.b64decode(data), '<f8')`.
+        Binary buffers are served by /packed_arrays/<uniqueId>/<array>.
+        """
+        if array not in models.PACKED_ARRAYS:
+            raise ValueError('Unsupported array. Should be one of {}'
+                             .format(list(models.PACKED_ARRAYS)))
+        buffer = self._get_packed(array)
+        if buffer is None:
+            return None
+        return base64.b64encode(buffer).decode('ascii')
+
 
 class NumberKeyValue(CustomSQLAlchemyObjectType):
 
@@ -337,28 +607,6 @@ class Species(CustomSQLAlchemyObjectType):
         interfaces = (graphene.relay.Node, )
 
 
-#class SystemLoader(promise.dataloader.DataLoader):
-#    def batch_load_fn(self, keys):
-#        return promise.Promise.resolve(
-#            models.db_session.query(models.System) \
-#                    .filter(models.System.id.in_(keys)).all()
-#            )
-
-
-#system_loader = SystemLoader()
-
-
-#class ReactionLoader(promise.dataloader.DataLoader):
-#    def batch_load_fn(self, keys):
-#        return promise.Promise.resolve(
-#            models.db_session.query(models.Reaction) \
-#                    .filter(models.Reaction.id.in_(keys)).all()
-#            )
-
-
-#reaction_loader = ReactionLoader()
-
-
 class Reaction(CustomSQLAlchemyObjectType):
 
     class Meta:
@@ -368,10 +616,16 @@ class Reaction(CustomSQLAlchemyObjectType):
     reaction_systems = graphene.List(ReactionSystem)
     systems = graphene.List(System)
 
-    #def resolve_systems(self, info):
-    #    return system_loader.load_many(
-    #            [x.id for x in self.systems]
-    #            )
+    resolve_equation = resolve_derived('equation')
+
+    def resolve_reaction_systems(self, info):
+        return load_relationship(self, info, models.Reaction.reaction_systems)
+
+    def resolve_systems(self, info):
+        return load_relationship(self, info, models.Reaction.systems)
+
+    def resolve_publication(self, info):
+        return load_relationship(self, info, models.Reaction.publication)
 
 
 # class Search(CustomSQLAlchemyObjectType):
@@ -410,67 +664,433 @@ class Echemical(CustomSQLAlchemyObjectType):
         model = models.Echemical
         interfaces = (graphene.relay.Node, )
 
+FIRST_CAP_RE = re.compile('(.)([A-Z][a-z]+)')
+ALL_CAP_RE = re.compile('([a-z0-9])([A-Z])')
+
+
+@functools.lru_cache(maxsize=1024)
+def convert(name):
+    s1 = FIRST_CAP_RE.sub(r'\1_\2', name)
+    return ALL_CAP_RE.sub(r'\1_\2', s1).lower()
+
+
+def get_order(model, order):
+    """Translate an order argument like "-reactionEnergy"
+    into the model column and the sort direction.
+    """
+    ascending = not order.startswith('-')
+    column_name = order if ascending else order[1:]
+    return getattr(model, convert(column_name), None), ascending
+
+
+PROJECTION_PLANS = cache.LRUCache(
+    maxsize=int(os.environ.get('PROJECTION_PLAN_CACHE_SIZE', 1024)))
+
+
+def iter_fields(selection_set, fragments):
+    """Yield the fields selected on a node, expanding fragments and
+    stepping through the edges/node levels of connections.
+    """
+    if selection_set is None:
+        return
+    for selection in selection_set.selections:
+        if isinstance(selection, graphql.language.ast.FragmentSpread):
+            yield from iter_fields(
+                fragments[selection.name.value].selection_set, fragments)
+        elif isinstance(selection, graphql.language.ast.InlineFragment):
+            yield from iter_fields(selection.selection_set, fragments)
+        elif selection.name.value in ('edges', 'node'):
+            yield from iter_fields(selection.selection_set, fragments)
+        else:
+            yield selection
+
+
+class ProjectionPlan(object):
+    """Columns and eager loads needed to resolve a selection set.
+
+    `columns` are the column attributes of `model` to load, or None
+    if all of them are needed. Deferred columns are not listed, but
+    their groups are added to `groups` to be undeferred. `children`
+    maps relationship names to the plans of the related models.
+    Hybrid properties that need a relationship get plans for complete
+    rows, given by `fields=None`. `fallbacks` are the columns needed to
+    compute selected DERIVED_COLUMNS from their hybrid properties in
+    schemas without the columns.
+    """
+
+    def __init__(self, model, fields, fragments):
+        mapper = sqlalchemy.inspect(model)
+        self.model = model
+        if fields is None:
+            self.columns = None
+            fields = []
+        else:
+            self.columns = set(mapper.get_property_by_column(column).key
+                               for column in mapper.primary_key)
+        self.groups = set()
+        self.fallbacks = set()
+        derived = models.DERIVED_COLUMNS.get(model, {})
+        child_fields = collections.OrderedDict()
+
+        for field in fields:
+            name = field.name.value
+            if name.startswith('__') or name in ('totalCount', 'pageInfo',
+                                                  'cursor'):
+                continue
+            if name[0].isupper():  # hybrid property
+                names = models.hybrid_prop_parameters(name)
+                if 'all' in names:
+                    self.columns = None
+                    self.groups.update(
+                        prop.group for prop in mapper.column_attrs
+                        if prop.deferred)
+                    continue
+            else:
+                names = [convert(name)]
+
+            for key in names:
+                prop = mapper.attrs.get(key)
+                if key in derived:
+                    self.fallbacks.update(
+                        models.get_derived_sources(model, key))
+                if isinstance(prop, sqlalchemy.orm.ColumnProperty):
+                    if prop.deferred:
+                        self.groups.add(prop.group)
+                    elif self.columns is not None:
+                        self.columns.add(key)
+                elif isinstance(prop, sqlalchemy.orm.RelationshipProperty):
+                    # columns referenced by the join condition
+                    if self.columns is not None:
+                        self.columns.update(
+                            mapper.get_property_by_column(column).key
+                            for column in prop.local_columns
+                            if column.table in mapper.tables)
+                    if field.selection_set is None:
+                        child_fields[key] = None
+                    elif child_fields.get(key, []) is not None:
+                        child_fields.setdefault(key, []).extend(
+                            iter_fields(field.selection_set, fragments))
+
+        self.children = collections.OrderedDict(
+            (key, ProjectionPlan(mapper.attrs[key].mapper.class_, fields,
+                                 fragments))
+            for key, fields in child_fields.items())
+
+    @classmethod
+    def get(cls, model, info):
+        """Plan for the connection field resolved with `info`,
+        memoized per model and selection set.
+
+        The GraphQL view caches parsed documents, so repeated
+        queries hit the same AST nodes.
+        """
+        key = (model, tuple(info.field_asts),
+               tuple(info.fragments.values()))
+        plan = PROJECTION_PLANS.get(key)
+        if plan is None:
+            fields = [field for field_ast in info.field_asts
+                      for field in iter_fields(field_ast.selection_set,
+                                               info.fragments)]
+            plan = cls(model, fields, info.fragments)
+            PROJECTION_PLANS.set(key, plan)
+        return plan
+
+    def options(self, load=None, extra_columns=(), skip=()):
+        """Query options loading the planned columns and relationships,
+        except for the relationships and deferred groups in `skip`.
+        Without the 'derived' group, the fallbacks are loaded instead.
+
+        Relationships to a single row are joined, collections are
+        fetched with one additional SELECT ... IN per relationship.
+        """
+        if load is None:
+            load = sqlalchemy.orm.Load(self.model)
+        options = []
+        columns = set(extra_columns)
+        groups = set(self.groups)
+        if 'derived' in skip:
+            mapper = sqlalchemy.inspect(self.model)
+            for key in self.fallbacks:
+                prop = mapper.attrs.get(key)
+                if not isinstance(prop, sqlalchemy.orm.ColumnProperty):
+                    continue
+                if prop.deferred:
+                    groups.add(prop.group)
+                else:
+                    columns.add(key)
+        if self.columns is not None:
+            options.append(load.load_only(*(self.columns | columns)))
+        for group in groups - set(skip):
+            options.append(load.undefer_group(group))
+        for key, child in self.children.items():
+            if key in skip:
+                continue
+            attribute = getattr(self.model, key)
+            if attribute.property.uselist:
+                child_load = load.selectinload(attribute)
+            else:
+                child_load = load.joinedload(attribute)
+            options.append(child_load)
+            options += child.options(child_load, skip=skip)
+        return options
+
+
+KEYSET_PREFIX = 'keyset:'
+
+
+def encode_keyset_cursor(values):
+    return graphql_relay.utils.base64(KEYSET_PREFIX + json.dumps(values))
+
+
+def decode_keyset_cursor(cursor):
+    """Return the (order value, primary key...) list stored in a
+    keyset cursor or None if `cursor` is a regular offset cursor.
+    """
+    if not cursor:
+        return None
+    try:
+        cursor = graphql_relay.utils.unbase64(cursor)
+    except (TypeError, ValueError):
+        return None
+    if not cursor.startswith(KEYSET_PREFIX):
+        return None
+    return json.loads(cursor[len(KEYSET_PREFIX):])
+
+
+def keyset_predicate(column, keys, values, greater):
+    """Rows that come strictly after (`greater`) or before the
+    row with `values` when sorted by `column`, then by `keys`.
+
+    Postgres sorts NULL after every value in ascending order, so
+    NULL is treated as the largest possible value of `column`.
+    The row comparisons can be answered from a composite index on
+    (column, primary key).
+    """
+    compare = (lambda a, b: a > b) if greater else (lambda a, b: a < b)
+    if column is None:
+        return compare(sqlalchemy.tuple_(*keys), sqlalchemy.tuple_(*values))
+
+    value, key_values = values[0], values[1:]
+    if value is None:
+        nulls = sqlalchemy.and_(
+            column.is_(None),
+            compare(sqlalchemy.tuple_(*keys), sqlalchemy.tuple_(*key_values)))
+        if greater:
+            return nulls
+        return sqlalchemy.or_(column.isnot(None), nulls)
+
+    predicate = compare(sqlalchemy.tuple_(column, *keys),
+                        sqlalchemy.tuple_(value, *key_values))
+    if greater:
+        return sqlalchemy.or_(predicate, column.is_(None))
+    return predicate
+
+
+# list-valued filter arguments and their columns
+LIST_FILTERS = collections.OrderedDict([
+    ('ids', 'id'),
+    ('unique_ids', 'unique_id'),
+    ('pub_ids', 'pub_id'),
+])
+
+
+def list_position(column, values):
+    """Position of `column` in `values`, to sort rows in the order
+    of the requested values.
+    """
+    return sqlalchemy.func.array_position(
+        sqlalchemy.cast(postgresql.array(values),
+                        postgresql.ARRAY(column.type)),
+        column)
+
+
 class FilteringConnectionField(graphene_sqlalchemy.SQLAlchemyConnectionField):
     RELAY_ARGS = ['first', 'last', 'before', 'after']
-    SPECIAL_ARGS = ['distinct', 'op', 'jsonkey', 'order']
+    SPECIAL_ARGS = ['distinct', 'op', 'jsonkey', 'order', 'keyset',
+                    'filter'] + list(LIST_FILTERS)
+
+    @classmethod
+    def get_count_key(cls, model, args, session=None):
+        """Normalized filter set of a query in the database and schema
+        of `session`, used to cache its count.
+        """
+        skip_args = cls.RELAY_ARGS + ['order', 'keyset']
+        return (models.get_cache_key(session), model.__name__) + tuple(sorted(
+            (field, json.dumps(value, sort_keys=True)
+             if isinstance(value, dict) else str(value))
+            for field, value in args.items()
+            if field not in skip_args))
+
+    @classmethod
+    def resolve_connection(cls, connection_type, model, info, args, resolved):
+        after = decode_keyset_cursor(args.get('after'))
+        before = decode_keyset_cursor(args.get('before'))
+        if resolved is None:
+            resolved = cls.get_query(model, info, **args)
+        if args.get('keyset') or after or before:
+            for name, cursor in (('after', after), ('before', before)):
+                if args.get(name) and cursor is None:
+                    raise ValueError(
+                        '{} is not a keyset cursor. Use the cursors of a '
+                        'keyset: true query or leave out keyset.'
+                        .format(name))
+            connection = cls.resolve_keyset_connection(
+                connection_type, model, args, resolved, after, before)
+        else:
+            connection = cls.resolve_offset_connection(
+                connection_type, args, resolved)
+        connection.count_query = resolved
+        connection.count_key = cls.get_count_key(
+            model, args, graphene_sqlalchemy.utils.get_session(info.context))
+        return connection
+
+    @classmethod
+    def resolve_offset_connection(cls, connection_type, args, query):
+        """Paginate `query` with relay array cursors.
+
+        The table is only counted when `last` or `before` requires
+        the total length, otherwise one row more than requested is
+        fetched to tell whether there is a next page.
+        """
+        slice_start = 0
+        if args.get('last') is not None or args.get('before'):
+            length = query.count()
+            rows = query
+            slice_length = length
+        else:
+            slice_start = get_offset_with_default(args.get('after'), -1) + 1
+            rows = query.offset(slice_start)
+            if args.get('first') is not None:
+                rows = rows.limit(args['first'] + 1)
+            rows = rows.all()
+            slice_length = len(rows)
+            length = None
+
+        connection = connection_from_list_slice(
+            rows,
+            args,
+            slice_start=slice_start,
+            list_length=slice_start + slice_length if length is None
+            else length,
+            list_slice_length=slice_length,
+            connection_type=connection_type,
+            pageinfo_type=graphene.relay.PageInfo,
+            edge_type=connection_type.Edge,
+        )
+        connection.iterable = rows
+        connection.length = length
+        return connection
+
+    @classmethod
+    def resolve_keyset_connection(cls, connection_type, model, args, query,
+                                  after, before):
+        """Paginate `query` by seeking to the (order column, primary key)
+        stored in the `after`/`before` cursors instead of using OFFSET,
+        so that deep pages cost the same as the first one.
+        """
+        column, ascending = None, True
+        if args.get('order'):
+            column, ascending = get_order(model, args['order'])
+        keys = list(sqlalchemy.inspect(model).primary_key)
+        first, last = args.get('first'), args.get('last')
+
+        if after:
+            query = query.filter(keyset_predicate(
+                column, keys, after, greater=ascending))
+        if before:
+            query = query.filter(keyset_predicate(
+                column, keys, before, greater=not ascending))
+
+        # fetch from the end of the range when only `last` is given
+        backwards = last is not None and first is None
+        forward = ascending != backwards
+        order_by = [key if forward else key.desc() for key in keys]
+        if column is not None:
+            order_by.insert(0, column if forward else column.desc())
+        query = query.order_by(None).order_by(*order_by)
+
+        limit = last if backwards else first
+        if limit is not None:
+            query = query.limit(limit + 1)
+        rows = query.all()
+        has_more = limit is not None and len(rows) > limit
+        rows = rows[:limit]
+        if backwards:
+            rows.reverse()
+
+        def cursor(row):
+            values = [getattr(row, key.key) for key in keys]
+            if column is not None:
+                values.insert(0, getattr(row, column.key))
+            return encode_keyset_cursor(values)
+
+        edges = [connection_type.Edge(node=row, cursor=cursor(row))
+                 for row in rows]
+        page_info = graphene.relay.PageInfo(
+            start_cursor=edges[0].cursor if edges else None,
+            end_cursor=edges[-1].cursor if edges else None,
+            has_previous_page=has_more if backwards else bool(after),
+            has_next_page=bool(before) if backwards else has_more,
+        )
+        connection = connection_type(edges=edges, page_info=page_info)
+        connection.iterable = rows
+        # counted only when totalCount is requested
+        connection.length = None
+        return connection
 
     @classmethod
     def get_query(cls, model, info, **args):
-        from sqlalchemy import or_
-        from sqlalchemy.orm import load_only
         query = super(FilteringConnectionField, cls).get_query(model, info)
-        from sqlalchemy.orm import joinedload
+
+        extra_columns = []
+        if args.get('order'):
+            column, _ = get_order(model, args['order'])
+            if column is not None:
+                extra_columns.append(column.key)
+        session = graphene_sqlalchemy.utils.get_session(info.context)
+        skip = []
+        if not models.has_packed_arrays(session):
+            skip.append('packed')
+        if not models.has_derived_columns(session):
+            skip.append('derived')
+        query = query.options(*ProjectionPlan.get(model, info).options(
+            extra_columns=extra_columns, skip=skip))
+
+        return cls.filter_query(model, query, args)
+
+    @classmethod
+    def check_derived_columns(cls, model, session, args):
+        """Raise a ValueError if `args` filter or order by one of the
+        DERIVED_COLUMNS while the schema does not have it yet.
+        """
+        derived = models.DERIVED_COLUMNS.get(model, {})
+        names = set(field.split('__')[0] for field in args
+                    if field not in cls.RELAY_ARGS + cls.SPECIAL_ARGS)
+        if args.get('order'):
+            names.add(convert(args['order'].lstrip('-')))
+        if args.get('filter'):
+            names.update(convert(name)
+                         for name in iter_filter_fields(args['filter']))
+        used = sorted(names.intersection(derived))
+        if used and not models.has_derived_columns(session):
+            raise ValueError(
+                'Filtering and ordering by {} requires the schema '
+                'migration migrations/0005_derived_columns.sql'
+                .format(', '.join(used)))
+
+    @classmethod
+    def filter_query(cls, model, query, args):
+        """Apply the filter arguments from get_filter_fields
+        to `query`.
+        """
+        from sqlalchemy import or_
+        cls.check_derived_columns(model, query.session, args)
         distinct_filter = False  # default value for distinct
         op = 'eq'
         jsonkey_input = None
         ALLOWED_OPS = ['gt', 'lt', 'le', 'ge', 'eq', 'ne',
                        '=',  '>',  '<',  '>=', '<=', '!=']
 
-        cont_fields = ['edges', 'node']
-        skip_fields = ['totalCount', 'pageInfo']
-        fields = info.field_asts# [0].selection_set.selections
-        load_fields = {}
-        field_names = []
-
-        def convert(name):
-            import re
-            s1 = re.sub('(.)([A-Z][a-z]+)', r'\1_\2', name)
-            return re.sub('([a-z0-9])([A-Z])', r'\1_\2', s1).lower()
-
-        include_all = False
-        while isinstance(fields, list):
-            for field in fields:
-                name = field.name.value
-                if name in cont_fields:
-                    fields = field.selection_set.selections
-                elif name in skip_fields:# or name[0].isupper():
-                    continue
-                else:
-                    if name[0].isupper():  # hybrid property
-                        names = models.hybrid_prop_parameters(name)
-                        if 'all' in names:
-                            include_all = True
-                            fields = None
-                            continue
-                    else:
-                        names = [name]
-                    for name in names:
-                        if field.selection_set is not None:
-                            keyname = name
-                            field_names.append(name)
-                            load_fields.update({keyname: []})
-                            fields = field.selection_set.selections
-                        else:
-                            load_fields[keyname].append(convert(name))
-                            fields = None
-
-        if not include_all:
-            query = query.options(load_only(*load_fields[field_names[0]]))
-
-            if len(field_names) > 1:
-                column = getattr(model, convert(field_names[1]), None)
-                query = query.options(joinedload(column, innerjoin=True).load_only(*load_fields[field_names[1]]))
-
         for field, value in args.items():
             if field == 'distinct':
                 distinct_filter = value
@@ -480,15 +1100,28 @@ class FilteringConnectionField(graphene_sqlalchemy.SQLAlchemyConnectionField):
             elif field == 'jsonkey':
                 jsonkey_input = value
             elif field == 'order':
-                ascending = not value.startswith('-')
-                column_name = value if not value.startswith('-') else value[1:]
-                column = getattr(model, convert(column_name), None)
+                column, ascending = get_order(model, value)
 
                 if ascending:
                     query = query.order_by(column)
                 else:
                     query = query.order_by(column.desc())
 
+        if args.get('filter'):
+            query = query.filter(compile_filter(model, args['filter']))
+
+        for field, column_name in LIST_FILTERS.items():
+            values = args.get(field)
+            if values is None:
+                continue
+            if not values:
+                query = query.filter(sqlalchemy.false())
+                continue
+            column = getattr(model, column_name)
+            query = query.filter(column.in_(values))
+            if not args.get('order') and not distinct_filter:
+                query = query.order_by(list_position(column, values))
+
         for field, value in args.items():
             if field not in (cls.RELAY_ARGS + cls.SPECIAL_ARGS):
                 from sqlalchemy.sql.expression import func, cast
@@ -509,6 +1142,7 @@ class FilteringConnectionField(graphene_sqlalchemy.SQLAlchemyConnectionField):
                 elif str(column.type) == "JSONB":
                     jsonb = True
 
+                    json_column = column
                     if jsonkey is not None:
                         query = query.filter(column.has_key(jsonkey))
                         column = column[jsonkey].astext
@@ -531,19 +1165,12 @@ class FilteringConnectionField(graphene_sqlalchemy.SQLAlchemyConnectionField):
 
                         else:
                             if field == 'reactants' or field == 'products':
-                                if not 'star' in value and not 'gas' in value:
-                                    or_statement = or_(column.has_key(value),
-                                                       column.has_key(value +
-                                                                      'gas'),
-                                                       column.has_key(value +
-                                                                      'star'))
-
-                                    query = query.filter(or_statement)
-                                else:
-                                    query = query.filter(column.has_key(value))
+                                query = query.filter(
+                                    species_filter(column, value))
                             else:
                                 if jsonkey is not None:
-                                    query = query.filter(column == value)
+                                    query = query.filter(json_value_filter(
+                                        json_column, jsonkey, value))
                                 else:
                                     query = query.filter(column.has_key(value))
 
@@ -584,6 +1211,142 @@ class FilteringConnectionField(graphene_sqlalchemy.SQLAlchemyConnectionField):
         return query
 
 
+def species_filter(column, species):
+    """Filter on reactants or products containing `species`, in the
+    gas phase or adsorbed unless the state is given, as one `?|`
+    operation that can use the GIN index of the column.
+    """
+    if 'star' in species or 'gas' in species:
+        return column.has_key(species)
+    return column.has_any(postgresql.array(
+        [species, species + 'gas', species + 'star']))
+
+
+def json_value_filter(column, key, value):
+    """Filter on `column[key]` equal to `value` as text. The
+    containment operators narrow the rows down through the GIN index
+    of the column, the text comparison keeps the exact semantics for
+    numbers and booleans.
+    """
+    candidates = [value]
+    try:
+        parsed = json.loads(value)
+    except ValueError:
+        pass
+    else:
+        if not isinstance(parsed, (dict, list, str)):
+            candidates.append(parsed)
+    return sqlalchemy.and_(
+        sqlalchemy.or_(*[column.contains({key: candidate})
+                         for candidate in candidates]),
+        column[key].astext == value)
+
+
+# graphene scalar of the comparisons of each filterable column type
+FILTER_SCALARS = [
+    (sqlalchemy.Boolean, graphene.Boolean),
+    (sqlalchemy.Integer, graphene.Int),
+    (sqlalchemy.Float, graphene.Float),
+    (sqlalchemy.String, graphene.String),
+]
+
+COMPARISONS = collections.OrderedDict([
+    ('eq', lambda column, value: column == value),
+    ('ne', lambda column, value: column != value),
+    ('gt', lambda column, value: column > value),
+    ('ge', lambda column, value: column >= value),
+    ('lt', lambda column, value: column < value),
+    ('le', lambda column, value: column <= value),
+    ('in_', lambda column, values: column.in_(values) if values
+     else sqlalchemy.false()),
+    ('is_null', lambda column, value: column.is_(None) if value
+     else column.isnot(None)),
+])
+
+COMPARISON_INPUTS = {}
+FILTER_INPUTS = {}
+
+
+def get_comparison_input(scalar):
+    """Input type of the COMPARISONS of a column, e.g.
+    `{ge: -1, le: 0.5}` or `{in: ["Pt", "Cu"]}`.
+    """
+    if scalar not in COMPARISON_INPUTS:
+        fields = collections.OrderedDict(
+            (name, scalar()) for name in ['eq', 'ne', 'gt', 'ge', 'lt', 'le'])
+        fields['in_'] = graphene.List(scalar, name='in')
+        fields['is_null'] = graphene.Boolean()
+        COMPARISON_INPUTS[scalar] = type(
+            '{}Comparison'.format(scalar.__name__),
+            (graphene.InputObjectType, ), fields)
+    return COMPARISON_INPUTS[scalar]
+
+
+def get_filter_input(model):
+    """Input type of the structured `filter` argument of `model`:
+    comparisons of its scalar columns, which must all hold, and
+    nested `and`, `or` and `not` groups of filters.
+    """
+    name = '{}Filter'.format(model.__name__)
+    if name not in FILTER_INPUTS:
+        fields = collections.OrderedDict()
+        for prop in sqlalchemy.inspect(model).column_attrs:
+            if prop.key.startswith('_'):
+                continue
+            for column_type, scalar in FILTER_SCALARS:
+                if isinstance(prop.columns[0].type, column_type):
+                    fields[prop.key] = get_comparison_input(scalar)()
+                    break
+        fields['and_'] = graphene.List(lambda: FILTER_INPUTS[name],
+                                       name='and')
+        fields['or_'] = graphene.List(lambda: FILTER_INPUTS[name],
+                                      name='or')
+        fields['not_'] = graphene.InputField(lambda: FILTER_INPUTS[name],
+                                             name='not')
+        FILTER_INPUTS[name] = type(name, (graphene.InputObjectType, ),
+                                   fields)
+    return FILTER_INPUTS[name]
+
+
+def iter_filter_fields(filter):
+    """Yield the column names used in a structured filter."""
+    for field, value in filter.items():
+        if value is None:
+            continue
+        if field in ('and_', 'or_'):
+            for child in value:
+                yield from iter_filter_fields(child)
+        elif field == 'not_':
+            yield from iter_filter_fields(value)
+        else:
+            yield field
+
+
+def compile_filter(model, filter):
+    """SQL condition of a structured filter from get_filter_input."""
+    clauses = []
+    for field, value in filter.items():
+        if value is None:
+            continue
+        if field == 'and_':
+            clauses.append(sqlalchemy.and_(
+                *[compile_filter(model, f) for f in value]))
+        elif field == 'or_':
+            clauses.append(sqlalchemy.or_(
+                *[compile_filter(model, f) for f in value])
+                if value else sqlalchemy.false())
+        elif field == 'not_':
+            clauses.append(sqlalchemy.not_(compile_filter(model, value)))
+        else:
+            column = get_column(model, field)
+            for comparison, operand in value.items():
+                if operand is not None:
+                    clauses.append(COMPARISONS[comparison](column, operand))
+    if not clauses:
+        return sqlalchemy.true()
+    return sqlalchemy.and_(*clauses)
+
+
 def get_filter_fields(model):
     """Generate filter fields (= comparison)
     from graphene_sqlalcheme model
@@ -627,10 +1390,146 @@ def get_filter_fields(model):
     filter_fields['search'] = graphene.String()
     filter_fields['jsonkey'] = graphene.String()
     filter_fields['order'] = graphene.String()
+    filter_fields['keyset'] = graphene.Boolean()
+    filter_fields['filter'] = get_filter_input(model)()
+    for field, column_name in LIST_FILTERS.items():
+        if column_name in filter_fields:
+            filter_fields[field] = graphene.List(
+                type(filter_fields[column_name]))
 
     return filter_fields
 
 
+AGGREGATES = ['count', 'min', 'max', 'avg', 'percentile']
+
+
+class Aggregate(graphene.ObjectType):
+    """Statistics of one group of rows. Aggregates that were not
+    requested are null.
+    """
+    group = graphene.JSONString()
+    count = graphene.Int()
+    min = graphene.Float()
+    max = graphene.Float()
+    avg = graphene.Float()
+    percentiles = graphene.List(graphene.Float)
+    histogram = graphene.List(graphene.Int)
+
+
+def get_column(model, name):
+    """Model column of an argument like "surfaceComposition"."""
+    attribute = getattr(model, convert(name), None)
+    if not isinstance(getattr(attribute, 'property', None),
+                      sqlalchemy.orm.ColumnProperty):
+        raise ValueError('Unknown column {} of {}'
+                         .format(name, model.__name__))
+    return attribute
+
+
+def get_aggregate_fields(model):
+    """Arguments of an aggregation field: the filters of
+    get_filter_fields and the grouping and statistics to compute.
+    """
+    fields = get_filter_fields(model)
+    for field in ['distinct', 'order', 'keyset']:
+        fields.pop(field)
+    fields['column'] = graphene.String()
+    fields['group_by'] = graphene.List(graphene.String)
+    fields['aggregates'] = graphene.List(graphene.String)
+    fields['percentiles'] = graphene.List(graphene.Float)
+    fields['bins'] = graphene.List(graphene.Float)
+    return fields
+
+
+def aggregate(model, session, column, group_by=(), aggregates=('count', ),
+              percentiles=(0.5, ), bins=None, filters=None):
+    """Statistics of `column` for each group of rows with equal
+    `group_by` columns, computed with one GROUP BY query.
+
+    count is the number of rows in the group. min, max, avg and
+    percentile skip null values. `bins` are histogram edges like
+    numpy.histogram's, the last bin includes its upper edge.
+    """
+    for name in aggregates:
+        if name not in AGGREGATES:
+            raise ValueError('Unsupported aggregate {}. Should be one of {}'
+                             .format(name, AGGREGATES))
+    column = get_column(model, column)
+    if not isinstance(column.type, (sqlalchemy.Integer, sqlalchemy.Numeric)):
+        raise ValueError('Column {} is not numeric'.format(column.key))
+    if bins is not None and (len(bins) < 2 or list(bins) != sorted(bins)):
+        raise ValueError('Histogram bins should be at least two '
+                         'increasing edges')
+    group_columns = [get_column(model, name) for name in group_by]
+
+    func = sqlalchemy.func
+    expressions = collections.OrderedDict()
+    if 'count' in aggregates:
+        expressions['count'] = func.count()
+    for name in ['min', 'max', 'avg']:
+        if name in aggregates:
+            expressions[name] = getattr(func, name)(column)
+    if 'percentile' in aggregates:
+        fractions = sqlalchemy.cast(
+            postgresql.array([float(p) for p in percentiles]),
+            postgresql.ARRAY(sqlalchemy.Float))
+        expressions['percentiles'] = func.percentile_cont(fractions) \
+            .within_group(column)
+    if bins is not None:
+        for i, (lower, upper) in enumerate(zip(bins[:-1], bins[1:])):
+            below = column <= upper if i == len(bins) - 2 else column < upper
+            expressions['bin{}'.format(i)] = func.count().filter(
+                sqlalchemy.and_(column >= lower, below))
+
+    query = session.query(
+        *(group_columns + [expression.label(name) for name, expression
+                           in expressions.items()])).select_from(model)
+    query = FilteringConnectionField.filter_query(model, query, filters or {})
+    query = query.order_by(None).group_by(*group_columns) \
+        .order_by(*group_columns)
+
+    results = []
+    for row in query:
+        values = dict(zip(row.keys(), row))
+        result = Aggregate(
+            group=collections.OrderedDict(
+                zip(group_by, row[:len(group_columns)])),
+            count=values.get('count'),
+            min=values.get('min'),
+            max=values.get('max'),
+            avg=values.get('avg'),
+            percentiles=values.get('percentiles'))
+        if bins is not None:
+            result.histogram = [values['bin{}'.format(i)]
+                                for i in range(len(bins) - 1)]
+        results.append(result)
+    return results
+
+
+def resolve_aggregates(model, info, args):
+    """Resolve an aggregation field. Without an `aggregates` argument
+    the statistics selected in the query are computed.
+    """
+    args = dict(args)
+    options = {name: args.pop(name) for name in
+               ['column', 'group_by', 'aggregates', 'percentiles', 'bins']
+               if args.get(name) is not None}
+    if 'aggregates' not in options:
+        selected = [field.name.value for field_ast in info.field_asts
+                    for field in iter_fields(field_ast.selection_set,
+                                             info.fragments)]
+        options['aggregates'] = [
+            'percentile' if name == 'percentiles' else name
+            for name in selected if name in AGGREGATES + ['percentiles']]
+    return aggregate(model, graphene_sqlalchemy.utils.get_session(
+        info.context), filters=args, **options)
+
+
+class DistinctValue(graphene.ObjectType):
+    value = graphene.String()
+    count = graphene.Int()
+
+
 class Query(graphene.ObjectType):
     node = graphene.relay.Node.Field()
     information = FilteringConnectionField(
@@ -664,6 +1563,28 @@ class Query(graphene.ObjectType):
         Xrd, **get_filter_fields(models.Xrd))
     echemical = FilteringConnectionField(
         Echemical, **get_filter_fields(models.Echemical))
+    reaction_aggregates = graphene.List(
+        Aggregate, **get_aggregate_fields(models.Reaction))
+
+    def resolve_reaction_aggregates(self, info, **args):
+        args.setdefault('column', 'reactionEnergy')
+        return resolve_aggregates(models.Reaction, info, args)
+
+    distinct_values = graphene.List(
+        DistinctValue, source=graphene.String(required=True),
+        attribute=graphene.String(required=True), prefix=graphene.String(),
+        first=graphene.Int())
+
+    def resolve_distinct_values(self, info, source, attribute, prefix=None,
+                                first=None):
+        """Distinct values of an attribute of reactions or systems,
+        see facets.FACETS.
+        """
+        values = facets.get_values(
+            graphene_sqlalchemy.utils.get_session(info.context),
+            source, convert(attribute), prefix, first)
+        return [DistinctValue(value=value, count=count)
+                for value, count in values]
 
 schema = graphene.Schema(
     query=Query, types=[System, Species, TextKeyValue, NumberKeyValue, Key,
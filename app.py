@@ -6,7 +6,6 @@ import numpy as np
 import os
 import json
 import flask
-import flask_graphql
 import flask_sqlalchemy
 from flask_cors import CORS
 import logging
@@ -14,6 +13,7 @@ from raven.contrib.flask import Sentry
 # local imports
 import models
 import api
+import graphql_view
 import traceback
 from sqlalchemy.exc import OperationalError
 
@@ -66,6 +66,10 @@ bulk_enumerator = None
 #    traceback.print_exc()
 catKitDemo = None
 
+from apps.export import export_blueprint
+from apps.stats import stats_blueprint
+from apps.typeahead import typeahead_blueprint
+
 try:
     from apps.upload import upload
 except ImportError as e:
@@ -203,7 +207,7 @@ if catKitDemo is not None:
 
 # Graphql view
 app.add_url_rule('/graphql',
-                 view_func=flask_graphql.GraphQLView.as_view(
+                 view_func=graphql_view.GraphQLView.as_view(
                      'graphql',
                      schema=api.schema,
                      graphiql=True,
@@ -221,11 +225,18 @@ if catlearn_blueprint is not None:
     app.register_blueprint(catlearn_blueprint, url_prefix='/apps/catlearn')
 if upload is not None:
     app.register_blueprint(upload, url_prefix='/apps/upload')
+app.register_blueprint(export_blueprint)
+app.register_blueprint(stats_blueprint)
+app.register_blueprint(typeahead_blueprint)
 
 # Needed to set session cookies.
 os.environ['OAUTHLIB_INSECURE_TRANSPORT'] = '1'
 app.secret_key = os.environ.get('FLASK_SECRET_KEY', '')
 
+# gunicorn --preload forks the workers after importing this module,
+# they must not share connections opened by the master
+db.engine.dispose()
+
 
 if __name__ == '__main__':
     import optparse
@@ -45,8 +45,8 @@ class ReactionModel(object):
         pass
 
 
-def graphql_query(products='products: "O"',
-                  reactants='', facet='', pub_id=None, limit=5000):
+def reactions_query(products='products: "O"',
+                    reactants='', facet='', pub_id=None, limit=5000):
     publication = ''
     if pub_id is not None:
         publication = ' pubId: "{}"'.format(pub_id)
@@ -69,11 +69,24 @@ def graphql_query(products='products: "O"',
       }}
     }}""".format(**locals()).replace('\n', '')}
 
-    response = requests.get(GRAPHQL_ROOT, query).json()
+    return query
+
+
+def graphql_query(*args, **kwargs):
+    response = requests.get(GRAPHQL_ROOT, reactions_query(*args, **kwargs)).json()
 
     return response
 
 
+def graphql_batch(queries):
+    """Send several queries in one request, returns their
+    responses in the same order.
+    """
+    if not queries:
+        return []
+    return requests.post(GRAPHQL_ROOT, json=queries).json()
+
+
 @activityMaps.route('/systems/', methods=['GET', 'POST'])
 def systems(request=None):
     """
@@ -161,11 +174,15 @@ def systems(request=None):
                 if not pub_id in OOH_pub_ids:
                     OOH_pub_ids = [pub_id_sub]
 
-        for reactant in ['OH', 'O']:
-            for pub_id_sub in OOH_pub_ids:
-                raw_systems[reactant]['data']['reactions']['edges'] += graphql_query(
-                    products='products: "' + reactant + '", ',
-                    pub_id=pub_id_sub)['data']['reactions']['edges']
+        batch = [(reactant, reactions_query(
+                      products='products: "' + reactant + '", ',
+                      pub_id=pub_id_sub))
+                 for reactant in ['OH', 'O']
+                 for pub_id_sub in OOH_pub_ids]
+        responses = graphql_batch([query for _, query in batch])
+        for (reactant, _), response in zip(batch, responses):
+            raw_systems[reactant]['data']['reactions']['edges'] += \
+                response['data']['reactions']['edges']
 
         systems = {}
         for reactant in raw_systems:
@@ -267,20 +284,17 @@ def systems(request=None):
         raw_systems['NH2'] = {'data': {'reactions': {'edges': []}}}
         raw_systems['NH'] = {'data': {'reactions': {'edges': []}}}
 
-        for pub_id_sub in NNH_pub_ids:
-            raw_systems['NH2']['data']['reactions']['edges'] += graphql_query(
-                reactants='reactants: "star+H2gas+N2gas",',
-                products=' products: "NH2star", ',
-                facet='facet: "' + '~111' + '", ',
-                pub_id=pub_id_sub
-            )['data']['reactions']['edges']
-
-            raw_systems['NH']['data']['reactions']['edges'] += graphql_query(
-                reactants='reactants: "star+H2gas+N2gas",',
-                products='products: "NHstar", ',
-                facet='facet: "' + '~111' + '", ',
-                pub_id=pub_id_sub
-            )['data']['reactions']['edges']
+        batch = [(reactant, reactions_query(
+                      reactants='reactants: "star+H2gas+N2gas",',
+                      products='products: "' + reactant + 'star", ',
+                      facet='facet: "' + '~111' + '", ',
+                      pub_id=pub_id_sub))
+                 for pub_id_sub in NNH_pub_ids
+                 for reactant in ['NH2', 'NH']]
+        responses = graphql_batch([query for _, query in batch])
+        for (reactant, _), response in zip(batch, responses):
+            raw_systems[reactant]['data']['reactions']['edges'] += \
+                response['data']['reactions']['edges']
 
         systems = {}
         for reactant in raw_systems:
@@ -371,23 +385,22 @@ def systems(request=None):
 
     elif activityMap == 'CO_Hydrogenation_111':
         raw_systems = {}
-        raw_systems['COstar'] = list(map(
-            lambda x: x['node'],
-            graphql_query(
+        co_response, oh_response = graphql_batch([
+            reactions_query(
                 products='products: "' + 'COstar' + '", ',
                 reactants='reactants: "' + 'COgas' + '", ',
                 facet='facet: "' + '111' + '", ',
-            )['data']['reactions']['edges']
-        ))
-
-        raw_systems['OHstar'] = list(map(
-            lambda x: x['node'],
-            graphql_query(
+            ),
+            reactions_query(
                 products='products: "' + 'H2gas+OHstar' + '", ',
                 reactants='reactants: "' + 'H2Ogas' + '", ',
                 facet='facet: "' + '111' + '", ',
-            )['data']['reactions']['edges']
-        ))
+            ),
+        ])
+        raw_systems['COstar'] = list(map(
+            lambda x: x['node'], co_response['data']['reactions']['edges']))
+        raw_systems['OHstar'] = list(map(
+            lambda x: x['node'], oh_response['data']['reactions']['edges']))
 
         systems = {}
         for reactant in raw_systems:
@@ -0,0 +1,141 @@
+"""
+Bulk downloads of systems and reactions, see export.py::
+
+    /export/<table>?<filters>&format=ndjson|extxyz|npz
+    /input_files/?uniqueIds=<id1>,<id2>&formats=vasp
+    /packed_arrays/<uniqueId>/<array>
+"""
+import flask
+import numpy as np
+import sqlalchemy.orm
+
+import export
+import models
+from apps.utils import get_db
+
+export_blueprint = flask.Blueprint('export', __name__)
+
+
+@export_blueprint.route('/export/<table>')
+def export_table(table):
+    """Stream all rows of `table` matching the filters in the query
+    string as NDJSON or, for systems, extxyz. Reactions can also be
+    downloaded as columnar .npz bundle.
+    """
+    if table not in export.EXPORT_TABLES:
+        return flask.jsonify({
+            'error': 'table {} is invalid. Should be one of {}'.format(
+                table, sorted(export.EXPORT_TABLES))}), 404
+    out_format = flask.request.args.get('format', 'ndjson')
+    if out_format not in export.EXPORT_FORMATS[table]:
+        return flask.jsonify({
+            'error': 'format {} is invalid. Should be one of {}'.format(
+                out_format, export.EXPORT_FORMATS[table])}), 400
+
+    model = export.EXPORT_TABLES[table]
+    try:
+        args = export.parse_filters(model, flask.request.args)
+    except ValueError as e:
+        return flask.jsonify({'error': str(e)}), 400
+
+    session = get_db().session
+    if out_format in export.COLUMNAR_FORMATS:
+        columns = flask.request.args.get('columns')
+        try:
+            bundle = export.export_npz(
+                session, model, args,
+                columns.split(',') if columns else None)
+        except export.TooManyRows as e:
+            return flask.jsonify({'error': str(e)}), 413
+        except ValueError as e:
+            return flask.jsonify({'error': str(e)}), 400
+        return flask.Response(
+            bundle,
+            mimetype=export.MIMETYPES[out_format],
+            headers={'Content-Disposition':
+                     'attachment; filename={}.{}'.format(table, out_format)})
+
+    query = export.export_query(session, model, args)
+    return flask.Response(
+        flask.stream_with_context(export.generate(query, out_format)),
+        mimetype=export.MIMETYPES[out_format],
+        headers={'Content-Disposition':
+                 'attachment; filename={}.{}'.format(table, out_format)})
+
+
+@export_blueprint.route('/input_files/', methods=['GET', 'POST'])
+def input_files():
+    """Zip archive of DFT input files for several systems, given as
+    comma separated (or JSON list of) uniqueIds or as pubId, in one
+    or more ASE formats.
+    """
+    params = dict(flask.request.args.items())
+    if flask.request.is_json:
+        params.update(flask.request.get_json())
+
+    def get_list(name):
+        value = params.get(name) or []
+        if isinstance(value, str):
+            value = [item.strip() for item in value.split(',') if item.strip()]
+        return value
+
+    unique_ids = get_list('uniqueIds')
+    formats = get_list('formats') or ['py']
+    pub_id = params.get('pubId')
+    invalid = [out_format for out_format in formats
+               if out_format not in export.writable_formats()]
+    if invalid:
+        return flask.jsonify({
+            'error': 'formats {} are invalid. Should be one of {}'.format(
+                invalid, export.writable_formats())}), 400
+    if bool(unique_ids) == bool(pub_id):
+        return flask.jsonify({
+            'error': 'Either uniqueIds or pubId is required.'}), 400
+
+    try:
+        systems = export.input_file_systems(get_db().session, unique_ids,
+                                            pub_id)
+    except ValueError as e:
+        return flask.jsonify({'error': str(e)}), 404
+    if len(systems) > export.MAX_INPUT_FILE_SYSTEMS:
+        return flask.jsonify({
+            'error': 'At most {} systems per request.'.format(
+                export.MAX_INPUT_FILE_SYSTEMS)}), 400
+
+    return flask.Response(
+        flask.stream_with_context(
+            export.generate_input_files(systems, formats)),
+        mimetype='application/zip',
+        headers={'Content-Disposition':
+                 'attachment; filename=input_files.zip'})
+
+
+@export_blueprint.route('/packed_arrays/<unique_id>/<array>')
+def packed_array(unique_id, array):
+    """One per-atom array of a system as raw little-endian float64
+    buffer, with its shape in the X-Array-Shape header.
+    """
+    if array not in models.PACKED_ARRAYS:
+        return flask.jsonify({
+            'error': 'array {} is invalid. Should be one of {}'.format(
+                array, list(models.PACKED_ARRAYS))}), 404
+    session = get_db().session
+    query = session.query(models.System).options(
+        sqlalchemy.orm.load_only('id', 'mtime', array))
+    if models.has_packed_arrays(session):
+        query = query.options(sqlalchemy.orm.joinedload(models.System.packed))
+    system = query.filter(models.System.unique_id == unique_id).one_or_none()
+    if system is None:
+        return flask.jsonify({
+            'error': 'Unknown uniqueId: {}'.format(unique_id)}), 404
+    buffer = system._get_packed(array)
+    if buffer is None:
+        return flask.jsonify({
+            'error': '{} is not stored for {}'.format(array, unique_id)}), 404
+    shape = models.PACKED_ARRAYS[array]
+    if shape[0] == -1:
+        shape = (len(buffer) // 8 // int(np.prod(shape[1:])),) + shape[1:]
+    return flask.Response(
+        buffer,
+        mimetype='application/octet-stream',
+        headers={'X-Array-Shape': ','.join(str(n) for n in shape)})
@@ -0,0 +1,25 @@
+"""
+Statistics of the in-process caches and the instrumented GraphQL
+requests::
+
+    /cache/
+    /instrumentation/
+"""
+import flask
+
+import cache
+import instrumentation
+
+stats_blueprint = flask.Blueprint('stats', __name__)
+
+
+@stats_blueprint.route('/cache/')
+def cache_stats():
+    """Hit/miss statistics of the in-process caches."""
+    return flask.jsonify(cache.stats())
+
+
+@stats_blueprint.route('/instrumentation/')
+def instrumentation_stats():
+    """Histograms of the instrumented GraphQL requests by operation."""
+    return flask.jsonify(instrumentation.stats())
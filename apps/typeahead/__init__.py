@@ -0,0 +1,36 @@
+"""
+Completions for the search boxes of the frontend, see typeahead.py::
+
+    /typeahead?q=bajd&categories=authors,titles&limit=10
+"""
+import flask
+
+import typeahead
+from apps.utils import get_db
+
+typeahead_blueprint = flask.Blueprint('typeahead', __name__)
+
+
+@typeahead_blueprint.route('/typeahead')
+def typeahead_completions():
+    """Completions of the prefix `q` from the in-memory typeahead
+    index, optionally restricted to comma separated `categories`.
+    """
+    categories = [category for category in
+                  flask.request.args.get('categories', '').split(',')
+                  if category]
+    invalid = [category for category in categories
+               if category not in typeahead.TYPEAHEAD_QUERIES]
+    if invalid:
+        return flask.jsonify({
+            'error': 'categories {} are invalid. Should be one of {}'.format(
+                invalid, list(typeahead.TYPEAHEAD_QUERIES))}), 400
+    try:
+        limit = min(int(flask.request.args.get('limit', 10)),
+                    typeahead.MAX_COMPLETIONS)
+    except ValueError:
+        return flask.jsonify({'error': 'limit should be an integer'}), 400
+    completions = typeahead.TYPEAHEAD.complete(
+        get_db().engine, flask.request.args.get('q', ''), categories, limit)
+    return flask.jsonify([completion._asdict()
+                          for completion in completions])
@@ -35,6 +35,9 @@ import ase.build
 
 import models
 import api
+import cache
+import facets
+from apps.utils import get_db
 
 import sendgrid
 
@@ -545,6 +548,8 @@ def delete():
              })
 
         cathub_db.delete_publication(pub_id)
+        cache.invalidate()
+        facets.schedule_refresh(get_db().engine)
 
         return flask.jsonify({
                  'status': 'ok',
@@ -5,12 +5,18 @@ except:
 
 import ase
 import ase.io
+import flask
 
 VALID_FORMATS = ["abinit", "castep-cell", "cfg", "cif", "dlp4", "eon", "espresso-in", "extxyz", "findsym",
                      "gen", "gromos", "json", "jsv", "nwchem", "proteindatabank", "py", "traj", "turbomole", "v-sim", "vasp", "xsf", "xyz"]
 
 
 
+def get_db():
+    """flask_sqlalchemy.SQLAlchemy instance of the current app."""
+    return flask.current_app.extensions['sqlalchemy'].db
+
+
 def ase_convert(instring, informat=None, outformat=None, atoms_in=False, atoms_out=False):
     """Enter a input file that is understood by ASE
     and return a string in a different format as written
@@ -0,0 +1,289 @@
+"""
+Small in-process caches shared by the API and the apps.
+
+Caches holding data derived from the database are registered by
+name, so that they can all be cleared with invalidate() after a
+write and reported with stats(). Content addressed caches, whose
+keys change whenever the data does, are registered with
+`invalidate=False` and only show up in the statistics.
+"""
+# global imports
+import collections
+import hashlib
+import os
+import shutil
+import tempfile
+import threading
+import time
+
+REGISTRY = collections.OrderedDict()
+PERSISTENT = set()
+
+
+def register(name, cache, invalidate=True):
+    """Register `cache` under `name` and return it."""
+    REGISTRY[name] = cache
+    if not invalidate:
+        PERSISTENT.add(name)
+    return cache
+
+
+def invalidate():
+    """Clear all registered caches, e.g. after a publication was
+    uploaded or deleted.
+    """
+    for name, cache in REGISTRY.items():
+        if name not in PERSISTENT:
+            cache.clear()
+
+
+def stats():
+    return {name: cache.stats() for name, cache in REGISTRY.items()}
+
+
+class LRUCache(object):
+    """Thread-safe least-recently-used cache.
+
+    Entries are evicted once more than `maxsize` are stored, once the
+    values take more than `maxbytes` (measured with len()) or, if `ttl`
+    is given, once they are older than `ttl` seconds. Hits, misses and
+    evictions are counted so that the cache can be sized from `stats()`.
+    """
+
+    def __init__(self, maxsize=1024, ttl=None, maxbytes=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.maxbytes = maxbytes
+        self.nbytes = 0
+        self.lock = threading.RLock()
+        self.entries = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, key):
+        with self.lock:
+            return self._lookup(key) is not None
+
+    def _lookup(self, key):
+        entry = self.entries.get(key)
+        if entry is None:
+            return None
+        if self.ttl is not None and time.time() - entry[1] > self.ttl:
+            self._remove(key)
+            self.evictions += 1
+            return None
+        self.entries.move_to_end(key)
+        return entry
+
+    def get(self, key, default=None):
+        with self.lock:
+            entry = self._lookup(key)
+            if entry is None:
+                self.misses += 1
+                return default
+            self.hits += 1
+            return entry[0]
+
+    def _remove(self, key):
+        entry = self.entries.pop(key, None)
+        if entry is not None:
+            self.nbytes -= entry[2]
+        return entry
+
+    def set(self, key, value):
+        nbytes = len(value) if self.maxbytes is not None else 0
+        with self.lock:
+            self._remove(key)
+            if self.maxbytes is not None and nbytes > self.maxbytes:
+                return
+            self.entries[key] = (value, time.time(), nbytes)
+            self.nbytes += nbytes
+            while len(self.entries) > self.maxsize or \
+                    (self.maxbytes is not None
+                     and self.nbytes > self.maxbytes):
+                self._remove(next(iter(self.entries)))
+                self.evictions += 1
+
+    def pop(self, key, default=None):
+        with self.lock:
+            entry = self._remove(key)
+            return default if entry is None else entry[0]
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.nbytes = 0
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                'size': len(self.entries),
+                'maxsize': self.maxsize,
+                'nbytes': self.nbytes,
+                'maxbytes': self.maxbytes,
+                'ttl': self.ttl,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'hit_rate': float(self.hits) / lookups if lookups else 0.,
+            }
+
+
+class DiskCache(object):
+    """Cache of strings stored as files below `directory`.
+
+    Files are named after the SHA-256 hash of the key and written
+    atomically, so several processes can share one directory.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(directory, exist_ok=True)
+
+    def path(self, key):
+        digest = hashlib.sha256(repr(key).encode('utf8')).hexdigest()
+        return os.path.join(self.directory, digest[:2], digest)
+
+    def get(self, key, default=None):
+        try:
+            with open(self.path(key), encoding='utf8') as cache_file:
+                value = cache_file.read()
+        except (IOError, OSError):
+            with self.lock:
+                self.misses += 1
+            return default
+        with self.lock:
+            self.hits += 1
+        return value
+
+    def set(self, key, value):
+        path = self.path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        handle, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path))
+        with os.fdopen(handle, 'w', encoding='utf8') as cache_file:
+            cache_file.write(value)
+        os.replace(tmp_path, path)
+
+    def clear(self):
+        for name in os.listdir(self.directory):
+            shutil.rmtree(os.path.join(self.directory, name),
+                          ignore_errors=True)
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                'directory': self.directory,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': float(self.hits) / lookups if lookups else 0.,
+            }
+
+
+class TieredCache(object):
+    """In-process LRU cache in front of an optional DiskCache."""
+
+    def __init__(self, memory, disk=None):
+        self.memory = memory
+        self.disk = disk
+
+    def get(self, key, default=None):
+        value = self.memory.get(key)
+        if value is None and self.disk is not None:
+            value = self.disk.get(key)
+            if value is not None:
+                self.memory.set(key, value)
+        return default if value is None else value
+
+    def set(self, key, value):
+        self.memory.set(key, value)
+        if self.disk is not None:
+            self.disk.set(key, value)
+
+    def clear(self):
+        self.memory.clear()
+        if self.disk is not None:
+            self.disk.clear()
+
+    def stats(self):
+        stats = {'memory': self.memory.stats()}
+        if self.disk is not None:
+            stats['disk'] = self.disk.stats()
+        return stats
+
+
+class SingleFlight(object):
+    """Share one execution among concurrent calls with the same key.
+
+    The first caller of do() runs the function, callers arriving
+    while it runs wait for and return its result (or exception).
+    clear() forgets the running calls, so that calls arriving after
+    a write start a new execution. Waiting callers give up after
+    `timeout` seconds and run the function themselves.
+    """
+
+    def __init__(self, timeout=None):
+        self.timeout = timeout
+        self.lock = threading.Lock()
+        self.calls = {}
+        self.executions = 0
+        self.shared = 0
+
+    def __len__(self):
+        return len(self.calls)
+
+    def do(self, key, function):
+        """Return (result of `function`, whether it was shared)."""
+        with self.lock:
+            call = self.calls.get(key)
+            if call is None:
+                call = self.calls[key] = {'done': threading.Event()}
+                self.executions += 1
+                leader = True
+            else:
+                self.shared += 1
+                leader = False
+
+        if not leader:
+            if call['done'].wait(self.timeout):
+                if 'error' in call:
+                    raise call['error']
+                return call['result'], True
+            with self.lock:
+                self.shared -= 1
+                self.executions += 1
+            return function(), False
+
+        try:
+            call['result'] = function()
+        except Exception as e:
+            call['error'] = e
+            raise
+        finally:
+            with self.lock:
+                if self.calls.get(key) is call:
+                    del self.calls[key]
+            call['done'].set()
+        return call['result'], False
+
+    def clear(self):
+        with self.lock:
+            self.calls.clear()
+
+    def stats(self):
+        with self.lock:
+            calls = self.executions + self.shared
+            return {
+                'in_flight': len(self.calls),
+                'executions': self.executions,
+                'shared': self.shared,
+                'share_rate': float(self.shared) / calls if calls else 0.,
+            }
@@ -0,0 +1,224 @@
+"""
+Static cost analysis and admission control of GraphQL queries.
+
+Before a query is executed its cost is estimated from the parsed
+document as the number of rows times the fields resolved for each
+row:
+
+- connections return `first` or `last` rows, at most as many rows
+  as ids given in LIST_ARGS, or UNBOUNDED_ROWS (FILTERED_ROWS with
+  filter arguments) without them; nested
+  connections and lists are assumed to hold LIST_ROWS rows
+- plain fields cost 1 per row, hybrid properties the weight declared
+  in models.HYBRID_PROP_COSTS
+
+Queries above QUERY_COST_BUDGET are rejected. Queries above
+HEAVY_QUERY_COST wait for one of HEAVY_QUERY_SLOTS, so that heavy
+queries cannot occupy all worker threads. Every query runs with a
+Postgres statement_timeout proportional to its cost, but at least
+MIN_STATEMENT_TIMEOUT since the estimate cannot tell an indexed
+lookup from an ILIKE scan or count over the large tables.
+"""
+# global imports
+import contextlib
+import os
+import threading
+
+import graphql.language.ast
+from graphql.type.definition import (GraphQLList, GraphQLNonNull,
+                                     GraphQLObjectType)
+
+# local imports
+import models
+
+UNBOUNDED_ROWS = int(os.environ.get('UNBOUNDED_ROWS', 10000))
+FILTERED_ROWS = int(os.environ.get('FILTERED_ROWS', 500))
+LIST_ROWS = int(os.environ.get('LIST_ROWS', 20))
+
+QUERY_COST_BUDGET = float(os.environ.get('QUERY_COST_BUDGET', 1e6))
+HEAVY_QUERY_COST = float(os.environ.get('HEAVY_QUERY_COST', 5e4))
+HEAVY_QUERY_SLOTS = int(os.environ.get('HEAVY_QUERY_SLOTS', 1))
+HEAVY_QUERY_TIMEOUT = float(os.environ.get('HEAVY_QUERY_TIMEOUT', 30))
+
+# statement_timeout in milliseconds per unit of cost and its bounds
+STATEMENT_TIMEOUT_PER_COST = float(
+    os.environ.get('STATEMENT_TIMEOUT_PER_COST', 0.1))
+MIN_STATEMENT_TIMEOUT = int(os.environ.get('MIN_STATEMENT_TIMEOUT', 15000))
+MAX_STATEMENT_TIMEOUT = int(os.environ.get('MAX_STATEMENT_TIMEOUT', 60000))
+
+# arguments of connections that do not filter rows
+PAGINATION_ARGS = ['first', 'last', 'before', 'after', 'order', 'keyset',
+                   'distinct', 'op', 'jsonkey']
+
+# list-valued arguments selecting at most one row per value
+LIST_ARGS = ['ids', 'uniqueIds']
+
+HEAVY_QUERIES = threading.BoundedSemaphore(HEAVY_QUERY_SLOTS)
+
+
+class QueryCostExceeded(Exception):
+    pass
+
+
+class QueryQueueTimeout(Exception):
+    pass
+
+
+def unwrap(graphql_type):
+    while isinstance(graphql_type, GraphQLNonNull):
+        graphql_type = graphql_type.of_type
+    return graphql_type
+
+
+def is_connection(graphql_type):
+    return isinstance(graphql_type, GraphQLObjectType) \
+        and 'edges' in graphql_type.fields \
+        and 'pageInfo' in graphql_type.fields
+
+
+def argument_value(value, variables):
+    if isinstance(value, graphql.language.ast.Variable):
+        return variables.get(value.name.value)
+    if isinstance(value, graphql.language.ast.IntValue):
+        return int(value.value)
+    if isinstance(value, graphql.language.ast.ListValue):
+        return [argument_value(item, variables) for item in value.values]
+    if isinstance(value, graphql.language.ast.ObjectValue):
+        return {field.name.value: argument_value(field.value, variables)
+                for field in value.fields}
+    return getattr(value, 'value', None)
+
+
+def connection_rows(field, variables, top_level):
+    """Number of rows a connection field is expected to return."""
+    arguments = {argument.name.value: argument_value(argument.value,
+                                                     variables)
+                 for argument in field.arguments or []}
+    limits = [arguments[name] for name in ['first', 'last']
+              if isinstance(arguments.get(name), int)]
+    limits += [len(arguments[name]) for name in LIST_ARGS
+               if isinstance(arguments.get(name), list)]
+    if limits:
+        return max(min(limits), 0)
+    if not top_level:
+        return LIST_ROWS
+    if any(value is not None for name, value in arguments.items()
+           if name not in PAGINATION_ARGS):
+        return FILTERED_ROWS
+    return UNBOUNDED_ROWS
+
+
+def iter_selections(schema, parent_type, selection_set, fragments):
+    """Yield (field, type of the object it is selected on), expanding
+    fragments.
+    """
+    if selection_set is None:
+        return
+    for selection in selection_set.selections:
+        if isinstance(selection, graphql.language.ast.Field):
+            yield selection, parent_type
+            continue
+        if isinstance(selection, graphql.language.ast.FragmentSpread):
+            fragment = fragments.get(selection.name.value)
+            if fragment is None:
+                continue
+        else:
+            fragment = selection
+        fragment_type = parent_type
+        if fragment.type_condition is not None:
+            fragment_type = schema.get_type(
+                fragment.type_condition.name.value) or parent_type
+        yield from iter_selections(schema, fragment_type,
+                                   fragment.selection_set, fragments)
+
+
+def selection_cost(schema, parent_type, selection_set, fragments, variables,
+                   edges=None, top_level=False):
+    """Cost of resolving `selection_set` on one object of
+    `parent_type`. `edges` is the number of rows of a connection.
+    """
+    cost = 0
+    for field, field_parent in iter_selections(schema, parent_type,
+                                               selection_set, fragments):
+        name = field.name.value
+        definition = getattr(field_parent, 'fields', {}).get(name)
+        if definition is None:
+            # introspection or invalid fields
+            cost += 1
+            continue
+        field_type = unwrap(definition.type)
+        if isinstance(field_type, GraphQLList):
+            rows = edges if name == 'edges' and edges is not None \
+                else LIST_ROWS
+            item_type = unwrap(field_type.of_type)
+            cost += rows * (1 + selection_cost(
+                schema, item_type, field.selection_set, fragments,
+                variables))
+        elif isinstance(field_type, GraphQLObjectType):
+            rows = None
+            if is_connection(field_type):
+                rows = connection_rows(field, variables, top_level)
+            cost += 1 + selection_cost(
+                schema, field_type, field.selection_set, fragments,
+                variables, edges=rows)
+        else:
+            cost += models.HYBRID_PROP_COSTS.get(name, 1)
+    return cost
+
+
+def estimate_cost(schema, document_ast, variables=None, operation_name=None):
+    """Estimated cost of executing an operation of `document_ast`."""
+    variables = variables or {}
+    fragments = {}
+    operations = []
+    for definition in document_ast.definitions:
+        if isinstance(definition, graphql.language.ast.FragmentDefinition):
+            fragments[definition.name.value] = definition
+        elif isinstance(definition,
+                        graphql.language.ast.OperationDefinition):
+            operations.append(definition)
+    if operation_name:
+        operations = [operation for operation in operations
+                      if operation.name
+                      and operation.name.value == operation_name]
+    if not operations:
+        return 0
+    operation = operations[0]
+    root_type = {
+        'query': schema.get_query_type(),
+        'mutation': schema.get_mutation_type(),
+        'subscription': schema.get_subscription_type(),
+    }.get(operation.operation)
+    return selection_cost(schema, root_type, operation.selection_set,
+                          fragments, variables, top_level=True)
+
+
+def statement_timeout(cost):
+    """Postgres statement_timeout in milliseconds for a query cost."""
+    return int(min(max(cost * STATEMENT_TIMEOUT_PER_COST,
+                       MIN_STATEMENT_TIMEOUT), MAX_STATEMENT_TIMEOUT))
+
+
+@contextlib.contextmanager
+def admission(cost, session=None):
+    """Admit a query of `cost`: reject it if over budget, wait for a
+    slot if it is heavy and limit the run time of its statements.
+    """
+    if cost > QUERY_COST_BUDGET:
+        raise QueryCostExceeded(
+            'Query cost {:.0f} exceeds the budget of {:.0f}. Limit the '
+            'number of rows with first or last, or select fewer nested '
+            'fields.'.format(cost, QUERY_COST_BUDGET))
+    heavy = cost > HEAVY_QUERY_COST
+    if heavy and not HEAVY_QUERIES.acquire(timeout=HEAVY_QUERY_TIMEOUT):
+        raise QueryQueueTimeout(
+            'Too many expensive queries are running, try again later.')
+    try:
+        if session is not None:
+            # only lasts for the transaction of the request
+            session.execute('SET LOCAL statement_timeout = {:d}'.format(
+                statement_timeout(cost)))
+        yield
+    finally:
+        if heavy:
+            HEAVY_QUERIES.release()
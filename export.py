@@ -0,0 +1,448 @@
+"""
+Streaming bulk export of systems and reactions.
+
+Instead of paging through /graphql, complete tables can be
+downloaded from /export/<table> with the same filter arguments
+as the GraphQL fields, e.g.::
+
+    /export/reactions?pubId=SomePub2018&format=ndjson
+    /export/systems?energy=-10&op=lt&format=extxyz
+
+Rows are read through a server-side cursor in chunks of
+EXPORT_CHUNK_SIZE and written to the response as they come,
+so memory use does not grow with the number of exported rows.
+
+Reactions can also be downloaded as a columnar NumPy .npz
+bundle with `format=npz`, optionally restricted to some columns::
+
+    /export/reactions?format=npz&columns=reactionEnergy,facet,sites
+
+Numeric columns are stored as typed arrays, with NaN for missing
+floats and an additional `<column>_mask` array for missing integers.
+String and JSON columns are dictionary encoded as int32 codes
+(-1 for NULL) plus a `<column>_dictionary` array of the distinct
+values, JSON values serialized with sorted keys::
+
+    bundle = np.load('reactions.npz')
+    facets = bundle['facet_dictionary'][bundle['facet']]
+
+Bundles are built in memory, so at most MAX_COLUMNAR_ROWS rows are
+exported per bundle. They are cached per filter set in COLUMNAR_CACHE,
+which is bounded by COLUMNAR_CACHE_BYTES.
+
+DFT input files for many systems are generated in a pool of
+INPUT_FILE_WORKERS processes and returned as zip archive::
+
+    /input_files/?uniqueIds=<id1>,<id2>&formats=vasp,espresso-in
+    /input_files/?pubId=SomePub2018&formats=vasp
+"""
+# global imports
+import concurrent.futures
+import concurrent.futures.process
+import io
+import json
+import multiprocessing
+import os
+import threading
+import zipfile
+
+import ase.io
+import ase.io.formats
+import graphene
+import numpy as np
+import sqlalchemy
+import sqlalchemy.orm
+from sqlalchemy.dialects.postgresql import TSVECTOR
+
+# local imports
+import api
+import cache
+import models
+
+EXPORT_CHUNK_SIZE = int(os.environ.get('EXPORT_CHUNK_SIZE', 1000))
+
+EXPORT_TABLES = {
+    'systems': models.System,
+    'reactions': models.Reaction,
+}
+
+EXPORT_FORMATS = {
+    'systems': ['ndjson', 'extxyz'],
+    'reactions': ['ndjson', 'npz'],
+}
+
+COLUMNAR_FORMATS = ['npz']
+
+MIMETYPES = {
+    'ndjson': 'application/x-ndjson',
+    'extxyz': 'chemical/x-extxyz',
+    'npz': 'application/octet-stream',
+}
+
+# arguments that only make sense for paginated GraphQL queries
+SKIP_ARGS = ['keyset', 'search', 'format', 'columns']
+
+INPUT_FILE_WORKERS = int(os.environ.get('INPUT_FILE_WORKERS',
+                                        os.cpu_count() or 1))
+MAX_INPUT_FILE_SYSTEMS = int(os.environ.get('MAX_INPUT_FILE_SYSTEMS', 1000))
+INPUT_FILE_COLUMNS = ['unique_id', 'mtime', 'numbers', 'positions', 'cell',
+                      'pbc']
+
+_pool = None
+_pool_lock = threading.Lock()
+
+MAX_COLUMNAR_ROWS = int(os.environ.get('MAX_COLUMNAR_ROWS', 200000))
+
+COLUMNAR_CACHE = cache.register('columnar', cache.LRUCache(
+    maxsize=int(os.environ.get('COLUMNAR_CACHE_SIZE', 8)),
+    maxbytes=int(os.environ.get('COLUMNAR_CACHE_BYTES', 256 * 2 ** 20)),
+    ttl=float(os.environ.get('COLUMNAR_CACHE_TTL', 3600))))
+
+
+class TooManyRows(ValueError):
+    """More rows match than can be exported in one columnar bundle."""
+
+
+def parse_filters(model, request_args):
+    """Convert query string arguments to the filter arguments of
+    get_filter_fields, accepting camelCase and snake_case names.
+    """
+    filter_fields = api.get_filter_fields(model)
+    args = {}
+    for name, value in request_args.items():
+        field = api.convert(name)
+        if field in SKIP_ARGS:
+            continue
+        if field not in filter_fields:
+            raise ValueError('Unknown filter {}, should be one of {}'
+                             .format(name, sorted(filter_fields)))
+        field_type = type(filter_fields[field])
+        if field_type is graphene.Int:
+            value = int(value)
+        elif field_type is graphene.Float:
+            value = float(value)
+        elif field_type is graphene.Boolean:
+            value = value.lower() in ['1', 'true', 'yes']
+        args[field] = value
+    return args
+
+
+def export_query(session, model, args):
+    """All rows of `model` matching `args`, streamed in chunks."""
+    query = session.query(model).options(sqlalchemy.orm.undefer('*'))
+    if not models.has_derived_columns(session):
+        query = query.options(*[
+            sqlalchemy.orm.defer(column)
+            for column in models.DERIVED_COLUMNS.get(model, [])])
+    query = api.FilteringConnectionField.filter_query(model, query, args)
+    query = query.order_by(*sqlalchemy.inspect(model).primary_key)
+    return query.yield_per(EXPORT_CHUNK_SIZE)
+
+
+def row_to_dict(row):
+    state = sqlalchemy.inspect(row)
+    return {column.key: getattr(row, column.key)
+            for column in state.mapper.column_attrs
+            if not isinstance(column.columns[0].type, TSVECTOR)
+            and column.key not in state.unloaded}
+
+
+def format_ndjson(row):
+    return json.dumps(row_to_dict(row)) + '\n'
+
+
+def format_extxyz(system):
+    with io.StringIO() as out_file:
+        ase.io.write(out_file, system._toatoms(include_results=True),
+                     format='extxyz')
+        return out_file.getvalue()
+
+
+FORMATTERS = {
+    'ndjson': format_ndjson,
+    'extxyz': format_extxyz,
+}
+
+
+def generate(query, out_format):
+    """Yield the formatted rows of `query`, one chunk at a time."""
+    formatter = FORMATTERS[out_format]
+    chunk = []
+    for row in query:
+        chunk.append(formatter(row))
+        if len(chunk) >= EXPORT_CHUNK_SIZE:
+            yield ''.join(chunk)
+            chunk = []
+    if chunk:
+        yield ''.join(chunk)
+
+
+def get_columns(model, names=None, session=None):
+    """Column attributes of `model` exported in columnar formats.
+    DERIVED_COLUMNS are left out if the schema of `session` does not
+    have them.
+    """
+    skip = [] if models.has_derived_columns(session) \
+        else models.DERIVED_COLUMNS.get(model, [])
+    columns = [column for column in sqlalchemy.inspect(model).column_attrs
+               if not isinstance(column.columns[0].type, TSVECTOR)
+               and column.key not in skip]
+    if not names:
+        return columns
+    by_key = {column.key: column for column in columns}
+    try:
+        return [by_key[api.convert(name.strip())] for name in names]
+    except KeyError as e:
+        raise ValueError('Unknown column {}, should be one of {}'
+                         .format(e.args[0], sorted(by_key)))
+
+
+class DictionaryColumn(object):
+    """Accumulates a dictionary encoded string or JSON column."""
+
+    def __init__(self, is_json=False):
+        self.is_json = is_json
+        self.codes = []
+        self.dictionary = {}
+
+    def append(self, value):
+        if value is None:
+            self.codes.append(-1)
+            return
+        if self.is_json:
+            value = json.dumps(value, sort_keys=True)
+        self.codes.append(self.dictionary.setdefault(value,
+                                                     len(self.dictionary)))
+
+    def arrays(self, name):
+        return {
+            name: np.array(self.codes, dtype=np.int32),
+            name + '_dictionary': np.array(list(self.dictionary), dtype=str),
+        }
+
+
+class FloatColumn(object):
+
+    def __init__(self):
+        self.values = []
+
+    def append(self, value):
+        self.values.append(np.nan if value is None else value)
+
+    def arrays(self, name):
+        return {name: np.array(self.values, dtype=np.float64)}
+
+
+class IntegerColumn(object):
+
+    def __init__(self):
+        self.values = []
+        self.mask = []
+
+    def append(self, value):
+        self.values.append(0 if value is None else value)
+        self.mask.append(value is None)
+
+    def arrays(self, name):
+        arrays = {name: np.array(self.values, dtype=np.int64)}
+        if any(self.mask):
+            arrays[name + '_mask'] = np.array(self.mask, dtype=bool)
+        return arrays
+
+
+def make_accumulator(column):
+    column_type = column.columns[0].type
+    if isinstance(column_type, sqlalchemy.Float):
+        return FloatColumn()
+    if isinstance(column_type, sqlalchemy.Integer):
+        return IntegerColumn()
+    return DictionaryColumn(is_json=not isinstance(column_type,
+                                                   sqlalchemy.String))
+
+
+def export_npz(session, model, args, names=None):
+    """Matching rows of `model` as .npz bundle of column arrays."""
+    columns = get_columns(model, names, session)
+    key = (models.get_cache_key(session), model.__name__,
+           tuple(sorted((field, str(value)) for field, value in args.items())),
+           tuple(column.key for column in columns))
+    bundle = COLUMNAR_CACHE.get(key)
+    if bundle is not None:
+        return bundle
+
+    query = session.query(*[getattr(model, column.key) for column in columns])
+    query = api.FilteringConnectionField.filter_query(model, query, args)
+    # the bundle is built in memory, so refuse to build huge ones
+    count = query.order_by(None).count()
+    if count > MAX_COLUMNAR_ROWS:
+        raise TooManyRows(
+            '{} rows match, at most {} can be exported as columnar bundle. '
+            'Add filters or use format=ndjson.'.format(
+                count, MAX_COLUMNAR_ROWS))
+    query = query.order_by(*sqlalchemy.inspect(model).primary_key) \
+        .yield_per(EXPORT_CHUNK_SIZE)
+
+    accumulators = [make_accumulator(column) for column in columns]
+    for row in query:
+        for accumulator, value in zip(accumulators, row):
+            accumulator.append(value)
+
+    arrays = {}
+    for column, accumulator in zip(columns, accumulators):
+        arrays.update(accumulator.arrays(column.key))
+    with io.BytesIO() as out_file:
+        np.savez(out_file, **arrays)
+        bundle = out_file.getvalue()
+    COLUMNAR_CACHE.set(key, bundle)
+    return bundle
+
+
+def get_pool():
+    """The process pool for input files. Workers are spawned rather
+    than forked, since forking a threaded web worker can copy held
+    locks and open database connections into the children.
+    """
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = concurrent.futures.ProcessPoolExecutor(
+                max_workers=INPUT_FILE_WORKERS,
+                mp_context=multiprocessing.get_context('spawn'))
+        return _pool
+
+
+def reset_pool(pool):
+    """Drop `pool` after a worker died, so the next request starts a
+    new one.
+    """
+    global _pool
+    with _pool_lock:
+        if _pool is pool:
+            _pool = None
+    pool.shutdown(wait=False)
+
+
+def writable_formats():
+    return [key for key, value in ase.io.formats.all_formats.items()
+            if value[1].find('F') > 0]
+
+
+def get_extension(out_format):
+    for extension, extension_format in \
+            ase.io.formats.extension2format.items():
+        if extension_format == out_format:
+            return extension
+    return out_format
+
+
+def render_input_files(columns, formats):
+    """Write the system given by its `columns` in each of `formats`.
+    Runs in the worker processes.
+
+    Returns the file contents, or None if ASE failed to write a
+    format, and the error messages.
+    """
+    try:
+        atoms = models.System(**columns)._toatoms()
+    except Exception as e:
+        return [None] * len(formats), ['{}: {!r}'.format(
+            columns['unique_id'], e)]
+    contents = []
+    errors = []
+    for out_format in formats:
+        mem_file = io.StringIO()
+        mem_file.name = 'Export from http://catappdatabase.herokuapp.com/graphql'
+        try:
+            ase.io.write(mem_file, atoms, out_format)
+        except Exception as e:
+            contents.append(None)
+            errors.append('{}: {} {!r}'.format(columns['unique_id'],
+                                              out_format, e))
+        else:
+            contents.append(mem_file.getvalue())
+    return contents, errors
+
+
+def input_file_systems(session, unique_ids=None, pub_id=None):
+    """Systems by `unique_ids` in the requested order or all systems
+    of publication `pub_id`.
+    """
+    query = session.query(models.System).options(
+        sqlalchemy.orm.load_only(*INPUT_FILE_COLUMNS))
+    if pub_id is not None:
+        return query.join(models.System.publication) \
+            .filter(models.Publication.pub_id == pub_id) \
+            .order_by(models.System.id).all()
+    systems = {system.unique_id: system for system in query.filter(
+        models.System.unique_id.in_(unique_ids))}
+    missing = [unique_id for unique_id in unique_ids
+               if unique_id not in systems]
+    if missing:
+        raise ValueError('Unknown uniqueIds: {}'.format(', '.join(missing)))
+    return [systems[unique_id] for unique_id in unique_ids]
+
+
+class ZipStream(io.RawIOBase):
+    """Unseekable file collecting what zipfile writes to it."""
+
+    def __init__(self):
+        self.buffer = bytearray()
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self.buffer += data
+        return len(data)
+
+    def pop(self):
+        data = bytes(self.buffer)
+        del self.buffer[:]
+        return data
+
+
+def generate_input_files(systems, formats):
+    """Yield a zip archive with `formats`/<unique_id>.<extension> for
+    all `systems`. Files that are not in RENDER_CACHE are written by
+    the process pool. Files that ASE or a worker failed to write are
+    listed in errors.txt, so a single broken system does not truncate
+    the archive.
+    """
+    keys = [[(system.unique_id, system.mtime, 'input:' + out_format)
+             for out_format in formats] for system in systems]
+    cached = [[models.RENDER_CACHE.get(key) for key in system_keys]
+              for system_keys in keys]
+    pool = get_pool()
+    rendered = {i: pool.submit(
+        render_input_files,
+        {column: getattr(systems[i], column)
+         for column in INPUT_FILE_COLUMNS}, formats)
+        for i, contents in enumerate(cached) if None in contents}
+
+    stream = ZipStream()
+    errors = []
+    with zipfile.ZipFile(stream, 'w', zipfile.ZIP_DEFLATED) as archive:
+        for i, system in enumerate(systems):
+            contents = cached[i]
+            if i in rendered:
+                try:
+                    contents, system_errors = rendered.pop(i).result()
+                except Exception as e:
+                    if isinstance(e, concurrent.futures.process.
+                                  BrokenProcessPool):
+                        reset_pool(pool)
+                    contents = [None] * len(formats)
+                    system_errors = ['{}: {!r}'.format(system.unique_id, e)]
+                errors += system_errors
+                for key, content in zip(keys[i], contents):
+                    if content is not None:
+                        models.RENDER_CACHE.set(key, content)
+            for out_format, content in zip(formats, contents):
+                if content is not None:
+                    archive.writestr('{}/{}.{}'.format(
+                        out_format, system.unique_id,
+                        get_extension(out_format)), content)
+            yield stream.pop()
+        if errors:
+            archive.writestr('errors.txt', '\n'.join(errors) + '\n')
+    yield stream.pop()
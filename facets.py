@@ -0,0 +1,140 @@
+"""
+Distinct values of reaction and system attributes for autocomplete
+dropdowns, e.g.::
+
+    {distinctValues(source: "reactions", attribute: "facet") {
+      value
+      count
+    }}
+
+For JSONB columns like reactants or keyValuePairs the distinct keys
+are listed. Values are read from the materialized view public.facets
+(migrations/0004_facets.sql) instead of scanning the tables, and
+kept in FACET_CACHE.
+
+Only the owner of the view can refresh it. Data is loaded by the
+cathub client, not through the web app, so the view has to be
+refreshed as its owner with tools/refresh_facets.py, e.g. from cron
+or after each load. The upload app calls schedule_refresh() after it
+deleted a publication. That refresh only runs if the app's database
+role owns the view, and a warning is logged otherwise. REFRESH ...
+CONCURRENTLY only writes the rows that changed and does not block
+readers.
+"""
+# global imports
+import collections
+import logging
+import os
+import threading
+
+import sqlalchemy
+
+# local imports
+import cache
+import models
+
+log = logging.getLogger(__name__)
+
+# attributes in public.facets, by GraphQL field
+FACETS = collections.OrderedDict([
+    ('reactions', ['chemical_composition', 'surface_composition', 'facet',
+                   'dft_code', 'dft_functional', 'reactants', 'products',
+                   'sites']),
+    ('systems', ['adsorbate', 'substrate', 'facet', 'dft_code',
+                 'dft_functional', 'key_value_pairs']),
+])
+
+FACETS_VIEW = sqlalchemy.Table(
+    'facets', sqlalchemy.MetaData(),
+    sqlalchemy.Column('source', sqlalchemy.String),
+    sqlalchemy.Column('attribute', sqlalchemy.String),
+    sqlalchemy.Column('value', sqlalchemy.String),
+    sqlalchemy.Column('count', sqlalchemy.BigInteger),
+    schema=models.SCHEMA)
+
+FACET_CACHE = cache.register('facets', cache.LRUCache(
+    maxsize=int(os.environ.get('FACET_CACHE_SIZE', 1024)),
+    ttl=float(os.environ.get('FACET_CACHE_TTL', 3600))))
+
+
+def get_values(session, source, attribute, prefix=None, limit=None):
+    """(value, count) pairs of `attribute`, most frequent first.
+    With `prefix` only values starting with it, ignoring case.
+    """
+    if attribute not in FACETS.get(source, []):
+        raise ValueError('Unknown attribute {} of {}. Should be one of {}'
+                         .format(attribute, source, dict(FACETS)))
+    key = (models.get_cache_key(session), source, attribute, prefix, limit)
+    values = FACET_CACHE.get(key)
+    if values is None:
+        view = FACETS_VIEW.c
+        query = session.query(view.value, view.count) \
+            .filter(view.source == source, view.attribute == attribute)
+        if prefix:
+            query = query.filter(view.value.ilike(
+                prefix.replace('\\', '\\\\').replace('%', '\\%')
+                .replace('_', '\\_') + '%'))
+        query = query.order_by(view.count.desc(), view.value)
+        if limit is not None:
+            query = query.limit(limit)
+        values = [tuple(row) for row in query]
+        FACET_CACHE.set(key, values)
+    return values
+
+
+def can_refresh(connectable):
+    """Whether the database role of `connectable` owns public.facets
+    and may refresh it.
+    """
+    return bool(connectable.execute(sqlalchemy.text(
+        "SELECT pg_has_role(current_user, relowner, 'USAGE') "
+        "FROM pg_class WHERE oid = to_regclass(:name)"),
+        name='{}.facets'.format(models.SCHEMA)).scalar())
+
+
+def refresh(connectable):
+    """Refresh public.facets, e.g. after an upload. Requires
+    ownership of the view.
+    """
+    connectable.execute(sqlalchemy.text(
+        'REFRESH MATERIALIZED VIEW CONCURRENTLY {}.facets'
+        .format(models.SCHEMA)).execution_options(autocommit=True))
+    FACET_CACHE.clear()
+
+
+_refresh_lock = threading.Lock()
+_refresh_state = {'running': False, 'pending': False}
+
+
+def _refresh_loop(connectable):
+    while True:
+        with _refresh_lock:
+            if not _refresh_state['pending']:
+                _refresh_state['running'] = False
+                return
+            _refresh_state['pending'] = False
+        try:
+            refresh(connectable)
+        except Exception:
+            log.exception('Refreshing {}.facets failed'.format(models.SCHEMA))
+
+
+def schedule_refresh(connectable):
+    """Refresh public.facets in a background thread. Calls made while
+    a refresh is running are folded into one more refresh. Without
+    ownership of the view nothing is refreshed and a warning is logged.
+    """
+    if not can_refresh(connectable):
+        log.warning('Not refreshing {}.facets, the database role does not '
+                    'own it. Run tools/refresh_facets.py as the owner.'
+                    .format(models.SCHEMA))
+        return None
+    with _refresh_lock:
+        _refresh_state['pending'] = True
+        if _refresh_state['running']:
+            return None
+        _refresh_state['running'] = True
+    thread = threading.Thread(target=_refresh_loop, args=(connectable, ),
+                              name='facets-refresh', daemon=True)
+    thread.start()
+    return thread
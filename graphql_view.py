@@ -0,0 +1,516 @@
+"""
+GraphQL view of the public /graphql endpoint.
+
+Extends flask_graphql.GraphQLView with a response cache. The API
+is read-only and the same queries are sent over and over again
+(e.g. the landing page redirect in app.index), so complete JSON
+responses are kept in an LRU cache keyed on the normalized query
+document, the variables and the operation name.
+
+The cache is cleared through cache.invalidate() whenever data is
+written from within the app (see apps.upload). Entries also expire
+after RESPONSE_CACHE_TTL seconds to pick up data that was loaded
+directly into the database.
+
+Identical queries that miss the cache while one of them is being
+executed, e.g. right after a publication was announced, wait for
+that execution and share its response (X-Cache: SHARED) instead of
+running the same SQL again. This works across the threads of a
+gunicorn worker; every worker process executes a query at most once.
+
+Persisted queries
+-----------------
+
+Instead of the full query string clients can send the SHA-256 hash
+of a query that was registered before, either as `id` or in the
+format of Apollo's automatic persisted queries::
+
+    /graphql?extensions={"persistedQuery":{"version":1,"sha256Hash":"<hash>"}}
+
+A query is registered by sending the hash together with the query
+once. Registered queries are parsed and validated only once. Unknown
+hashes are answered with status 200 and the PersistedQueryNotFound
+error, upon which Apollo clients send the query again with its hash.
+
+HTTP caching
+------------
+
+Responses carry a Last-Modified header derived from the latest
+`systems.mtime` and `publication.stime` and a matching ETag, so
+that repeated GET requests are answered with 304 Not Modified.
+
+Batched operations
+------------------
+
+A JSON array of `{query, variables, operationName}` objects is
+executed in one request::
+
+    [{"query": "{reactions(first: 5) {...}}"},
+     {"query": "query OH($pubId: String) {...}",
+      "variables": {"pubId": "..."}}]
+
+and answered with the array of results in the same order. All
+operations of a batch share one context, i.e. one database session
+and transaction and the DataLoaders of api.get_loader. Their costs
+add up for the admission control. Batches hold at most
+MAX_BATCH_SIZE operations and are cached like single queries.
+
+Admission control
+-----------------
+
+The cost of each query is estimated before it is executed. Too
+expensive queries are rejected, heavy ones are queued and all run
+with a statement_timeout derived from their cost, see cost.py.
+
+Instrumentation
+---------------
+
+Requests with the X-GraphQL-Debug header, carrying the configured
+GRAPHQL_DEBUG_SECRET or sent to an app in debug mode, skip the caches
+and return their SQL statements, resolver and serialization times in
+the `extensions` field, see instrumentation.py.
+"""
+# global imports
+import datetime
+import functools
+import hashlib
+import json
+import os
+import time
+
+import ase.db.core
+import flask
+import flask_graphql
+import graphql
+import graphql.backend.base
+import graphql.backend.core
+import graphql.execution
+import graphql.language.ast
+import graphql.language.printer
+import sqlalchemy
+import werkzeug.http
+from graphql_server import HttpQueryError, load_json_variables
+
+# local imports
+import cache
+import cost
+import instrumentation
+import models
+
+RESPONSE_CACHE = cache.register('response', cache.LRUCache(
+    maxsize=int(os.environ.get('RESPONSE_CACHE_SIZE', 512)),
+    ttl=float(os.environ.get('RESPONSE_CACHE_TTL', 3600))))
+
+NORMALIZED_QUERIES = cache.LRUCache(maxsize=1024)
+
+PERSISTED_QUERIES = cache.LRUCache(
+    maxsize=int(os.environ.get('PERSISTED_QUERIES_SIZE', 4096)))
+
+# identical requests being executed
+IN_FLIGHT = cache.register('in_flight', cache.SingleFlight(
+    timeout=float(os.environ.get('IN_FLIGHT_TIMEOUT', 60))))
+
+MAX_BATCH_SIZE = int(os.environ.get('GRAPHQL_MAX_BATCH_SIZE', 20))
+
+# Latest modification time of the data per database and schema,
+# looked up at most once per LAST_MODIFIED_TTL seconds.
+LAST_MODIFIED = cache.register('last_modified', cache.LRUCache(
+    maxsize=16,
+    ttl=float(os.environ.get('LAST_MODIFIED_TTL', 60))))
+
+
+def normalize_query(query):
+    """Return the query document printed in canonical form, so that
+    queries differing only in whitespace, commas or comments share
+    one cache entry. Unparsable queries are returned unchanged.
+    """
+    normalized = NORMALIZED_QUERIES.get(query)
+    if normalized is None:
+        try:
+            normalized = graphql.language.printer.print_ast(
+                graphql.parse(query))
+        except graphql.GraphQLError:
+            normalized = query
+        NORMALIZED_QUERIES.set(query, normalized)
+    return normalized
+
+
+def hash_query(query):
+    return hashlib.sha256(query.encode('utf8')).hexdigest()
+
+
+class DocumentCacheBackend(graphql.backend.core.GraphQLCoreBackend):
+    """Backend that parses and validates every query document only
+    once and keeps the result in an LRU cache.
+    """
+
+    def __init__(self, maxsize=1024, executor=None):
+        super(DocumentCacheBackend, self).__init__(executor=executor)
+        self.documents = cache.LRUCache(maxsize=maxsize)
+
+    def document_from_string(self, schema, document_string):
+        key = (schema, document_string)
+        document = self.documents.get(key)
+        if document is None:
+            document_ast = graphql.parse(document_string)
+            errors = graphql.validate(schema, document_ast)
+            if errors:
+                def execute(*args, **kwargs):
+                    return graphql.execution.ExecutionResult(
+                        errors=errors, invalid=True)
+            else:
+                execute = functools.partial(
+                    graphql.backend.core.execute_and_validate,
+                    schema, document_ast, validate=False,
+                    **self.execute_params)
+            document = graphql.backend.base.GraphQLDocument(
+                schema=schema,
+                document_string=document_string,
+                document_ast=document_ast,
+                execute=execute,
+            )
+            document.errors = errors
+            self.documents.set(key, document)
+        return document
+
+
+def get_last_modified(session):
+    """Latest modification time of systems and publications as
+    datetime in UTC or None for an empty database.
+    """
+    key = models.get_cache_key(session)
+    last_modified = LAST_MODIFIED.get(key)
+    if last_modified is None:
+        mtime = session.query(sqlalchemy.func.max(models.System.mtime)) \
+            .scalar()
+        stime = session.query(
+            sqlalchemy.func.max(models.Publication.stime)).scalar()
+        times = [t for t in (mtime, stime) if t is not None]
+        if not times:
+            return None
+        last_modified = datetime.datetime(2000, 1, 1, 0, 0) \
+            + datetime.timedelta(
+                seconds=int(round(max(times) * ase.db.core.seconds['y'], 0)))
+        LAST_MODIFIED.set(key, last_modified)
+    return last_modified
+
+
+class GraphQLView(flask_graphql.GraphQLView):
+
+    backend = DocumentCacheBackend()
+    batch = True
+
+    def persist_query(self, query):
+        """Parse and validate `query` and register it under its
+        SHA-256 hash.
+        """
+        document = self.get_backend().document_from_string(
+            self.schema, query)
+        if document.errors:
+            raise HttpQueryError(400, document.errors[0].message)
+        query_id = hash_query(query)
+        PERSISTED_QUERIES.set(query_id, query)
+        return query_id
+
+    def resolve_persisted_query(self, data, args):
+        """Return `data` with the query looked up from the persisted
+        query id if one was sent.
+        """
+        if not isinstance(data, dict):
+            return data
+        extensions = data.get('extensions') or args.get('extensions')
+        if isinstance(extensions, str):
+            try:
+                extensions = json.loads(extensions)
+            except ValueError:
+                raise HttpQueryError(400, 'Extensions are invalid JSON.')
+        persisted_query = (extensions or {}).get('persistedQuery') or {}
+        query_id = persisted_query.get('sha256Hash') \
+            or data.get('id') or args.get('id')
+        if not query_id:
+            return data
+
+        query = data.get('query') or args.get('query')
+        if query:
+            if hash_query(query) != query_id:
+                raise HttpQueryError(
+                    400, 'Provided sha256Hash does not match query.')
+            try:
+                self.persist_query(query)
+            except graphql.GraphQLError as e:
+                raise HttpQueryError(400, e.message)
+        else:
+            query = PERSISTED_QUERIES.get(query_id)
+            if query is None:
+                # Apollo clients expect this error with a 200 status
+                # and then retry with the full query
+                raise HttpQueryError(200, 'PersistedQueryNotFound')
+
+        data = {key: data.get(key) for key in data}
+        data['query'] = query
+        return data
+
+    def parse_body(self):
+        """Request body with persisted queries resolved, parsed once
+        per request and kept on flask.g for the cache key, the
+        instrumentation, the cost estimate and the execution.
+        """
+        if 'graphql_body' not in flask.g:
+            try:
+                flask.g.graphql_body = (self.parse_request_body(), None)
+            except HttpQueryError as e:
+                flask.g.graphql_body = (None, e)
+        data, error = flask.g.graphql_body
+        if error is not None:
+            raise error
+        return data
+
+    def parse_request_body(self):
+        data = super(GraphQLView, self).parse_body()
+        if isinstance(data, list):
+            if len(data) > MAX_BATCH_SIZE:
+                raise HttpQueryError(
+                    400, 'Batches are limited to {} operations.'.format(
+                        MAX_BATCH_SIZE))
+            return [self.resolve_persisted_query(entry, {})
+                    for entry in data]
+        return self.resolve_persisted_query(data, flask.request.args)
+
+    @staticmethod
+    def get_operation_key(data, args):
+        """Normalized query, variables and operation name of one
+        operation or None if it cannot be cached.
+        """
+        if not isinstance(data, dict):
+            return None
+        query = data.get('query') or args.get('query')
+        if not query:
+            return None
+        try:
+            variables = load_json_variables(
+                data.get('variables') or args.get('variables'))
+        except HttpQueryError:
+            return None
+        return (
+            normalize_query(query),
+            json.dumps(variables, sort_keys=True),
+            data.get('operationName') or args.get('operationName'),
+        )
+
+    def get_cache_key(self, data):
+        """Cache key of the current request or None if the
+        response should not be cached.
+        """
+        if flask.request.method not in ('GET', 'POST') \
+                or self.should_display_graphiql():
+            return None
+        pretty = bool(self.pretty or flask.request.args.get('pretty'))
+        if isinstance(data, list):
+            # the query string is ignored for batches
+            keys = tuple(self.get_operation_key(entry, {}) for entry in data)
+            if not keys or None in keys:
+                return None
+            return ('batch', keys, pretty)
+        key = self.get_operation_key(data, flask.request.args)
+        if key is None:
+            return None
+        return key + (pretty, )
+
+    @staticmethod
+    def format_error(error):
+        # remember that this response must not be cached
+        flask.g.graphql_errors = True
+        return flask_graphql.GraphQLView.format_error(error)
+
+    def set_validators(self, response, key, last_modified):
+        response.last_modified = last_modified
+        response.set_etag(hashlib.sha1(repr(
+            (last_modified.isoformat(), key)).encode('utf8')).hexdigest(),
+            weak=True)
+        response.cache_control.public = True
+        response.cache_control.no_cache = True
+
+    @staticmethod
+    def is_debug_request():
+        return instrumentation.is_debug_request(flask.request.headers,
+                                                flask.current_app.debug)
+
+    def get_middleware(self):
+        middleware = list(super(GraphQLView, self).get_middleware() or [])
+        if instrumentation.current() is not None:
+            middleware.append(instrumentation.ResolverTimer())
+        return middleware
+
+    def encode(self, data, pretty=False):
+        """Serialize `data`, adding the profile of debug requests to
+        its extensions.
+        """
+        profile = instrumentation.current()
+        if profile is None:
+            return flask_graphql.GraphQLView.encode(data, pretty=pretty)
+        start = time.perf_counter()
+        body = flask_graphql.GraphQLView.encode(data, pretty=pretty)
+        profile.serialization = time.perf_counter() - start
+        if not self.is_debug_request() or not isinstance(data, dict):
+            return body
+        data = dict(data)
+        extensions = dict(data.get('extensions') or {})
+        extensions['profile'] = profile.to_dict()
+        data['extensions'] = extensions
+        return flask_graphql.GraphQLView.encode(data, pretty=pretty)
+
+    def get_operation(self):
+        """Name of the requested operation for the instrumentation,
+        a hash of the normalized query if it is anonymous.
+        """
+        try:
+            data = self.parse_body()
+        except HttpQueryError:
+            return None
+        if not isinstance(data, dict):
+            return 'batch'
+        operation = data.get('operationName') \
+            or flask.request.args.get('operationName')
+        if operation:
+            return operation
+        query = data.get('query') or flask.request.args.get('query')
+        if not query:
+            return None
+        try:
+            operations = [
+                definition for definition in graphql.parse(query).definitions
+                if isinstance(definition,
+                              graphql.language.ast.OperationDefinition)]
+        except graphql.GraphQLError:
+            operations = []
+        if len(operations) == 1 and operations[0].name:
+            return operations[0].name.value
+        return hash_query(normalize_query(query))[:16]
+
+    def get_cost(self):
+        """Estimated cost of the requested operations, 0 if they
+        cannot be parsed (the errors are reported on execution).
+        """
+        try:
+            data = self.parse_body()
+        except HttpQueryError:
+            return 0
+        total = 0
+        for entry in data if isinstance(data, list) else [data]:
+            if not isinstance(entry, dict):
+                continue
+            args = flask.request.args if entry is data else {}
+            query = entry.get('query') or args.get('query')
+            if not query:
+                continue
+            try:
+                document = self.get_backend().document_from_string(
+                    self.schema, query)
+                variables = load_json_variables(
+                    entry.get('variables') or args.get('variables'))
+            except (graphql.GraphQLError, HttpQueryError):
+                continue
+            if document.errors:
+                continue
+            total += cost.estimate_cost(
+                self.schema, document.document_ast, variables,
+                entry.get('operationName') or args.get('operationName'))
+        return total
+
+    def has_query(self):
+        """Whether the request holds a query to execute, which a
+        plain GraphiQL page load does not.
+        """
+        try:
+            data = self.parse_body()
+        except HttpQueryError:
+            return False
+        if isinstance(data, list):
+            return any(isinstance(entry, dict) and entry.get('query')
+                       for entry in data)
+        return bool(data.get('query') or flask.request.args.get('query'))
+
+    def execute_request(self):
+        """Execute the request if admitted by cost.admission."""
+        if not self.has_query():
+            # nothing touches the database, errors and GraphiQL
+            # are rendered without a slot or statement_timeout
+            return super(GraphQLView, self).dispatch_request()
+        query_cost = self.get_cost()
+        profile = instrumentation.current()
+        if profile is not None:
+            profile.cost = query_cost
+        try:
+            with cost.admission(query_cost, self.get_context()['session']):
+                return super(GraphQLView, self).dispatch_request()
+        except cost.QueryCostExceeded as e:
+            error = HttpQueryError(400, str(e))
+        except cost.QueryQueueTimeout as e:
+            error = HttpQueryError(503, str(e), headers={
+                'Retry-After': str(int(cost.HEAVY_QUERY_TIMEOUT))})
+        return flask.Response(
+            self.encode({'errors': [self.format_error(error)]}),
+            status=error.status_code,
+            headers=error.headers,
+            content_type='application/json')
+
+    def execute_shared_request(self, key):
+        """Execute the request once for all concurrent requests with
+        the same cache key and store the response in the cache.
+        """
+        def execute():
+            response = self.execute_request()
+            body = response.get_data()
+            if response.status_code == 200 \
+                    and response.mimetype == 'application/json' \
+                    and not flask.g.get('graphql_errors', False):
+                RESPONSE_CACHE.set(key, body)
+            return body, response.status_code, list(response.headers)
+
+        (body, status, headers), shared = IN_FLIGHT.do(key, execute)
+        response = flask.Response(body, status=status, headers=headers)
+        response.headers['X-Cache'] = 'SHARED' if shared else 'MISS'
+        return response
+
+    def dispatch_request(self):
+        debug = self.is_debug_request()
+        if not (debug or instrumentation.INSTRUMENTATION):
+            return self.dispatch_cached_request()
+        instrumentation.start(self.get_operation())
+        try:
+            if debug:
+                return self.execute_request()
+            return self.dispatch_cached_request()
+        finally:
+            instrumentation.finish()
+
+    def dispatch_cached_request(self):
+        try:
+            key = self.get_cache_key(self.parse_body())
+        except HttpQueryError:
+            key = None
+        if key is None:
+            return self.execute_request()
+
+        last_modified = get_last_modified(self.get_context()['session'])
+        if last_modified is not None \
+                and flask.request.method in ('GET', 'HEAD'):
+            response = flask.Response(status=200)
+            self.set_validators(response, key, last_modified)
+            if not werkzeug.http.is_resource_modified(
+                    flask.request.environ,
+                    etag=response.headers['ETag'],
+                    last_modified=last_modified):
+                response.status_code = 304
+                return response
+
+        body = RESPONSE_CACHE.get(key)
+        if body is not None:
+            response = flask.Response(body, status=200,
+                                      content_type='application/json')
+            response.headers['X-Cache'] = 'HIT'
+        else:
+            response = self.execute_shared_request(key)
+        if last_modified is not None and response.status_code == 200:
+            self.set_validators(response, key, last_modified)
+        return response
@@ -0,0 +1,238 @@
+"""
+Opt-in instrumentation of GraphQL requests.
+
+Requests sent with the header `X-GraphQL-Debug: <secret>`, where
+the secret is set in GRAPHQL_DEBUG_SECRET, record
+
+- every SQL statement with its duration and the number of rows
+- the time spent in the resolvers, summed up per field path
+- the time needed to serialize the response
+
+and return them in the `extensions` field of the response::
+
+    {"data": {...},
+     "extensions": {"profile": {"cost": 1210,
+                                "duration": 12.3, "serialization": 0.4,
+                                "statements": [{"sql": "SELECT ...",
+                                                "time": 1.2,
+                                                "rows": 10}, ...],
+                                "resolvers": {"reactions": {...}, ...}}}}
+
+Times are in milliseconds. Debug requests bypass the response
+cache and show the SQL, so without a secret the header is only
+honored when the app runs in debug mode. With
+GRAPHQL_INSTRUMENTATION=1 all requests are recorded, without
+changing the responses.
+
+Recorded requests are summed up per operation (the operationName or
+a hash of the query) in histograms of the request duration and the
+number of statements, served as JSON from /instrumentation/.
+"""
+# global imports
+import bisect
+import collections
+import hmac
+import os
+import threading
+import time
+
+import sqlalchemy
+import sqlalchemy.engine
+
+DEBUG_HEADER = os.environ.get('GRAPHQL_DEBUG_HEADER', 'X-GraphQL-Debug')
+DEBUG_SECRET = os.environ.get('GRAPHQL_DEBUG_SECRET', '')
+INSTRUMENTATION = bool(os.environ.get('GRAPHQL_INSTRUMENTATION'))
+
+# upper bucket edges, the last bucket counts larger values
+DURATION_BUCKETS = [1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000,
+                    10000]
+STATEMENT_BUCKETS = [0, 1, 2, 5, 10, 20, 50, 100, 200, 500]
+
+# stats by operation, operations beyond the first MAX_OPERATIONS
+# are counted as "other"
+MAX_OPERATIONS = int(os.environ.get('INSTRUMENTED_OPERATIONS', 256))
+OPERATIONS = collections.OrderedDict()
+OPERATIONS_LOCK = threading.Lock()
+
+_local = threading.local()
+
+
+def milliseconds(seconds):
+    return round(seconds * 1000, 3)
+
+
+class Profile(object):
+    """SQL statements and resolver times of one request."""
+
+    def __init__(self, operation):
+        self.operation = operation
+        self.start = time.perf_counter()
+        self.duration = None
+        self.serialization = None
+        self.cost = None
+        self.statements = []
+        self.resolvers = collections.OrderedDict()
+
+    def add_statement(self, statement, seconds, rows):
+        self.statements.append({'sql': statement,
+                                'time': milliseconds(seconds),
+                                'rows': rows})
+
+    def add_resolver(self, path, seconds):
+        resolver = self.resolvers.get(path)
+        if resolver is None:
+            resolver = self.resolvers[path] = {'calls': 0, 'time': 0.0}
+        resolver['calls'] += 1
+        resolver['time'] += seconds
+
+    def to_dict(self):
+        duration = self.duration
+        if duration is None:
+            duration = time.perf_counter() - self.start
+        return {
+            'operation': self.operation,
+            'cost': self.cost,
+            'duration': milliseconds(duration),
+            'serialization': None if self.serialization is None
+            else milliseconds(self.serialization),
+            'statements': self.statements,
+            'rows': sum(max(statement['rows'], 0)
+                        for statement in self.statements),
+            'resolvers': collections.OrderedDict(
+                (path, {'calls': resolver['calls'],
+                        'time': milliseconds(resolver['time'])})
+                for path, resolver in self.resolvers.items()),
+        }
+
+
+class Histogram(object):
+
+    def __init__(self, edges):
+        self.edges = edges
+        self.counts = [0] * (len(edges) + 1)
+
+    def add(self, value):
+        self.counts[bisect.bisect_left(self.edges, value)] += 1
+
+    def to_dict(self):
+        return {'edges': self.edges, 'counts': list(self.counts)}
+
+
+class OperationStats(object):
+    """Histograms of all recorded requests of one operation."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.statements = 0
+        self.rows = 0
+        self.duration = 0.
+        self.durations = Histogram(DURATION_BUCKETS)
+        self.statement_counts = Histogram(STATEMENT_BUCKETS)
+
+    def add(self, profile):
+        profile = profile.to_dict()
+        with self.lock:
+            self.requests += 1
+            self.statements += len(profile['statements'])
+            self.rows += profile['rows']
+            self.duration += profile['duration']
+            self.durations.add(profile['duration'])
+            self.statement_counts.add(len(profile['statements']))
+
+    def to_dict(self):
+        with self.lock:
+            return {
+                'requests': self.requests,
+                'mean_duration': round(self.duration / self.requests, 3)
+                if self.requests else None,
+                'statements': self.statements,
+                'rows': self.rows,
+                'duration_histogram': self.durations.to_dict(),
+                'statements_histogram': self.statement_counts.to_dict(),
+            }
+
+
+def is_debug_request(headers, app_debug=False):
+    """Whether the request `headers` ask for the profile and are
+    allowed to, i.e. carry DEBUG_SECRET or the app is in debug mode.
+    """
+    value = headers.get(DEBUG_HEADER)
+    if not value:
+        return False
+    if DEBUG_SECRET:
+        return hmac.compare_digest(value.encode('utf8'),
+                                   DEBUG_SECRET.encode('utf8'))
+    return app_debug
+
+
+def current():
+    """Profile of the request handled by this thread, if recorded."""
+    return getattr(_local, 'profile', None)
+
+
+def start(operation):
+    _local.profile = Profile(operation)
+    return _local.profile
+
+
+def finish():
+    """Stop recording and add the profile to the operation stats."""
+    profile = current()
+    if profile is None:
+        return None
+    _local.profile = None
+    profile.duration = time.perf_counter() - profile.start
+    with OPERATIONS_LOCK:
+        operation = profile.operation
+        if operation not in OPERATIONS and len(OPERATIONS) >= MAX_OPERATIONS:
+            operation = 'other'
+        stats = OPERATIONS.get(operation)
+        if stats is None:
+            stats = OPERATIONS[operation] = OperationStats()
+    stats.add(profile)
+    return profile
+
+
+def stats():
+    with OPERATIONS_LOCK:
+        operations = list(OPERATIONS.items())
+    return collections.OrderedDict(
+        (operation, operation_stats.to_dict())
+        for operation, operation_stats in operations)
+
+
+@sqlalchemy.event.listens_for(sqlalchemy.engine.Engine,
+                              'before_cursor_execute')
+def _before_cursor_execute(connection, cursor, statement, parameters,
+                           context, executemany):
+    if current() is not None:
+        connection.info['instrumentation_start'] = time.perf_counter()
+
+
+@sqlalchemy.event.listens_for(sqlalchemy.engine.Engine,
+                              'after_cursor_execute')
+def _after_cursor_execute(connection, cursor, statement, parameters,
+                          context, executemany):
+    profile = current()
+    start = connection.info.pop('instrumentation_start', None)
+    if profile is not None and start is not None:
+        profile.add_statement(statement, time.perf_counter() - start,
+                              cursor.rowcount)
+
+
+class ResolverTimer(object):
+    """Graphene middleware adding the resolver times to the profile."""
+
+    def resolve(self, next, root, info, **args):
+        profile = current()
+        if profile is None:
+            return next(root, info, **args)
+        start = time.perf_counter()
+        try:
+            return next(root, info, **args)
+        finally:
+            profile.add_resolver(
+                '.'.join(str(key) for key in info.path
+                         if not isinstance(key, int)),
+                time.perf_counter() - start)
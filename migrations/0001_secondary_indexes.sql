@@ -0,0 +1,52 @@
+-- Secondary indices of the columns used by filters, ordering and
+-- relationship loading. Names match the indices declared with
+-- index=True in models.py.
+
+CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_public_reaction_pub_id
+    ON public.reaction (pub_id);
+CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_public_reaction_chemical_composition
+    ON public.reaction (chemical_composition);
+CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_public_reaction_surface_composition
+    ON public.reaction (surface_composition);
+CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_public_reaction_facet
+    ON public.reaction (facet);
+CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_public_reaction_reaction_energy
+    ON public.reaction (reaction_energy);
+CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_public_reaction_activation_energy
+    ON public.reaction (activation_energy);
+CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_public_reaction_dft_functional
+    ON public.reaction (dft_functional);
+
+CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_public_reaction_system_ase_id
+    ON public.reaction_system (ase_id);
+CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_public_reaction_system_id
+    ON public.reaction_system (id);
+
+CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_public_publication_system_ase_id
+    ON public.publication_system (ase_id);
+CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_public_publication_system_pub_id
+    ON public.publication_system (pub_id);
+
+CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_public_publication_year
+    ON public.publication (year);
+
+-- named like the index of the UNIQUE constraint that the foreign
+-- keys to systems.unique_id require, so it is not built twice
+CREATE UNIQUE INDEX CONCURRENTLY IF NOT EXISTS systems_unique_id_key
+    ON public.systems (unique_id);
+
+-- ASE's schema has no primary keys on the key-value tables
+CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_public_keys_id
+    ON public.keys (id);
+CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_public_species_id
+    ON public.species (id);
+CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_public_text_key_values_id
+    ON public.text_key_values (id);
+CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_public_number_key_values_id
+    ON public.number_key_values (id);
+
+-- full text search (textsearch and pubtextsearch filters)
+CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_public_reaction_textsearch
+    ON public.reaction USING gin (textsearch);
+CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_public_publication_pubtextsearch
+    ON public.publication USING gin (pubtextsearch);
@@ -0,0 +1,13 @@
+-- GIN indices for the ?, ?| and @> operators emitted by
+-- api.species_filter and api.json_value_filter.
+
+CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_reaction_reactants_gin
+    ON public.reaction USING gin (reactants);
+CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_reaction_products_gin
+    ON public.reaction USING gin (products);
+CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_reaction_sites_gin
+    ON public.reaction USING gin (sites);
+CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_reaction_coverages_gin
+    ON public.reaction USING gin (coverages);
+CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_systems_key_value_pairs_gin
+    ON public.systems USING gin (key_value_pairs);
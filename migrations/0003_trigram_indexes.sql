@@ -0,0 +1,17 @@
+-- requires: pg_trgm
+-- Trigram indices for the ILIKE '%...%' of "~" filters. The
+-- expressions have to match the casts emitted by
+-- FilteringConnectionField.filter_query.
+
+CREATE EXTENSION IF NOT EXISTS pg_trgm;
+
+CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_reaction_reactants_trgm
+    ON public.reaction USING gin ((CAST(reactants AS VARCHAR)) gin_trgm_ops);
+CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_reaction_products_trgm
+    ON public.reaction USING gin ((CAST(products AS VARCHAR)) gin_trgm_ops);
+CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_reaction_chemical_composition_trgm
+    ON public.reaction USING gin (chemical_composition gin_trgm_ops);
+CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_reaction_surface_composition_trgm
+    ON public.reaction USING gin (surface_composition gin_trgm_ops);
+CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_publication_authors_trgm
+    ON public.publication USING gin ((CAST(authors AS VARCHAR)) gin_trgm_ops);
@@ -0,0 +1,53 @@
+-- Distinct values of the reaction and system attributes listed in
+-- facets.FACETS with the number of rows having them. JSONB columns
+-- contribute their keys. Refresh with tools/refresh_facets.py after
+-- uploads, the unique index allows REFRESH ... CONCURRENTLY.
+
+CREATE MATERIALIZED VIEW IF NOT EXISTS public.facets AS
+SELECT source, attribute, value, count(*) AS count
+FROM (
+    SELECT 'reactions' AS source, 'chemical_composition' AS attribute,
+        chemical_composition AS value
+    FROM public.reaction
+    UNION ALL
+    SELECT 'reactions', 'surface_composition', surface_composition
+    FROM public.reaction
+    UNION ALL
+    SELECT 'reactions', 'facet', facet FROM public.reaction
+    UNION ALL
+    SELECT 'reactions', 'dft_code', dft_code FROM public.reaction
+    UNION ALL
+    SELECT 'reactions', 'dft_functional', dft_functional FROM public.reaction
+    UNION ALL
+    SELECT 'reactions', 'reactants', jsonb_object_keys(reactants)
+    FROM public.reaction WHERE jsonb_typeof(reactants) = 'object'
+    UNION ALL
+    SELECT 'reactions', 'products', jsonb_object_keys(products)
+    FROM public.reaction WHERE jsonb_typeof(products) = 'object'
+    UNION ALL
+    SELECT 'reactions', 'sites', jsonb_object_keys(sites)
+    FROM public.reaction WHERE jsonb_typeof(sites) = 'object'
+    UNION ALL
+    SELECT 'systems', 'adsorbate', key_value_pairs ->> 'adsorbate'
+    FROM public.systems
+    UNION ALL
+    SELECT 'systems', 'substrate', key_value_pairs ->> 'substrate'
+    FROM public.systems
+    UNION ALL
+    SELECT 'systems', 'facet', btrim(key_value_pairs ->> 'facet', '()')
+    FROM public.systems
+    UNION ALL
+    SELECT 'systems', 'dft_code', key_value_pairs ->> 'dft_code'
+    FROM public.systems
+    UNION ALL
+    SELECT 'systems', 'dft_functional', key_value_pairs ->> 'dft_functional'
+    FROM public.systems
+    UNION ALL
+    SELECT 'systems', 'key_value_pairs', jsonb_object_keys(key_value_pairs)
+    FROM public.systems WHERE jsonb_typeof(key_value_pairs) = 'object'
+) AS attribute_values
+WHERE value IS NOT NULL AND value <> ''
+GROUP BY source, attribute, value;
+
+CREATE UNIQUE INDEX IF NOT EXISTS ix_facets_source_attribute_value
+    ON public.facets (source, attribute, value);
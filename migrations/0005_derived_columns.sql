@@ -0,0 +1,137 @@
+-- schemas: public, upload
+-- Columns with the values of the hybrid properties in
+-- models.DERIVED_COLUMNS, e.g. System.Formula and Reaction.Equation, so
+-- that they can be filtered and ordered by with an index. Triggers
+-- compute them whenever a row is written, also by the cathub upload
+-- client, and existing rows are filled by the UPDATEs at the end. The
+-- functions have to return the same values as the hybrid properties,
+-- see test_derived_columns.
+
+ALTER TABLE public.systems
+    ADD COLUMN IF NOT EXISTS formula VARCHAR,
+    ADD COLUMN IF NOT EXISTS adsorbate VARCHAR,
+    ADD COLUMN IF NOT EXISTS substrate VARCHAR,
+    ADD COLUMN IF NOT EXISTS facet VARCHAR,
+    ADD COLUMN IF NOT EXISTS dft_functional VARCHAR;
+ALTER TABLE public.reaction
+    ADD COLUMN IF NOT EXISTS equation VARCHAR;
+
+-- ase.utils.formula_metal: metals first, both sorted alphabetically
+CREATE OR REPLACE FUNCTION public.derived_formula(numbers INTEGER[])
+RETURNS VARCHAR AS $$
+    SELECT COALESCE(string_agg(
+        symbol || CASE WHEN n > 1 THEN n::text ELSE '' END, ''
+        ORDER BY non_metal, symbol COLLATE "C"), '')
+    FROM (
+        SELECT symbol, count(*) AS n, symbol = ANY (ARRAY[
+        'H', 'He', 'B', 'C', 'N', 'O', 'F', 'Ne', 'Si', 'P', 'S', 'Cl',
+        'Ar', 'Ge', 'As', 'Se', 'Br', 'Kr', 'Sb', 'Te', 'I', 'Xe', 'Po',
+        'At', 'Rn'
+        ]) AS non_metal
+        FROM (SELECT (ARRAY[
+        'X', 'H', 'He', 'Li', 'Be', 'B', 'C', 'N', 'O', 'F', 'Ne', 'Na',
+        'Mg', 'Al', 'Si', 'P', 'S', 'Cl', 'Ar', 'K', 'Ca', 'Sc', 'Ti',
+        'V', 'Cr', 'Mn', 'Fe', 'Co', 'Ni', 'Cu', 'Zn', 'Ga', 'Ge', 'As',
+        'Se', 'Br', 'Kr', 'Rb', 'Sr', 'Y', 'Zr', 'Nb', 'Mo', 'Tc', 'Ru',
+        'Rh', 'Pd', 'Ag', 'Cd', 'In', 'Sn', 'Sb', 'Te', 'I', 'Xe', 'Cs',
+        'Ba', 'La', 'Ce', 'Pr', 'Nd', 'Pm', 'Sm', 'Eu', 'Gd', 'Tb',
+        'Dy', 'Ho', 'Er', 'Tm', 'Yb', 'Lu', 'Hf', 'Ta', 'W', 'Re', 'Os',
+        'Ir', 'Pt', 'Au', 'Hg', 'Tl', 'Pb', 'Bi', 'Po', 'At', 'Rn',
+        'Fr', 'Ra', 'Ac', 'Th', 'Pa', 'U', 'Np', 'Pu', 'Am', 'Cm', 'Bk',
+        'Cf', 'Es', 'Fm', 'Md', 'No', 'Lr', 'Rf', 'Db', 'Sg', 'Bh',
+        'Hs', 'Mt', 'Ds', 'Rg', 'Cn', 'Nh', 'Fl', 'Mc', 'Lv', 'Ts', 'Og'
+        ])[z + 1] AS symbol
+            FROM unnest(numbers) AS z) AS atoms
+        GROUP BY symbol) AS counts
+$$ LANGUAGE sql IMMUTABLE;
+
+-- models.Reaction._equation. Keys of the same length are sorted like
+-- JSONB stores them.
+CREATE OR REPLACE FUNCTION public.derived_equation(reactants JSONB,
+                                                   products JSONB)
+RETURNS VARCHAR AS $$
+DECLARE
+    equation VARCHAR := '';
+    side JSONB;
+    term RECORD;
+    prefactor NUMERIC;
+    i INTEGER;
+BEGIN
+    FOR side_number IN 1..2 LOOP
+        IF side_number = 2 THEN
+            equation := equation || ' -> ';
+            side := products;
+        ELSE
+            side := reactants;
+        END IF;
+        i := 0;
+        FOR term IN SELECT key, value #>> '{}' AS value
+                FROM jsonb_each(COALESCE(side, '{}'))
+                ORDER BY length(key) DESC, key COLLATE "C" LOOP
+            prefactor := term.value::numeric;
+            IF i > 0 THEN
+                IF prefactor > 0 THEN
+                    equation := equation || ' + ';
+                ELSE
+                    equation := equation || ' - ';
+                    prefactor := -prefactor;
+                END IF;
+            END IF;
+            equation := equation
+                || CASE WHEN prefactor = 1 THEN '' ELSE prefactor::text END
+                || replace(replace(term.key, 'gas', '(g)'), 'star', '*');
+            i := i + 1;
+        END LOOP;
+    END LOOP;
+    RETURN equation;
+END
+$$ LANGUAGE plpgsql IMMUTABLE;
+
+CREATE OR REPLACE FUNCTION public.systems_derived_columns()
+RETURNS TRIGGER AS $$
+BEGIN
+    NEW.formula := public.derived_formula(NEW.numbers);
+    NEW.adsorbate := COALESCE(NEW.key_value_pairs ->> 'adsorbate', '');
+    NEW.substrate := COALESCE(NEW.key_value_pairs ->> 'substrate', '');
+    NEW.facet := btrim(COALESCE(NEW.key_value_pairs ->> 'facet', ''), '()');
+    NEW.dft_functional := COALESCE(NEW.key_value_pairs ->> 'dft_functional',
+                                   '');
+    RETURN NEW;
+END
+$$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE FUNCTION public.reaction_derived_columns()
+RETURNS TRIGGER AS $$
+BEGIN
+    NEW.equation := public.derived_equation(NEW.reactants, NEW.products);
+    RETURN NEW;
+END
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS systems_derived_columns ON public.systems;
+CREATE TRIGGER systems_derived_columns
+    BEFORE INSERT OR UPDATE OF numbers, key_value_pairs ON public.systems
+    FOR EACH ROW EXECUTE PROCEDURE public.systems_derived_columns();
+DROP TRIGGER IF EXISTS reaction_derived_columns ON public.reaction;
+CREATE TRIGGER reaction_derived_columns
+    BEFORE INSERT OR UPDATE OF reactants, products ON public.reaction
+    FOR EACH ROW EXECUTE PROCEDURE public.reaction_derived_columns();
+
+-- fill the rows written before the triggers existed
+UPDATE public.systems SET numbers = numbers
+    WHERE formula IS NULL OR adsorbate IS NULL OR substrate IS NULL
+        OR facet IS NULL OR dft_functional IS NULL;
+UPDATE public.reaction SET reactants = reactants WHERE equation IS NULL;
+
+CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_public_systems_formula
+    ON public.systems (formula);
+CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_public_systems_adsorbate
+    ON public.systems (adsorbate);
+CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_public_systems_substrate
+    ON public.systems (substrate);
+CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_public_systems_facet
+    ON public.systems (facet);
+CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_public_systems_dft_functional
+    ON public.systems (dft_functional);
+CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_public_reaction_equation
+    ON public.reaction (equation);
@@ -1,8 +1,10 @@
 # global imports
+import collections
 import os
 import io
 import datetime
 import sqlalchemy
+import sqlalchemy.orm
 import sqlalchemy.types
 import sqlalchemy.ext.declarative
 from sqlalchemy import or_
@@ -28,6 +30,9 @@ import ase.db.core
 import ase.io
 from ase.utils import formula_metal
 
+# local imports
+import cache
+
 
 class JsonEncodedDict(sqla.TypeDecorator):
     """Enables JSON storage by encoding and decoding on the fly."""
@@ -42,6 +47,120 @@ class JsonEncodedDict(sqla.TypeDecorator):
 
 SCHEMA = 'public'
 
+# pbc bit field -> periodic boundary conditions
+PBC_MASKS = [np.array([bool(i & 1), bool(i & 2), bool(i & 4)])
+             for i in range(8)]
+
+RESULT_PROPERTIES = ('energy', 'forces', 'stress', 'dipole', 'charges',
+                     'magmom', 'magmoms', 'free_energy')
+
+CONSTRAINTS_CACHE = cache.register('constraints', cache.LRUCache(
+    maxsize=int(os.environ.get('CONSTRAINTS_CACHE_SIZE', 4096))),
+    invalidate=False)
+
+
+def float_array(value):
+    """Contiguous float64 array of a Postgres ARRAY column value."""
+    return np.array(value, dtype=np.float64)
+
+
+# Per-atom arrays that are also stored packed in PackedArrays
+# and the shapes they are unpacked to.
+PACKED_ARRAYS = collections.OrderedDict([
+    ('positions', (-1, 3)),
+    ('cell', (3, 3)),
+    ('forces', (-1, 3)),
+    ('magmoms', (-1,)),
+    ('charges', (-1,)),
+])
+
+
+def pack_array(value):
+    """Little-endian float64 bytes of an array or None."""
+    if value is None:
+        return None
+    return np.ascontiguousarray(value, dtype='<f8').tobytes()
+
+
+def unpack_array(buffer, name):
+    """Read-only float64 array viewing the packed `buffer`."""
+    if buffer is None:
+        return None
+    return np.frombuffer(buffer, dtype='<f8').reshape(PACKED_ARRAYS[name])
+
+
+def get_schema(bind):
+    """SCHEMA as mapped by the schema_translate_map of `bind`, e.g.
+    upload for the engine of apps.upload.
+    """
+    translate_map = bind.get_execution_options().get(
+        'schema_translate_map') or {}
+    return translate_map.get(SCHEMA, SCHEMA)
+
+
+def get_cache_key(session):
+    """Database and schema of `session`, to keep entries of caches
+    shared by the public and the upload schema apart.
+    """
+    if session is None:
+        return None
+    bind = session.get_bind()
+    return (repr(bind.engine.url), get_schema(bind))
+
+
+# Optional tables and columns by database, schema and name. Looked up
+# once, until the next cache.invalidate().
+SCHEMA_FEATURES = cache.register('schema_features',
+                                 cache.LRUCache(maxsize=64))
+
+
+def has_feature(session, name, statement):
+    """Whether `statement`, run with the schema of `session` as
+    :schema parameter, returns a true value.
+    """
+    if session is None:
+        return False
+    key = get_cache_key(session) + (name, )
+    exists = SCHEMA_FEATURES.get(key)
+    if exists is None:
+        exists = bool(session.execute(sqlalchemy.text(statement),
+                                      {'schema': key[1]}).scalar())
+        SCHEMA_FEATURES.set(key, exists)
+    return exists
+
+
+def has_packed_arrays(session):
+    """Whether the systems_packed table of tools/pack_arrays.py
+    exists in the database of `session`.
+    """
+    return has_feature(
+        session, 'systems_packed',
+        "SELECT to_regclass(:schema || '.systems_packed') IS NOT NULL")
+
+
+def has_derived_columns(session):
+    """Whether migrations/0005_derived_columns.sql added the
+    DERIVED_COLUMNS to the schema of `session`.
+    """
+    names = ["'{}.{}'".format(model.__tablename__, column)
+             for model, columns in DERIVED_COLUMNS.items()
+             for column in columns]
+    return has_feature(
+        session, 'derived_columns',
+        "SELECT count(*) = {} FROM information_schema.columns "
+        "WHERE table_schema = :schema "
+        "AND table_name || '.' || column_name IN ({})"
+        .format(len(names), ', '.join(names)))
+
+
+# Rendered structure files, keyed on (unique_id, mtime, format).
+# Set RENDER_CACHE_DIR to share them between processes and restarts.
+RENDER_CACHE = cache.register('render', cache.TieredCache(
+    cache.LRUCache(maxsize=int(os.environ.get('RENDER_CACHE_SIZE', 2048))),
+    cache.DiskCache(os.environ['RENDER_CACHE_DIR'])
+    if os.environ.get('RENDER_CACHE_DIR') else None,
+), invalidate=False)
+
 Base = sqlalchemy.ext.declarative.declarative_base()
 
 association_pubsys = \
@@ -51,12 +170,12 @@ association_pubsys = \
                                        sqlalchemy.ForeignKey(
                                            '{}.systems.unique_id'.format(SCHEMA)),
                                        # if PRODUCTION# else 'main.systems.pub_id'),
-                                       primary_key=True),
+                                       primary_key=True, index=True),
                      sqlalchemy.Column('pub_id', String,
                                        sqlalchemy.ForeignKey(
                                            '{}.publication.pub_id'.format(SCHEMA)),
                                        # if PRODUCTION else 'main.publication.pub_id'),
-                                       primary_key=True)
+                                       primary_key=True, index=True)
                      )
 
 
@@ -71,7 +190,7 @@ class Publication(Base):
     volume = sqlalchemy.Column(String, )
     number = sqlalchemy.Column(String, )
     pages = sqlalchemy.Column(String, )
-    year = sqlalchemy.Column(Integer, )
+    year = sqlalchemy.Column(Integer, index=True)
     publisher = sqlalchemy.Column(String, )
     doi = sqlalchemy.Column(String, )
     tags = sqlalchemy.Column(JSONB, )
@@ -105,11 +224,11 @@ class ReactionSystem(Base):
     ase_id = sqlalchemy.Column(String,
                                sqlalchemy.ForeignKey(
                                    '{}.systems.unique_id'.format(SCHEMA)),
-                               primary_key=True)
+                               primary_key=True, index=True)
     id = sqlalchemy.Column(Integer,
                            sqlalchemy.ForeignKey(
                                '{}.reaction.id'.format(SCHEMA)),
-                           primary_key=True)
+                           primary_key=True, index=True)
 
 
 class Log(Base):
@@ -120,7 +239,8 @@ class Log(Base):
                                sqlalchemy.ForeignKey(
                                    '{}.systems.unique_id'.format(SCHEMA)),
                                primary_key=True)
-    logfile = sqlalchemy.Column(String, )
+    logfile = sqlalchemy.orm.deferred(sqlalchemy.Column(String, ),
+                                      group='logfile')
     logtype = sqlalchemy.Column(String, )
 
     @hybrid_property
@@ -129,25 +249,30 @@ class Log(Base):
 
 
 class Reaction(Base):
+    # GIN and trigram indices of the JSONB and text search columns
+    # are only created by the migrations in migrations/
     __tablename__ = 'reaction'
     __table_args__ = ({'schema': SCHEMA})
     id = sqlalchemy.Column(Integer, primary_key=True)
     #rowid = sqlalchemy.sqlalchemy.Column(Integer)
-    chemical_composition = sqlalchemy.Column(String, )
-    surface_composition = sqlalchemy.Column(String, )
-    facet = sqlalchemy.Column(String, )
+    chemical_composition = sqlalchemy.Column(String, index=True)
+    surface_composition = sqlalchemy.Column(String, index=True)
+    facet = sqlalchemy.Column(String, index=True)
     sites = sqlalchemy.Column(JSONB, )
     coverages = sqlalchemy.Column(JSONB, )
     reactants = sqlalchemy.Column(JSONB, )
     products = sqlalchemy.Column(JSONB, )
-    reaction_energy = sqlalchemy.Column(Float, )
-    activation_energy = sqlalchemy.Column(Float, )
+    reaction_energy = sqlalchemy.Column(Float, index=True)
+    activation_energy = sqlalchemy.Column(Float, index=True)
     dft_code = sqlalchemy.Column(String, )
-    dft_functional = sqlalchemy.Column(String, )
+    dft_functional = sqlalchemy.Column(String, index=True)
     username = sqlalchemy.Column(String, )
     pub_id = sqlalchemy.Column(String,  sqlalchemy.ForeignKey(
-        '{}.publication.pub_id'.format(SCHEMA)))
+        '{}.publication.pub_id'.format(SCHEMA)), index=True)
     textsearch = sqlalchemy.Column(TSVECTOR, )
+    # materialized hybrid property, see DERIVED_COLUMNS
+    equation = sqlalchemy.orm.deferred(
+        sqlalchemy.Column(String, index=True), group='derived')
 
     reaction_systems = sqlalchemy.orm.relationship("ReactionSystem",
                                                    # primaryjoin="""ReactionSystem.id==Reaction.id""",
@@ -202,16 +327,19 @@ class Information(Base):
 
 
 class System(Base):
+    # Large columns are deferred. Queries load them by undeferring
+    # their group, see api.ProjectionPlan.
     __tablename__ = 'systems'
     __table_args__ = ({'schema': SCHEMA})
     id = sqlalchemy.Column(Integer, primary_key=True)
     #rowid = sqlalchemy.Column(Integer, )
-    unique_id = sqlalchemy.Column(String, )
+    unique_id = sqlalchemy.Column(String, unique=True)
     ctime = sqlalchemy.Column(Float, )
     mtime = sqlalchemy.Column(Float, )
     username = sqlalchemy.Column(String)
     numbers = sqlalchemy.Column(ARRAY(Integer), )
-    positions = sqlalchemy.Column(ARRAY(Float, dimensions=2))
+    positions = sqlalchemy.orm.deferred(
+        sqlalchemy.Column(ARRAY(Float, dimensions=2)), group='structure')
     cell = sqlalchemy.Column(ARRAY(Float, dimensions=2))
     pbc = sqlalchemy.Column(Integer,)
     initial_magmoms = sqlalchemy.Column(ARRAY(Float),)
@@ -224,20 +352,33 @@ class System(Base):
     calculator_parameters = sqlalchemy.Column(String, )
     energy = sqlalchemy.Column(Float, )
     free_energy = sqlalchemy.Column(Float, )
-    forces = sqlalchemy.Column(ARRAY(Float, dimensions=2))
+    forces = sqlalchemy.orm.deferred(
+        sqlalchemy.Column(ARRAY(Float, dimensions=2)), group='results')
     stress = sqlalchemy.Column(ARRAY(Float))
     dipole = sqlalchemy.Column(ARRAY(Float))
     magmoms = sqlalchemy.Column(ARRAY(Float))
     magmom = sqlalchemy.Column(Float, )
     charges = sqlalchemy.Column(ARRAY(Float))
-    key_value_pairs = sqlalchemy.Column(JSONB, )
-    data = sqlalchemy.Column(JSONB,)
+    key_value_pairs = sqlalchemy.orm.deferred(sqlalchemy.Column(JSONB, ),
+                                              group='key_value_pairs')
+    data = sqlalchemy.orm.deferred(sqlalchemy.Column(JSONB,), group='data')
     natoms = sqlalchemy.Column(Integer,)
     fmax = sqlalchemy.Column(Float, )
     smax = sqlalchemy.Column(Float, )
     volume = sqlalchemy.Column(Float, )
     mass = sqlalchemy.Column(Float, )
     charge = sqlalchemy.Column(Float, )
+    # materialized hybrid properties, see DERIVED_COLUMNS
+    formula = sqlalchemy.orm.deferred(
+        sqlalchemy.Column(String, index=True), group='derived')
+    adsorbate = sqlalchemy.orm.deferred(
+        sqlalchemy.Column(String, index=True), group='derived')
+    substrate = sqlalchemy.orm.deferred(
+        sqlalchemy.Column(String, index=True), group='derived')
+    facet = sqlalchemy.orm.deferred(
+        sqlalchemy.Column(String, index=True), group='derived')
+    dft_functional = sqlalchemy.orm.deferred(
+        sqlalchemy.Column(String, index=True), group='derived')
 
     keys = sqlalchemy.orm.relationship("Key", backref="systems", uselist=True)
 
@@ -265,35 +406,102 @@ class System(Base):
                                               uselist=True
                                               )
 
+    # optional, filled by tools/pack_arrays.py. Only loaded if
+    # has_packed_arrays, the table does not exist before the migration.
+    packed = sqlalchemy.orm.relationship("PackedArrays", uselist=False,
+                                         passive_deletes=True)
+
     ###################################
     # GENERAL ATOMS FORMATS
     ###################################
 
+    def _get_constraints(self):
+        """Constraint objects built from `constraints`. The decoded
+        dicts are memoized per unique_id and each call builds new
+        objects, since Atoms.set_constraint does not copy them.
+        """
+        if not self.constraints:
+            return None
+        entry = CONSTRAINTS_CACHE.get(self.unique_id)
+        if entry is not None and entry[0] == self.constraints:
+            dicts = entry[1]
+        else:
+            dicts = json.loads(self.constraints)
+            if len(dicts[0]['kwargs']['indices']) == 0:
+                dicts = None
+            CONSTRAINTS_CACHE.set(self.unique_id, (self.constraints, dicts))
+        if dicts is None:
+            return None
+        return [dict2constraint(d) for d in dicts]
+
+    def _get_packed_row(self, load):
+        """PackedArrays row if it is up to date and already loaded
+        (or `load` is set and the table exists), otherwise None.
+        """
+        if 'packed' in sqlalchemy.inspect(self).dict or (
+                load and has_packed_arrays(
+                    sqlalchemy.orm.object_session(self))):
+            packed = self.packed
+            if packed is not None and packed.mtime == self.mtime:
+                return packed
+        return None
+
+    def _get_array(self, name, load=False):
+        """Float64 array of one of PACKED_ARRAYS or None, decoded
+        from the packed row without copying if possible and built from
+        the ARRAY column otherwise.
+        """
+        packed = self._get_packed_row(load)
+        if packed is not None:
+            return unpack_array(getattr(packed, name), name)
+        value = getattr(self, name)
+        return None if value is None else float_array(value)
+
+    def _get_packed(self, name, load=True):
+        """One of PACKED_ARRAYS as little-endian float64 bytes or None."""
+        packed = self._get_packed_row(load)
+        if packed is not None:
+            buffer = getattr(packed, name)
+            return None if buffer is None else bytes(buffer)
+        return pack_array(getattr(self, name))
+
     def _toatoms(self, include_results=False):
+        atoms = ase.atoms.Atoms(
+            numbers=np.array(self.numbers, dtype=np.int64),
+            positions=self._get_array('positions'),
+            cell=self._get_array('cell'),
+            pbc=PBC_MASKS[self.pbc & 7],
+        )
         if not include_results:
-            return ase.atoms.Atoms(
-                self.numbers,
-                self.positions,
-                cell=self.cell,
-                pbc=(self.pbc & np.array([1, 2, 4])).astype(bool),
-            )
-        if self.constraints:
-            constraints = json.loads(self.constraints)
-            if len(constraints[0]['kwargs']['indices']) > 0:
-                constraints = [dict2constraint(d) for d in constraints]
-        else:
-            constraints = None
-        atoms = ase.atoms.Atoms(self.numbers,
-                                self.positions,
-                                cell=self.cell,
-                                pbc=(self.pbc & np.array(
-                                    [1, 2, 4])).astype(bool),
-                                magmoms=self.initial_magmoms,
-                                charges=self.initial_charges,
-                                tags=self.tags,
-                                masses=self.masses,
-                                momenta=self.momenta,
-                                constraint=constraints)
+            return atoms
+
+        for name, value in (('initial_magmoms', self.initial_magmoms),
+                            ('initial_charges', self.initial_charges),
+                            ('masses', self.masses),
+                            ('momenta', self.momenta)):
+            if value is not None:
+                atoms.new_array(name, float_array(value))
+        if self.tags is not None:
+            atoms.new_array('tags', np.array(self.tags, dtype=np.int64))
+
+        results = {}
+        for prop in RESULT_PROPERTIES:
+            if prop in PACKED_ARRAYS:
+                result = self._get_array(prop)
+            else:
+                result = getattr(self, prop, None)
+            if result is not None:
+                results[prop] = float_array(result) \
+                    if isinstance(result, list) else result
+        # attach the calculator before info and constraints are set,
+        # so that its copy of the atoms stays small
+        if results:
+            atoms.calc = SinglePointCalculator(atoms, **results)
+            atoms.calc.name = getattr(self, 'calculator', 'unknown')
+
+        constraints = self._get_constraints()
+        if constraints:
+            atoms.set_constraint(constraints)
 
         atoms.info = {}
         atoms.info['unique_id'] = self.unique_id
@@ -302,34 +510,39 @@ class System(Base):
         data = self.data
         if data:
             atoms.info['data'] = data
-
-        all_properties = ['energy', 'forces', 'stress', 'dipole',
-                          'charges', 'magmom', 'magmoms', 'free_energy']
-        results = {}
-        for prop in all_properties:
-            result = getattr(self, prop, None)
-            if result is not None:
-                results[prop] = result
-        if results:
-            atoms.calc = SinglePointCalculator(atoms, **results)
-            atoms.calc.name = getattr(self, 'calculator', 'unknown')
         return atoms
 
     @hybrid_property
     def _formula(self):
         return formula_metal(self.numbers)
 
+    def _render(self, out_format, render):
+        """Return `render()`, cached in RENDER_CACHE. Structures are
+        not modified without updating mtime, so entries never expire.
+        """
+        key = (self.unique_id, self.mtime, out_format)
+        content = RENDER_CACHE.get(key)
+        if content is None:
+            content = render()
+            RENDER_CACHE.set(key, content)
+        return content
+
     @hybrid_property
     def _cifdata(self):
-        mem_file = io.BytesIO()
-        ase.io.write(mem_file, self._toatoms(), 'cif')
-        return str(mem_file.getvalue(), 'utf8')
+        def render():
+            mem_file = io.BytesIO()
+            ase.io.write(mem_file, self._toatoms(), 'cif')
+            return str(mem_file.getvalue(), 'utf8')
+        return self._render('cif', render)
 
     @hybrid_property
     def _trajdata(self):
-        mem_file = io.StringIO()
-        ase.io.write(mem_file, self._toatoms(include_results=True), 'json')
-        return mem_file.getvalue()
+        def render():
+            mem_file = io.StringIO()
+            ase.io.write(mem_file, self._toatoms(include_results=True),
+                         'json')
+            return mem_file.getvalue()
+        return self._render('traj', render)
 
     @hybrid_property
     def _pbc(self):
@@ -384,6 +597,55 @@ class System(Base):
         return self.key_value_pairs.get('dft_functional', '')
 
 
+class PackedArrays(Base):
+    """PACKED_ARRAYS of a system as little-endian float64 buffers,
+    which are decoded without copying by System._get_array. Rows are
+    written by tools/pack_arrays.py and ignored once `mtime` no longer
+    matches the system.
+    """
+    __tablename__ = 'systems_packed'
+    __table_args__ = ({'schema': SCHEMA})
+    id = sqlalchemy.Column(Integer,
+                           sqlalchemy.ForeignKey(
+                               '{}.systems.id'.format(SCHEMA),
+                               ondelete='CASCADE'),
+                           primary_key=True)
+    mtime = sqlalchemy.Column(Float, )
+    positions = sqlalchemy.Column(BYTEA, )
+    cell = sqlalchemy.Column(BYTEA, )
+    forces = sqlalchemy.Column(BYTEA, )
+    magmoms = sqlalchemy.Column(BYTEA, )
+    charges = sqlalchemy.Column(BYTEA, )
+
+
+# Hybrid properties that are also stored in indexed columns, so that
+# they can be filtered and ordered by in SQL. The columns are added by
+# migrations/0005_derived_columns.sql and filled by triggers whenever a
+# row is written. They are deferred in the group 'derived' and only
+# used once has_derived_columns() finds them.
+DERIVED_COLUMNS = collections.OrderedDict([
+    (System, collections.OrderedDict([
+        ('formula', '_formula'),
+        ('adsorbate', '_adsorbate'),
+        ('substrate', '_substrate'),
+        ('facet', '_facet'),
+        ('dft_functional', '_dft_functional'),
+    ])),
+    (Reaction, collections.OrderedDict([
+        ('equation', '_equation'),
+    ])),
+])
+
+
+def get_derived_sources(model, column):
+    """Columns needed to compute the derived `column` of `model`
+    from its hybrid property instead.
+    """
+    hybrid = DERIVED_COLUMNS[model][column]
+    return hybrid_prop_parameters(
+        ''.join(part.capitalize() for part in hybrid.split('_')))
+
+
 class Species(Base):
     __tablename__ = 'species'
     __table_args__ = ({'schema': SCHEMA})
@@ -481,7 +743,7 @@ class Sample(Base):
     pub_id = sqlalchemy.Column(String,
                            sqlalchemy.ForeignKey(
                                'experimental.publication.pub_id'))
-    data = sqlalchemy.Column(JSONB, )
+    data = sqlalchemy.orm.deferred(sqlalchemy.Column(JSONB, ), group='data')
 
 class Xps(Base):
     __tablename__ = 'xps'
@@ -523,16 +785,31 @@ class Echemical(Base):
 
 
 
+# Cost of resolving a hybrid property for one row, relative to a plain
+# column, used by cost.py to estimate the cost of queries.
+HYBRID_PROP_COSTS = {'Formula': 2,
+                     'Equation': 2,
+                     'Cifdata': 100,
+                     'InputFile': 100,
+                     'Trajdata': 200,
+                     'Logtext': 20,
+                     'PackedArray': 5}
+
+
 def hybrid_prop_parameters(key):
     h_parameters = {'Formula': ['id', 'numbers'],
                     'Equation': ['id', 'reactants', 'products'],
-                    'Cifdata': ['id', 'numbers', 'positions', 'cell', 'pbc'],
+                    'Cifdata': ['id', 'unique_id', 'mtime', 'numbers',
+                                'positions', 'cell', 'pbc'],
+                    'InputFile': ['id', 'unique_id', 'mtime', 'numbers',
+                                  'positions', 'cell', 'pbc'],
                     'Ctime': ['id', 'ctime'],
                     'Mtime': ['id', 'mtime'],
                     'Stime': ['id', 'stime'],
                     'Pbc': ['id', 'pbc'],
                     'Trajdata': ['all'],
-                    'Logtext': ['logfile']}
+                    'Logtext': ['logfile'],
+                    'PackedArray': ['id', 'mtime', 'packed']}
 
     if key not in h_parameters:
         return ['id', 'key_value_pairs']
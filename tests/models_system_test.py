@@ -264,3 +264,27 @@ def system_has_volume_test():
     if not hasattr(system, 'volume'):
         raise TypeError('system has no attribute volume')
 
+
+
+def system_toatoms_test():
+    import json
+    import numpy as np
+    import models
+    system = models.System(
+        unique_id='toatoms_test', numbers=[1, 1],
+        positions=[[0., 0., 0.], [0., 0., .74]],
+        cell=[[5., 0., 0.], [0., 5., 0.], [0., 0., 5.]], pbc=3,
+        tags=[0., 1.], energy=-1.5, forces=[[0., 0., .1], [0., 0., -.1]],
+        constraints=json.dumps([{'name': 'FixAtoms',
+                                 'kwargs': {'indices': [0]}}]),
+        key_value_pairs={}, data={})
+    atoms = system._toatoms(include_results=True)
+    if atoms.positions.dtype != np.float64 \
+            or list(atoms.pbc) != [True, True, False]:
+        raise ValueError('wrong positions or pbc: {}'.format(atoms))
+    if atoms.get_potential_energy() != -1.5:
+        raise ValueError('energy not attached to atoms')
+    atoms.constraints[0].index[0] = 1
+    if list(system._toatoms(include_results=True).constraints[0].index) \
+            != [0]:
+        raise ValueError('constraints are shared between atoms')
@@ -1,3 +1,5 @@
+import contextlib
+import datetime
 import os
 import sys
 import unittest
@@ -5,12 +7,23 @@ import tempfile
 import pprint
 import sqlite3
 import json
+import hashlib
+import threading
+import time
 
 import flask
+import graphql
+import sqlalchemy
 
 sys.path.append(os.path.abspath('.'))
 
 import app
+import cache
+import cost
+import facets
+import graphql_view
+import instrumentation
+import typeahead
 
 #def connect_db():
 #    rv = sqlite3.connect(app.app.config['DATABASE'])
@@ -39,9 +52,29 @@ class ReactionBackendTestCase(unittest.TestCase):
         #os.environ['SQLITE_DB'] = app.app.config['DATABASE']
         app.app.testing = True
         self.app = app.app.test_client()
+        instrumentation.DEBUG_SECRET = 'secret'
         #with app.app.app_context():
         #    init_db(app.app)
 
+    @contextlib.contextmanager
+    def rolled_back(self):
+        """Bind the session to a connection whose transaction is rolled
+        back at the end, so that the shared test database is left
+        untouched.
+        """
+        connection = app.db.engine.connect()
+        transaction = connection.begin()
+        app.db.session.remove()
+        app.db.session.configure(bind=connection)
+        try:
+            yield connection
+        finally:
+            app.db.session.remove()
+            transaction.rollback()
+            connection.close()
+            app.db.session.configure(bind=app.db.engine)
+            cache.invalidate()
+
     def get_data(self, query, verbose=False):
         if verbose == True:
             print('\n\nQUERY {query}'.format(**locals()))
@@ -137,6 +170,35 @@ class ReactionBackendTestCase(unittest.TestCase):
         rv_data = self.get_data(query)
         assert rv_data['data']['systems']['totalCount'] == 3347, rv_data
 
+    def test_total_count_modes(self):
+        query = '{systems(first: 0) { totalCount(mode: "%s") edges { node { id } } }}'
+        exact = self.get_data(query % 'exact')['data']['systems']['totalCount']
+        cached = self.get_data(query % 'cached')['data']['systems']['totalCount']
+        estimated = self.get_data(query % 'estimated')['data']['systems']['totalCount']
+        assert exact == cached, (exact, cached)
+        assert isinstance(estimated, int), estimated
+
+    def test_count_key_schema(self):
+        import sqlalchemy.orm
+        import api
+        import models
+        upload_engine = app.db.engine.execution_options(
+            schema_translate_map={'public': 'upload'})
+        public = sqlalchemy.orm.Session(bind=app.db.engine)
+        upload = sqlalchemy.orm.Session(bind=upload_engine)
+        keys = [api.FilteringConnectionField.get_count_key(
+            models.System, {'energy': 1}, session)
+            for session in (public, upload)]
+        assert keys[0] != keys[1], keys
+        assert models.get_cache_key(upload)[1] == 'upload'
+        # the schemas do not share the modification time
+        last_modified = graphql_view.get_last_modified(public)
+        graphql_view.LAST_MODIFIED.set(models.get_cache_key(upload),
+                                       datetime.datetime(1999, 1, 1))
+        assert graphql_view.get_last_modified(upload) \
+            == datetime.datetime(1999, 1, 1)
+        assert graphql_view.get_last_modified(public) == last_modified
+
     def test_resolve_publication_systems(self):
         query ='{publications(year: 2017, last: 1, before: "YXJyYXljb25uZWN0aW9uOjM=") { totalCount edges {node { systems { uniqueId } } } }}'
         rv_data = self.get_data(query)
@@ -158,6 +220,491 @@ class ReactionBackendTestCase(unittest.TestCase):
         rv_data = self.get_data(query)
         assert len(rv_data['data']['reactions']['edges'][0]['node']['systems']) == 3, rv_data
 
+    def test_batched_nested_relationships(self):
+        statements = []
+
+        def count_statement(*args):
+            statements.append(args[2])
+
+        query = '{reactions(first: 10) { edges { node { id systems { uniqueId publication { pubId } } } } }}'
+        # execute the schema directly, so that only the statements of
+        # the resolvers are counted and not those of the HTTP view
+        with app.app.app_context():
+            engine = app.db.engine
+            sqlalchemy.event.listen(engine, 'before_cursor_execute', count_statement)
+            try:
+                result = app.api.schema.execute(
+                    query, context_value={'session': app.db.session})
+            finally:
+                sqlalchemy.event.remove(engine, 'before_cursor_execute', count_statement)
+
+        assert not result.errors, result.errors
+        assert len(result.data['reactions']['edges']) == 10, result.data
+        # at most one statement per nesting level, plus the count
+        assert len(statements) <= 4, statements
+
+    def test_deferred_columns(self):
+        with app.app.app_context():
+            engine = app.db.engine
+        statements = []
+
+        def count_statement(*args):
+            statements.append(args[2])
+
+        query = '{systems(first: 3) { edges { node { uniqueId Formula } } }}'
+        sqlalchemy.event.listen(engine, 'before_cursor_execute', count_statement)
+        try:
+            rv_data = self.get_data(query)
+        finally:
+            sqlalchemy.event.remove(engine, 'before_cursor_execute', count_statement)
+
+        assert len(rv_data['data']['systems']['edges']) == 3, rv_data
+        assert not any('systems.positions' in statement
+                       or 'systems.data' in statement
+                       for statement in statements), statements
+
+    def test_export_ndjson(self):
+        query = '{reactions(reactionEnergy: 0, op: "lt") { totalCount }}'
+        total_count = self.get_data(query)['data']['reactions']['totalCount']
+
+        rv = self.app.get('/export/reactions?reactionEnergy=0&op=lt')
+        assert rv.status_code == 200, rv.data
+        rows = [json.loads(line)
+                for line in rv.data.decode('utf8').splitlines()]
+        assert len(rows) == total_count, (len(rows), total_count)
+        assert all(row['reaction_energy'] < 0 for row in rows)
+
+        rv = self.app.get('/export/reactions?format=extxyz')
+        assert rv.status_code == 400, rv.data
+
+    def test_export_npz(self):
+        import io
+        import numpy as np
+        query = '{reactions(surfaceComposition: "Pt") { totalCount }}'
+        total_count = self.get_data(query)['data']['reactions']['totalCount']
+
+        rv = self.app.get('/export/reactions?format=npz'
+                          '&columns=reactionEnergy,facet'
+                          '&surfaceComposition=Pt')
+        assert rv.status_code == 200, rv.data
+        bundle = np.load(io.BytesIO(rv.data))
+        assert sorted(bundle.files) == [
+            'facet', 'facet_dictionary', 'reaction_energy'], bundle.files
+        assert bundle['reaction_energy'].dtype == np.float64
+        assert len(bundle['facet']) == total_count
+
+        import export
+        max_rows = export.MAX_COLUMNAR_ROWS
+        export.MAX_COLUMNAR_ROWS = total_count - 1
+        try:
+            rv = self.app.get('/export/reactions?format=npz'
+                              '&columns=facet&surfaceComposition=Pt')
+        finally:
+            export.MAX_COLUMNAR_ROWS = max_rows
+        assert rv.status_code == 413, rv.data
+
+    def test_input_files(self):
+        import io
+        import zipfile
+        query = '{systems(first: 2) { edges { node { uniqueId } } }}'
+        unique_ids = [edge['node']['uniqueId'] for edge in
+                      self.get_data(query)['data']['systems']['edges']]
+
+        rv = self.app.post('/input_files/', json={
+            'uniqueIds': unique_ids, 'formats': ['xyz', 'vasp']})
+        assert rv.status_code == 200, rv.data
+        names = zipfile.ZipFile(io.BytesIO(rv.data)).namelist()
+        assert len(names) == 4, names
+        assert 'xyz/{}.xyz'.format(unique_ids[0]) in names, names
+
+        import export
+        import models
+        broken = models.System(unique_id='broken', mtime=0., numbers=[1, 1],
+                               positions=[0., 0., 0.], cell=None, pbc=0)
+        archive = zipfile.ZipFile(io.BytesIO(b''.join(
+            export.generate_input_files([broken], ['xyz']))))
+        assert archive.namelist() == ['errors.txt'], archive.namelist()
+        assert archive.read('errors.txt').startswith(b'broken: ')
+
+    def test_packed_arrays(self):
+        import base64
+        import numpy as np
+        import models
+        from tools import pack_arrays
+        query = '{systems(first: 1) { edges { node { uniqueId natoms PackedArray(array: "positions") } } }}'
+        with self.rolled_back() as connection:
+            connection.execute('DROP TABLE IF EXISTS systems_packed')
+            cache.invalidate()
+            node = self.get_data(query)['data']['systems']['edges'][0]['node']
+            positions = np.frombuffer(base64.b64decode(node['PackedArray']), '<f8')
+            assert positions.shape == (3 * node['natoms'],), positions.shape
+            rv = self.app.get('/packed_arrays/{}/positions'.format(node['uniqueId']))
+            assert rv.status_code == 200, rv.data
+            assert np.frombuffer(rv.data, '<f8').tolist() == positions.tolist()
+
+            pack_arrays.pack_arrays(connection)
+            cache.invalidate()
+            packed = self.get_data(query)['data']['systems']['edges'][0]['node']
+            assert packed == node, (packed, node)
+
+            rv = self.app.get('/packed_arrays/{}/positions'.format(node['uniqueId']))
+            assert rv.status_code == 200, rv.data
+            assert rv.headers['X-Array-Shape'] == '{},3'.format(node['natoms'])
+            assert np.frombuffer(rv.data, '<f8').tolist() == positions.tolist()
+
+            with app.app.app_context():
+                system = app.db.session.query(models.System).filter_by(
+                    unique_id=node['uniqueId']).one()
+                assert system.packed is not None
+                assert np.allclose(system._get_array('positions', load=True),
+                                   system.positions)
+
+    def test_derived_columns(self):
+        query = '{systems(adsorbate: "OH", order: "formula", first: 5) { totalCount edges { node { formula Formula adsorbate Adsorbate } } }}'
+        rv_data = self.get_data(query)
+        nodes = [edge['node'] for edge in rv_data['data']['systems']['edges']]
+        assert rv_data['data']['systems']['totalCount'] > 0, rv_data
+        assert all(node['adsorbate'] == node['Adsorbate'] == 'OH'
+                   for node in nodes), nodes
+        assert all(node['formula'] == node['Formula'] for node in nodes), nodes
+        formulas = [node['formula'] for node in nodes]
+        assert formulas == sorted(formulas), formulas
+
+        query = '{reactions(equation: "~OH*", first: 5) { edges { node { equation Equation } } }}'
+        nodes = [edge['node'] for edge in
+                 self.get_data(query)['data']['reactions']['edges']]
+        assert nodes and all(node['equation'] == node['Equation']
+                             and 'OH*' in node['equation']
+                             for node in nodes), nodes
+
+    def test_derived_columns_triggers(self):
+        import models
+        with self.rolled_back() as connection:
+            # recompute all rows with the triggers
+            connection.execute('UPDATE systems SET numbers = numbers')
+            connection.execute('UPDATE reaction SET reactants = reactants')
+            session = app.db.session
+            for model, columns in models.DERIVED_COLUMNS.items():
+                rows = session.query(model).options(
+                    sqlalchemy.orm.undefer('*')).all()
+                assert rows, model
+                for row in rows:
+                    for column, hybrid in columns.items():
+                        assert getattr(row, column) == getattr(row, hybrid), \
+                            (row.id, column)
+
+    def test_derived_columns_fallback(self):
+        with self.rolled_back() as connection:
+            connection.execute(
+                'ALTER TABLE systems DROP COLUMN formula, '
+                'DROP COLUMN adsorbate, DROP COLUMN substrate, '
+                'DROP COLUMN facet, DROP COLUMN dft_functional')
+            connection.execute('ALTER TABLE reaction DROP COLUMN equation')
+            cache.invalidate()
+            query = '{systems(first: 5) { edges { node { uniqueId formula Formula adsorbate Adsorbate } } }}'
+            nodes = [edge['node'] for edge in
+                     self.get_data(query)['data']['systems']['edges']]
+            assert nodes and all(node['formula'] == node['Formula'] and
+                                 node['adsorbate'] == node['Adsorbate']
+                                 for node in nodes), nodes
+            unique_id = nodes[0]['uniqueId']
+            query = '{reactions(first: 5) { edges { node { equation Equation } } }}'
+            nodes = [edge['node'] for edge in
+                     self.get_data(query)['data']['reactions']['edges']]
+            assert nodes and all(node['equation'] == node['Equation']
+                                 for node in nodes), nodes
+
+            rv_data = self.get_data('{systems(adsorbate: "OH") { totalCount }}')
+            assert '0005_derived_columns' in rv_data['errors'][0]['message']
+            rv = self.app.get('/export/systems?format=ndjson&uniqueId={}'
+                              .format(unique_id))
+            assert rv.status_code == 200, rv.data
+            row = json.loads(rv.data.decode('utf8'))
+            assert row['unique_id'] == unique_id and 'formula' not in row, row
+
+    def test_reaction_aggregates(self):
+        query = '{reactionAggregates(reactants: "CO", groupBy: ["surfaceComposition", "facet"], aggregates: ["count", "min", "max", "avg", "percentile"], percentiles: [0.5], bins: [-10, 0, 10]) { group count min max avg percentiles histogram }}'
+        groups = self.get_data(query)['data']['reactionAggregates']
+        query = '{reactions(first: 0, reactants: "CO") { totalCount }}'
+        total = self.get_data(query)['data']['reactions']['totalCount']
+        assert sum(group['count'] for group in groups) == total, groups
+        keys = [tuple(json.loads(group['group']).values()) for group in groups]
+        assert len(set(keys)) == len(keys), keys
+        for group in groups:
+            assert group['min'] <= group['percentiles'][0] <= group['max']
+            assert group['min'] <= group['avg'] <= group['max']
+            assert sum(group['histogram']) <= group['count'], group
+
+        query = '{reactionAggregates(surfaceComposition: "Pt") { count max }}'
+        group, = self.get_data(query)['data']['reactionAggregates']
+        query = '{reactions(first: 1, surfaceComposition: "Pt", order: "-reactionEnergy") { totalCount edges { node { reactionEnergy } } }}'
+        reactions = self.get_data(query)['data']['reactions']
+        assert group['count'] == reactions['totalCount'], group
+        assert group['max'] == \
+            reactions['edges'][0]['node']['reactionEnergy'], group
+
+    def test_distinct_values(self):
+        engine = sqlalchemy.create_engine(
+            app.app.config['SQLALCHEMY_DATABASE_URI'])
+        assert facets.can_refresh(engine)
+        facets.FACET_CACHE.set('stale', [])
+        facets.schedule_refresh(engine).join()
+        assert 'stale' not in facets.FACET_CACHE
+        query = '{distinctValues(source: "reactions", attribute: "facet") { value count }}'
+        values = self.get_data(query)['data']['distinctValues']
+        assert values, values
+        counts = [value['count'] for value in values]
+        assert counts == sorted(counts, reverse=True), values
+        value = values[0]
+        query = '{{reactions(first: 0, facet: "{}") {{ totalCount }}}}' \
+            .format(value['value'])
+        rv_data = self.get_data(query)
+        assert rv_data['data']['reactions']['totalCount'] == value['count']
+
+        query = '{distinctValues(source: "reactions", attribute: "reactants", prefix: "co") { value count }}'
+        values = self.get_data(query)['data']['distinctValues']
+        assert values and all(value['value'].lower().startswith('co')
+                              for value in values), values
+        query = '{reactions(first: 0, reactants: "COgas") { totalCount }}'
+        rv_data = self.get_data(query)
+        assert {'value': 'COgas', 'count': rv_data['data']['reactions'][
+            'totalCount']} in values, values
+
+    def test_typeahead(self):
+        completions = json.loads(self.app.get(
+            '/typeahead?q=pt&categories=surfaceComposition').data)
+        query = '{reactions(first: 0, surfaceComposition: "Pt") { totalCount }}'
+        total = self.get_data(query)['data']['reactions']['totalCount']
+        assert {'text': 'Pt', 'category': 'surfaceComposition',
+                'count': total} in completions, completions
+        assert all(completion['text'].lower().startswith('pt')
+                   for completion in completions), completions
+
+        completions = json.loads(self.app.get(
+            '/typeahead?q=co&categories=reactants,products&limit=2').data)
+        assert len(completions) == 2, completions
+        counts = [completion['count'] for completion in completions]
+        assert counts == sorted(counts, reverse=True), completions
+
+        # rebuilt only when the data changed
+        builds = typeahead.TYPEAHEAD.builds
+        cache.invalidate()
+        self.app.get('/typeahead?q=pt')
+        typeahead.TYPEAHEAD.thread.join()
+        assert typeahead.TYPEAHEAD.builds == builds
+
+        # a forked worker starts its own check, even if the parent
+        # checked just before the fork
+        parent_thread = typeahead.TYPEAHEAD.thread
+        typeahead.TYPEAHEAD.pid = -1
+        rv = self.app.get('/typeahead?q=pt')
+        assert rv.status_code == 200, rv.data
+        assert typeahead.TYPEAHEAD.pid == os.getpid()
+        assert typeahead.TYPEAHEAD.thread is not parent_thread
+        typeahead.TYPEAHEAD.thread.join()
+
+        rv = self.app.get('/typeahead?q=pt&categories=compositions')
+        assert rv.status_code == 400, rv.data
+
+    def test_typeahead_cold_start(self):
+        index = typeahead.Typeahead()
+        with app.app.app_context():
+            engine = app.db.engine
+        barrier = threading.Barrier(2)
+        results = []
+
+        def complete():
+            barrier.wait()
+            try:
+                results.append(index.complete(engine, 'pt'))
+            except Exception as e:
+                results.append(e)
+
+        threads = [threading.Thread(target=complete) for _ in range(2)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        assert len(results) == 2 and results[0] == results[1], results
+        assert results[0] and index.builds == 1, results
+
+    def test_prefix_index(self):
+        index = typeahead.PrefixIndex([
+            ('titles', 'Oxygen evolution on oxides', 1),
+            ('authors', 'Bajdich, Michal', 3),
+            ('authors', 'Bajdich, M.', 5),
+        ])
+        assert [c.text for c in index.complete('baj')] == \
+            ['Bajdich, M.', 'Bajdich, Michal']
+        assert [c.text for c in index.complete('MICH')] == ['Bajdich, Michal']
+        assert [c.text for c in index.complete('evol')] == \
+            ['Oxygen evolution on oxides']
+        assert index.complete('baj', ['titles']) == []
+        assert index.complete('baj', limit=1)[0].count == 5
+
+    def test_instrumentation(self):
+        query = 'query Instrumented {reactions(first: 2, reactants: "CO") { edges { node { id systems { uniqueId } } } }}'
+        rv = self.app.post('/graphql', json={'query': query},
+                           headers={'X-GraphQL-Debug': 'secret'})
+        data = json.loads(rv.data.decode('utf8'))
+        profile = data['extensions']['profile']
+        assert len(data['data']['reactions']['edges']) == 2, data
+        assert profile['operation'] == 'Instrumented', profile
+        selects = [statement for statement in profile['statements']
+                   if statement['sql'].startswith('SELECT')]
+        assert selects and all(statement['time'] >= 0
+                               for statement in selects), profile
+        assert profile['rows'] >= 2, profile
+        assert profile['serialization'] is not None, profile
+        assert profile['resolvers']['reactions']['calls'] == 1, profile
+        assert profile['resolvers']['reactions.edges.node.id']['calls'] == 2
+
+        rv = self.app.post('/graphql', json={'query': query})
+        assert 'extensions' not in json.loads(rv.data.decode('utf8'))
+
+        # the header is ignored without the secret
+        rv = self.app.post('/graphql', json={'query': query},
+                           headers={'X-GraphQL-Debug': 'guess'})
+        assert 'extensions' not in json.loads(rv.data.decode('utf8'))
+        assert rv.headers['X-Cache'] == 'HIT', rv.headers
+
+        stats = json.loads(self.app.get('/instrumentation/').data)
+        operation = stats['Instrumented']
+        assert operation['requests'] == 1, stats
+        assert sum(operation['duration_histogram']['counts']) == 1, stats
+        assert operation['statements'] == len(profile['statements']), stats
+
+    def test_query_cost(self):
+        query = '{systems { edges { node { Trajdata publication { reactions { systems { Cifdata } } } } } }}'
+        rv = self.app.post('/graphql', json={'query': query})
+        assert rv.status_code == 400, rv.data
+        message = json.loads(rv.data.decode('utf8'))['errors'][0]['message']
+        assert 'exceeds the budget' in message, message
+
+        query = 'query Small($n: Int) {systems(first: $n) { edges { node { Cifdata } } }}'
+        rv = self.app.post('/graphql', json={'query': query,
+                                             'variables': {'n': 2}},
+                           headers={'X-GraphQL-Debug': 'secret'})
+        profile = json.loads(rv.data.decode('utf8'))['extensions']['profile']
+        assert profile['cost'] == cost.estimate_cost(
+            app.api.schema, graphql.parse(query), {'n': 2})
+        assert profile['cost'] < cost.estimate_cost(
+            app.api.schema, graphql.parse(query), {'n': 20})
+        # one row per id
+        assert cost.estimate_cost(app.api.schema, graphql.parse(
+            '{systems(uniqueIds: ["a", "b"]) { edges { node { Cifdata } } }}')) \
+            == profile['cost']
+        timeout = 'SET LOCAL statement_timeout = {:d}'.format(
+            cost.statement_timeout(profile['cost']))
+        assert profile['statements'][0]['sql'] == timeout, profile
+
+    def test_admission_without_query(self):
+        with app.app.app_context():
+            engine = app.db.engine
+            graphql_view.get_last_modified(app.db.session)
+        statements = []
+        parsed = []
+
+        def count_statement(*args):
+            statements.append(args[2])
+
+        parse_request_body = graphql_view.GraphQLView.parse_request_body
+
+        def count_parse(view):
+            parsed.append(flask.request.path)
+            return parse_request_body(view)
+
+        graphql_view.GraphQLView.parse_request_body = count_parse
+        sqlalchemy.event.listen(engine, 'before_cursor_execute', count_statement)
+        try:
+            rv = self.app.get('/graphql', headers={'Accept': 'text/html'})
+            assert rv.status_code == 200, rv.data
+            assert b'graphiql' in rv.data.lower()
+            assert not statements, statements
+            assert len(parsed) == 1, parsed
+
+            parsed.clear()
+            rv = self.app.post('/graphql', json={
+                'query': '{systems(first: 1) { edges { node { uniqueId } } }}'},
+                headers={'X-GraphQL-Debug': 'secret'})
+            assert rv.status_code == 200, rv.data
+            assert len(parsed) == 1, parsed
+        finally:
+            sqlalchemy.event.remove(engine, 'before_cursor_execute', count_statement)
+            graphql_view.GraphQLView.parse_request_body = parse_request_body
+
+    def test_heavy_query_queue(self):
+        heavy = cost.HEAVY_QUERY_COST + 1
+        timeout = cost.HEAVY_QUERY_TIMEOUT
+        cost.HEAVY_QUERY_TIMEOUT = 0.01
+        try:
+            with cost.admission(heavy):
+                # all slots are taken
+                with self.assertRaises(cost.QueryQueueTimeout):
+                    with cost.admission(heavy):
+                        pass
+                with cost.admission(1):
+                    pass
+            with cost.admission(heavy):
+                pass
+        finally:
+            cost.HEAVY_QUERY_TIMEOUT = timeout
+
+    def test_id_lists(self):
+        query = '{systems(first: 3) { edges { node { uniqueId } } }}'
+        unique_ids = [edge['node']['uniqueId'] for edge in
+                      self.get_data(query)['data']['systems']['edges']]
+        unique_ids = unique_ids[::-1] + ['unknown']
+        query = '{systems(uniqueIds: %s) { totalCount edges { node { uniqueId } } }}' \
+            % json.dumps(unique_ids)
+        data = self.get_data(query)['data']['systems']
+        assert [edge['node']['uniqueId'] for edge in data['edges']] \
+            == unique_ids[:-1], data
+        assert data['totalCount'] == 3, data
+
+        query = '{reactions(ids: [4, 2, 3], first: 2) { edges { node { reactionEnergy } } }}'
+        with app.app.app_context():
+            energies = [app.db.session.query(app.models.Reaction.reaction_energy)
+                        .filter_by(id=i).scalar() for i in [4, 2]]
+        data = self.get_data(query)['data']['reactions']
+        assert [edge['node']['reactionEnergy'] for edge in data['edges']] \
+            == energies, data
+
+        query = '{publications(pubIds: []) { edges { node { pubId } } }}'
+        assert self.get_data(query)['data']['publications']['edges'] == []
+
+    def test_structured_filter(self):
+        with app.app.app_context():
+            reactions = app.db.session.query(
+                app.models.Reaction.reaction_energy,
+                app.models.Reaction.activation_energy,
+                app.models.Reaction.facet).all()
+
+        query = '{reactions(filter: {reactionEnergy: {ge: -1, le: 0.5}, activationEnergy: {lt: 1}}) { totalCount edges { node { reactionEnergy activationEnergy } } }}'
+        data = self.get_data(query)['data']['reactions']
+        expected = [r for r in reactions if r[0] is not None and -1 <= r[0] <= 0.5
+                    and r[1] is not None and r[1] < 1]
+        assert expected and data['totalCount'] == len(expected), data
+        assert all(-1 <= edge['node']['reactionEnergy'] <= 0.5
+                   and edge['node']['activationEnergy'] < 1
+                   for edge in data['edges']), data
+
+        query = '{reactions(filter: {or: [{reactionEnergy: {lt: -1}}, {reactionEnergy: {gt: 1}}], not: {facet: {in: ["111", "100"]}}}) { totalCount }}'
+        data = self.get_data(query)['data']['reactions']
+        expected = [r for r in reactions if r[0] is not None
+                    and (r[0] < -1 or r[0] > 1)
+                    and r[2] is not None and r[2] not in ('111', '100')]
+        assert data['totalCount'] == len(expected), data
+
+        query = '{reactions(filter: {activationEnergy: {isNull: true}, or: []}) { totalCount }}'
+        assert self.get_data(query)['data']['reactions']['totalCount'] == 0
+
+        query = '{reactionAggregates(filter: {reactionEnergy: {ge: -1, le: 0.5}}) { count max }}'
+        data = self.get_data(query)['data']['reactionAggregates']
+        assert data[0]['count'] == len([r for r in reactions if r[0] is not None
+                                        and -1 <= r[0] <= 0.5]), data
+        assert data[0]['max'] <= 0.5, data
+
     def test_distinct_filter_on(self):
         query = '{reactions(first: 0, reactants:"~H", distinct: true) { totalCount edges { node { id } } }}'
         rv_data = self.get_data(query)
@@ -208,6 +755,18 @@ class ReactionBackendTestCase(unittest.TestCase):
         rv_data = self.get_data(query)
         assert rv_data['data']['reactions']['totalCount'] == 21, rv_data
 
+    def test_jsonkey_filter(self):
+        query = '{reactions(first: 1, order: "id") { edges { node { sites coverages } } }}'
+        node = self.get_data(query)['data']['reactions']['edges'][0]['node']
+        for field in ['sites', 'coverages']:
+            key, value = sorted(json.loads(node[field]).items())[0]
+            query = '{{reactions(first: 10, {field}: "{value}", jsonkey: "{key}") {{ totalCount edges {{ node {{ {field} }} }} }}}}'.format(**locals())
+            rv_data = self.get_data(query)
+            edges = rv_data['data']['reactions']['edges']
+            assert edges, rv_data
+            assert all(json.loads(edge['node'][field])[key] == value
+                       for edge in edges), rv_data
+
     def test_products_star(self):
         query = '{reactions(first:0, products: "COstar") { totalCount edges { node { id } } }}'
         rv_data = self.get_data(query)
@@ -325,6 +884,162 @@ class ReactionBackendTestCase(unittest.TestCase):
         rv_data = self.get_data('{systems(first: 2, after:"") { totalCount pageInfo { hasNextPage hasPreviousPage startCursor endCursor } edges { node { Formula energy mtime } } }}')
         assert rv_data['data']['systems']['pageInfo']['startCursor'] == 'YXJyYXljb25uZWN0aW9uOjA=', rv_data
 
+    def test_keyset_pagination(self):
+        import graphql_relay
+        import models
+        # reference order with the id as tie-break, like the keyset cursors
+        with app.app.app_context():
+            offset_ids = [graphql_relay.to_global_id('Reaction', row[0])
+                          for row in app.db.session.query(models.Reaction.id)
+                          .order_by(models.Reaction.reaction_energy,
+                                    models.Reaction.id).limit(10)]
+
+        query = '{reactions(first: 5, keyset: true, order: "reactionEnergy"%s) { pageInfo { hasNextPage endCursor } edges { node { id } } }}'
+        first_page = self.get_data(query % '')['data']['reactions']
+        assert first_page['pageInfo']['hasNextPage'], first_page
+        second_page = self.get_data(
+            query % ', after: "{}"'.format(first_page['pageInfo']['endCursor']))['data']['reactions']
+        keyset_ids = [edge['node']['id'] for edge in first_page['edges'] + second_page['edges']]
+        assert keyset_ids == offset_ids, (keyset_ids, offset_ids)
+
+        offset_cursor = self.get_data('{reactions(first: 5) { pageInfo { endCursor } }}')['data']['reactions']['pageInfo']['endCursor']
+        rv_data = self.get_data(query % ', after: "{}"'.format(offset_cursor))
+        assert 'not a keyset cursor' in rv_data['errors'][0]['message'], rv_data
+
+    def test_response_cache(self):
+        graphql_view.RESPONSE_CACHE.clear()
+        query = '{reactions(first: 1) { edges { node { id } } }}'
+        first = self.app.post('/graphql?query={query}'.format(**locals()))
+        assert first.headers['X-Cache'] == 'MISS', first.headers
+        # whitespace does not matter
+        query = '{reactions(first: 1) {edges {node {id}}}}'
+        second = self.app.post('/graphql?query={query}'.format(**locals()))
+        assert second.headers['X-Cache'] == 'HIT', second.headers
+        assert first.data == second.data
+
+        cache.invalidate()
+        third = self.app.post('/graphql?query={query}'.format(**locals()))
+        assert third.headers['X-Cache'] == 'MISS', third.headers
+
+        stats = json.loads(self.app.get('/cache/').data.decode('utf8'))
+        assert stats['response']['hits'] >= 1, stats
+
+    def test_request_coalescing(self):
+        graphql_view.RESPONSE_CACHE.clear()
+        execute_request = graphql_view.GraphQLView.execute_request
+
+        def slow_execute_request(view):
+            time.sleep(0.5)
+            return execute_request(view)
+
+        query = '{reactions(pubId: "MamunHighT2019", first: 2) { edges { node { id } } }}'
+        responses = []
+
+        def post():
+            responses.append(self.app.post('/graphql', json={'query': query}))
+
+        graphql_view.GraphQLView.execute_request = slow_execute_request
+        try:
+            threads = [threading.Thread(target=post) for _ in range(4)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        finally:
+            graphql_view.GraphQLView.execute_request = execute_request
+        assert sorted(rv.headers['X-Cache'] for rv in responses) == \
+            ['MISS', 'SHARED', 'SHARED', 'SHARED'], responses
+        assert len(set(rv.data for rv in responses)) == 1
+        assert all(rv.status_code == 200 for rv in responses)
+        stats = json.loads(self.app.get('/cache/').data.decode('utf8'))
+        assert stats['in_flight']['shared'] >= 3, stats
+
+    def test_persisted_query(self):
+        query = '{reactions(first: 1) { edges { node { id } } }}'
+        query_id = hashlib.sha256(query.encode('utf8')).hexdigest()
+        extensions = json.dumps(
+            {'persistedQuery': {'version': 1, 'sha256Hash': query_id}})
+
+        # Apollo clients only resend the query after this error
+        response = self.app.get('/graphql?id={query_id}'.format(**locals()))
+        assert response.status_code == 200, response.data
+        errors = json.loads(response.data.decode('utf8'))['errors']
+        assert errors[0]['message'] == 'PersistedQueryNotFound', errors
+        assert response.headers.get('X-Cache') is None
+
+        self.app.get('/graphql', query_string={
+            'extensions': extensions, 'query': query})
+        response = self.app.get('/graphql', query_string={
+            'extensions': extensions})
+        assert response.status_code == 200, response.data
+        assert len(json.loads(response.data.decode('utf8'))
+                   ['data']['reactions']['edges']) == 1
+
+        etag = response.headers['ETag']
+        response = self.app.get('/graphql', query_string={
+            'extensions': extensions}, headers={'If-None-Match': etag})
+        assert response.status_code == 304, response.status_code
+
+    def test_batch(self):
+        with app.app.app_context():
+            engine = app.db.engine
+            graphql_view.get_last_modified(app.db.session)
+        graphql_view.RESPONSE_CACHE.clear()
+        statements = []
+
+        def count_statement(*args):
+            statements.append(args[2])
+
+        query = '{reactions(first: 3) { edges { node { id systems { uniqueId } } } }}'
+        batch = [
+            {'query': query},
+            {'query': 'query One($n: Int) {reactions(first: $n) { edges { node { id } } }}',
+             'variables': {'n': 1}},
+            {'query': query},
+        ]
+        sqlalchemy.event.listen(engine, 'before_cursor_execute', count_statement)
+        try:
+            rv = self.app.post('/graphql', json=batch)
+        finally:
+            sqlalchemy.event.remove(engine, 'before_cursor_execute', count_statement)
+        assert rv.status_code == 200, rv.data
+        assert rv.headers['X-Cache'] == 'MISS', rv.headers
+        results = json.loads(rv.data.decode('utf8'))
+        assert [len(result['data']['reactions']['edges'])
+                for result in results] == [3, 1, 3], results
+        assert results[0] == results[2], results
+        # one session and transaction for all operations
+        assert sum(statement.startswith('SET LOCAL')
+                   for statement in statements) == 1, statements
+
+        rv = self.app.post('/graphql', json=batch)
+        assert rv.headers['X-Cache'] == 'HIT', rv.headers
+        assert json.loads(rv.data.decode('utf8')) == results
+
+        rv = self.app.post('/graphql', json=[{'query': query}] * (
+            graphql_view.MAX_BATCH_SIZE + 1))
+        assert rv.status_code == 400, rv.data
+
+    def test_projection_fragments(self):
+        query = '''{reactions(first: 2) { edges { node { ...R } } }}
+            fragment R on Reaction {
+              id
+              energy: reactionEnergy
+              ... on Reaction { systems { uniqueId Formula } }
+            }'''
+        result = self.app.post('/graphql', json={'query': query})
+        data = json.loads(result.data.decode('utf8'))
+        assert 'errors' not in data, data
+        nodes = [edge['node'] for edge in data['data']['reactions']['edges']]
+        assert len(nodes) == 2, nodes
+        assert all('energy' in node and node['systems']
+                   for node in nodes), nodes
+
+        result = self.app.post('/graphql', json={
+            'query': '{reactions(first: 2) { totalCount }}'})
+        data = json.loads(result.data.decode('utf8'))
+        assert data['data']['reactions']['totalCount'] > 0, data
+
     def test_keyvalue_state(self):
         rv_data = self.get_data('{systems(keyValuePairs: "state->gas") { totalCount edges { node { id } } }}')
         assert rv_data['data']['systems']['totalCount'] == 48, rv_data
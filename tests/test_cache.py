@@ -0,0 +1,158 @@
+import os
+import sys
+import tempfile
+import threading
+import time
+import unittest
+
+sys.path.append(os.path.abspath('.'))
+
+import cache
+
+
+class LRUCacheTestCase(unittest.TestCase):
+    def test_get_set(self):
+        lru = cache.LRUCache(maxsize=2)
+        lru.set('a', 1)
+        assert lru.get('a') == 1
+        assert lru.get('b') is None
+        assert lru.stats()['hits'] == 1
+        assert lru.stats()['misses'] == 1
+
+    def test_evicts_least_recently_used(self):
+        lru = cache.LRUCache(maxsize=2)
+        lru.set('a', 1)
+        lru.set('b', 2)
+        lru.get('a')
+        lru.set('c', 3)
+        assert 'a' in lru
+        assert 'b' not in lru
+        assert 'c' in lru
+        assert lru.stats()['evictions'] == 1
+
+    def test_ttl(self):
+        lru = cache.LRUCache(maxsize=2, ttl=0.01)
+        lru.set('a', 1)
+        time.sleep(0.02)
+        assert lru.get('a') is None
+        assert len(lru) == 0
+
+    def test_maxbytes(self):
+        lru = cache.LRUCache(maxsize=10, maxbytes=10)
+        lru.set('a', b'1234')
+        lru.set('b', b'1234')
+        lru.set('c', b'1234')
+        assert 'a' not in lru
+        assert 'b' in lru and 'c' in lru
+        assert lru.stats()['nbytes'] == 8
+        lru.set('d', b'12345678901')
+        assert 'd' not in lru
+        assert lru.pop('b') == b'1234'
+        assert lru.stats()['nbytes'] == 4
+
+
+class TieredCacheTestCase(unittest.TestCase):
+    def test_disk_tier(self):
+        with tempfile.TemporaryDirectory() as directory:
+            tiered = cache.TieredCache(cache.LRUCache(maxsize=1),
+                                       cache.DiskCache(directory))
+            tiered.set(('abc', 18.5, 'cif'), 'data_image0')
+            tiered.set(('def', 18.5, 'cif'), 'data_image1')
+            # evicted from memory, but still on disk
+            assert tiered.get(('abc', 18.5, 'cif')) == 'data_image0'
+            assert tiered.stats()['disk']['hits'] == 1
+
+            other = cache.TieredCache(cache.LRUCache(),
+                                      cache.DiskCache(directory))
+            assert other.get(('def', 18.5, 'cif')) == 'data_image1'
+            other.clear()
+            assert other.get(('def', 18.5, 'cif')) is None
+
+
+class SingleFlightTestCase(unittest.TestCase):
+    def run_concurrently(self, flight, function, n=5):
+        results = []
+        threads = [threading.Thread(
+            target=lambda: results.append(flight.do('key', function)))
+            for _ in range(n)]
+        for thread in threads:
+            thread.start()
+        return threads, results
+
+    def test_shares_execution(self):
+        flight = cache.SingleFlight()
+        release = threading.Event()
+        calls = []
+
+        def function():
+            calls.append(1)
+            release.wait()
+            return 'result'
+
+        threads, results = self.run_concurrently(flight, function)
+        while flight.stats()['shared'] < 4:
+            time.sleep(0.001)
+        release.set()
+        for thread in threads:
+            thread.join()
+        assert len(calls) == 1
+        assert sorted(results) == [('result', False)] + [('result', True)] * 4
+        assert len(flight) == 0
+        # later calls run again
+        assert flight.do('key', lambda: 'new') == ('new', False)
+
+    def test_shares_errors(self):
+        flight = cache.SingleFlight()
+        started = threading.Event()
+        release = threading.Event()
+        errors = []
+
+        def function():
+            started.set()
+            release.wait()
+            raise ValueError('failed')
+
+        def call():
+            try:
+                flight.do('key', function)
+            except ValueError as e:
+                errors.append(e)
+
+        leader = threading.Thread(target=call)
+        leader.start()
+        started.wait()
+        follower = threading.Thread(target=call)
+        follower.start()
+        while flight.stats()['shared'] < 1:
+            time.sleep(0.001)
+        release.set()
+        leader.join()
+        follower.join()
+        assert len(errors) == 2 and errors[0] is errors[1]
+
+    def test_clear_and_timeout(self):
+        flight = cache.SingleFlight(timeout=0.01)
+        started = threading.Event()
+        release = threading.Event()
+
+        def function():
+            started.set()
+            release.wait()
+            return 'old'
+
+        leader = threading.Thread(target=flight.do, args=('key', function))
+        leader.start()
+        started.wait()
+        # waiting callers run the function themselves after the timeout
+        assert flight.do('key', lambda: 'timeout') == ('timeout', False)
+        flight.clear()
+        flight.timeout = None
+        # new calls do not wait for the calls before clear()
+        assert flight.do('key', lambda: 'new') == ('new', False)
+        release.set()
+        leader.join()
+        assert len(flight) == 0
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,256 @@
+"""
+Query plan regression tests.
+
+tests/pg_sample_data.sql is loaded into the scratch database
+PLAN_TEST_DATABASE, converted to the current schema and migrated with
+tools/migrate.py. Then the example queries from the docstring of api
+are run with sequential scans disabled and every SELECT they issue is
+explained. A test fails if a plan still filters a table without an
+index condition, i.e. if no index can serve one of the documented
+queries.
+"""
+import json
+import os
+import re
+import sys
+import unittest
+
+import psycopg2
+import sqlalchemy
+import sqlalchemy.orm
+import sqlalchemy.schema
+
+sys.path.append(os.path.abspath('.'))
+
+import api
+import models
+from tools import migrate
+
+SERVER_URL = os.environ.get('PLAN_TEST_SERVER_URL',
+                            'postgresql://postgres@localhost:5432')
+PLAN_TEST_DATABASE = os.environ.get('PLAN_TEST_DATABASE',
+                                    'catalysis_hub_plan_test')
+SAMPLE_DATA = os.path.join(os.path.dirname(__file__), 'pg_sample_data.sql')
+
+# Copy the sample data, which uses the old catapp table and ASE's
+# binary arrays, into the tables of models.py.
+CONVERT_SAMPLE = [
+    """INSERT INTO public.systems (id, unique_id, ctime, mtime, username,
+        pbc, constraints, calculator, calculator_parameters, energy,
+        free_energy, magmom, key_value_pairs, natoms, fmax, smax, volume,
+        mass, charge)
+    SELECT id, unique_id, ctime, mtime, username, pbc, constraints,
+        calculator, calculator_parameters, energy, free_energy, magmom,
+        key_value_pairs::jsonb, natoms, fmax, smax, volume, mass, charge
+    FROM sample.systems""",
+    """INSERT INTO public.keys (key, id)
+    SELECT DISTINCT key, id FROM sample.keys""",
+    """INSERT INTO public.species (z, n, id)
+    SELECT DISTINCT z, n, id FROM sample.species""",
+    """INSERT INTO public.text_key_values (key, value, id)
+    SELECT DISTINCT ON (id, key) key, value, id
+    FROM sample.text_key_values""",
+    """INSERT INTO public.number_key_values (key, value, id)
+    SELECT DISTINCT ON (id, key) key, value, id
+    FROM sample.number_key_values""",
+    """INSERT INTO public.publication (id, pub_id, title, authors, journal,
+        volume, number, pages, year, publisher, doi, pubtextsearch)
+    SELECT row_number() OVER (ORDER BY p::text), md5(p::text), p->>'title',
+        p->'authors', p->>'journal', p->>'volume', p->>'number',
+        p->>'pages', NULLIF(p->>'year', '')::integer, p->>'publisher',
+        p->>'doi', to_tsvector(concat_ws(' ', p->>'title',
+                                         (p->'authors')::text, p->>'year'))
+    FROM (SELECT DISTINCT publication AS p FROM sample.catapp
+          WHERE publication IS NOT NULL) AS publications""",
+    """INSERT INTO public.reaction (id, chemical_composition,
+        surface_composition, facet, sites, reactants, products,
+        reaction_energy, activation_energy, dft_code, dft_functional,
+        pub_id, textsearch)
+    SELECT id, chemical_composition, surface_composition, facet,
+        CASE WHEN sites LIKE '{%' THEN sites::jsonb END, reactants,
+        products, reaction_energy, activation_energy, dft_code,
+        dft_functional, md5(publication::text),
+        to_tsvector(concat_ws(' ', chemical_composition, facet,
+                              reactants::text, products::text))
+    FROM sample.catapp""",
+    """INSERT INTO public.reaction_system (name, ase_id, id)
+    SELECT DISTINCT ON (ids.value, catapp.id) ids.key, ids.value, catapp.id
+    FROM sample.catapp, jsonb_each_text(catapp.ase_ids) AS ids
+    WHERE ids.value IN (SELECT unique_id FROM public.systems)""",
+    """INSERT INTO public.publication_system (ase_id, pub_id)
+    SELECT DISTINCT reaction_system.ase_id, reaction.pub_id
+    FROM public.reaction_system JOIN public.reaction
+    ON reaction.id = reaction_system.id
+    WHERE reaction.pub_id IS NOT NULL""",
+]
+
+
+def get_examples():
+    """GraphQL queries of the literal blocks in api.__doc__."""
+    examples = []
+    lines = api.__doc__.splitlines()
+    for i, line in enumerate(lines):
+        if not line.rstrip().endswith('::'):
+            continue
+        block = []
+        for line in lines[i + 1:]:
+            if line.strip() and not line.startswith(' '):
+                break
+            if line.strip().startswith('- '):
+                break
+            block.append(line)
+        examples.append('\n'.join(block).strip())
+    return examples
+
+
+def iter_plan(plan):
+    yield plan
+    for child in plan.get('Plans', []):
+        yield from iter_plan(child)
+
+
+def create_database():
+    """Create PLAN_TEST_DATABASE from the sample data and return an
+    engine connected to it.
+    """
+    admin = sqlalchemy.create_engine(SERVER_URL + '/postgres',
+                                     isolation_level='AUTOCOMMIT')
+    admin.execute('DROP DATABASE IF EXISTS {}'.format(PLAN_TEST_DATABASE))
+    admin.execute('CREATE DATABASE {}'.format(PLAN_TEST_DATABASE))
+    admin.dispose()
+
+    engine = sqlalchemy.create_engine(
+        SERVER_URL + '/' + PLAN_TEST_DATABASE)
+    with open(SAMPLE_DATA) as sample_file:
+        sample = sample_file.read()
+    with engine.begin() as connection:
+        connection.execute('CREATE SCHEMA sample')
+        cursor = connection.connection.cursor()
+        cursor.execute('SET search_path TO sample')
+        cursor.execute(sample)
+        cursor.execute('SET search_path TO public')
+        # tables without indices, these are added by the migrations
+        for table in models.Base.metadata.sorted_tables:
+            if table.schema in (None, models.SCHEMA):
+                connection.execute(sqlalchemy.schema.CreateTable(table))
+        for statement in CONVERT_SAMPLE:
+            connection.execute(sqlalchemy.text(statement))
+    migrate.migrate(engine)
+    engine.execute('ANALYZE')
+    return engine
+
+
+class QueryPlanTestCase(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        try:
+            cls.engine = create_database()
+        except (sqlalchemy.exc.OperationalError, psycopg2.Error) as e:
+            raise unittest.SkipTest('No Postgres server: {}'.format(e))
+        cls.trigrams = cls.engine.execute(
+            "SELECT count(*) FROM pg_extension WHERE extname = 'pg_trgm'") \
+            .scalar() > 0
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.engine.dispose()
+
+    def get_statements(self, query):
+        """SELECT statements issued by the GraphQL `query`."""
+        statements = []
+
+        def before_cursor_execute(connection, cursor, statement,
+                                  parameters, context, executemany):
+            if statement.lstrip().upper().startswith('SELECT'):
+                statements.append((statement, parameters))
+
+        connection = self.engine.connect()
+        connection.execute('SET enable_seqscan = off')
+        session = sqlalchemy.orm.Session(bind=connection)
+        sqlalchemy.event.listen(connection, 'before_cursor_execute',
+                                before_cursor_execute)
+        try:
+            api.schema.execute(query, context_value={'session': session})
+        finally:
+            session.close()
+            connection.close()
+        return statements
+
+    def get_unindexed_scans(self, statement, parameters):
+        """Plan nodes filtering or joining rows without an index
+        condition. Sequential scans of complete tables are fine.
+        """
+        with self.engine.connect() as connection:
+            connection.execute('SET enable_seqscan = off')
+            plan = connection.execute(
+                'EXPLAIN (FORMAT JSON) ' + statement, parameters).scalar()
+        if isinstance(plan, str):
+            plan = json.loads(plan)
+        scans = []
+        for node in iter_plan(plan[0]['Plan']):
+            if node['Node Type'] not in ('Seq Scan', 'Index Scan',
+                                         'Index Only Scan'):
+                continue
+            if node['Node Type'] == 'Seq Scan':
+                unindexed = 'Filter' in node or \
+                    node.get('Parent Relationship') == 'Inner'
+            else:
+                unindexed = 'Filter' in node and 'Index Cond' not in node
+            if unindexed:
+                # substring searches need the trigram indices
+                if not self.trigrams and '~~*' in node.get('Filter', ''):
+                    continue
+                scans.append('{} on {}: {}'.format(
+                    node['Node Type'], node['Relation Name'],
+                    node.get('Filter', '')))
+        return scans
+
+    def test_examples(self):
+        examples = get_examples()
+        assert len(examples) >= 10, examples
+        for query in examples:
+            statements = self.get_statements(query)
+            assert statements, query
+            for statement, parameters in statements:
+                scans = self.get_unindexed_scans(statement, parameters)
+                assert not scans, '{}\n{}\n{}'.format(
+                    query, re.sub(r'\s+', ' ', statement), scans)
+
+    def test_filters(self):
+        for query in [
+                '{reactions(first: 10, reactants: "OH") { edges { node { id } } }}',
+                '{reactions(first: 10, surfaceComposition: "Pt") { edges { node { id } } }}',
+                '{reactions(first: 10, facet: "111") { edges { node { id } } }}',
+                '{reactions(first: 10, reactionEnergy: 0, op: "lt") { edges { node { id } } }}',
+                '{reactions(first: 10, pubId: "x", order: "reactionEnergy") { edges { node { id } } }}',
+                '{systems(first: 10, uniqueId: "x") { edges { node { id } } }}',
+                '{systems(uniqueIds: ["x", "y"]) { edges { node { id } } }}',
+                '{reactions(ids: [3, 1, 2]) { edges { node { id } } }}',
+                '{reactions(first: 10, filter: {reactionEnergy: {ge: 0.1, le: 0.11}}) { edges { node { id } } }}',
+                '{reactions(first: 10, filter: {or: [{reactionEnergy: {lt: -2.9}}, {activationEnergy: {gt: 2.9}}]}) { edges { node { id } } }}',
+                '{publications(pubIds: ["x", "y"]) { edges { node { id } } }}',
+        ]:
+            for statement, parameters in self.get_statements(query):
+                scans = self.get_unindexed_scans(statement, parameters)
+                assert not scans, '{}\n{}'.format(query, scans)
+
+    def test_invalid_indexes(self):
+        # what a failed CREATE INDEX CONCURRENTLY leaves behind
+        index = ('public', 'ix_reaction_reactants_gin')
+        self.engine.execute(
+            "UPDATE pg_index SET indisvalid = false "
+            "WHERE indexrelid = 'public.ix_reaction_reactants_gin'::regclass")
+        self.engine.execute(
+            "DELETE FROM {} WHERE version = '0002'"
+            .format(migrate.VERSION_TABLE))
+        with self.engine.connect() as connection:
+            assert migrate.get_invalid_indexes(connection, [index]) == \
+                [index]
+        assert migrate.migrate(self.engine) == ['0002_jsonb_indexes']
+        with self.engine.connect() as connection:
+            assert migrate.get_invalid_indexes(connection, [index]) == []
+
+
+if __name__ == '__main__':
+    unittest.main()
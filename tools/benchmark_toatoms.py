@@ -0,0 +1,105 @@
+#!/usr/bin/env python
+"""
+Micro-benchmark of System._toatoms against the plain ase.atoms.Atoms
+construction it replaced. Run against the test database with::
+
+    python tools/benchmark_toatoms.py [number of systems]
+
+The database URL can be set with DATABASE_URL.
+"""
+import json
+import os
+import sys
+import timeit
+
+import numpy as np
+import sqlalchemy
+import sqlalchemy.orm
+import ase.atoms
+import ase.io
+from ase.constraints import dict2constraint
+from ase.calculators.singlepoint import SinglePointCalculator
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+import models  # noqa: E402
+
+DATABASE_URL = os.environ.get(
+    'DATABASE_URL', 'postgresql://postgres@localhost:5432/travis_ci_test')
+
+
+def reference_toatoms(self, include_results=False):
+    """System._toatoms before the fast construction path."""
+    if not include_results:
+        return ase.atoms.Atoms(
+            self.numbers,
+            self.positions,
+            cell=self.cell,
+            pbc=(self.pbc & np.array([1, 2, 4])).astype(bool),
+        )
+    if self.constraints:
+        constraints = json.loads(self.constraints)
+        if len(constraints[0]['kwargs']['indices']) > 0:
+            constraints = [dict2constraint(d) for d in constraints]
+    else:
+        constraints = None
+    atoms = ase.atoms.Atoms(self.numbers,
+                            self.positions,
+                            cell=self.cell,
+                            pbc=(self.pbc & np.array(
+                                [1, 2, 4])).astype(bool),
+                            magmoms=self.initial_magmoms,
+                            charges=self.initial_charges,
+                            tags=self.tags,
+                            masses=self.masses,
+                            momenta=self.momenta,
+                            constraint=constraints)
+
+    atoms.info = {}
+    atoms.info['unique_id'] = self.unique_id
+    atoms.info['key_value_pairs'] = self.key_value_pairs
+
+    data = self.data
+    if data:
+        atoms.info['data'] = data
+
+    all_properties = ['energy', 'forces', 'stress', 'dipole',
+                      'charges', 'magmom', 'magmoms', 'free_energy']
+    results = {}
+    for prop in all_properties:
+        result = getattr(self, prop, None)
+        if result is not None:
+            results[prop] = result
+    if results:
+        atoms.calc = SinglePointCalculator(atoms, **results)
+        atoms.calc.name = getattr(self, 'calculator', 'unknown')
+    return atoms
+
+
+def main(limit=1000, repeat=5):
+    engine = sqlalchemy.create_engine(DATABASE_URL)
+    session = sqlalchemy.orm.sessionmaker(bind=engine)()
+    systems = session.query(models.System) \
+        .options(sqlalchemy.orm.undefer('*')) \
+        .order_by(models.System.id).limit(limit).all()
+
+    for system in systems:
+        fast = system._toatoms(include_results=True)
+        reference = reference_toatoms(system, include_results=True)
+        assert fast == reference
+        assert fast.calc.results.keys() == reference.calc.results.keys()
+
+    print('{} systems'.format(len(systems)))
+    for include_results in [False, True]:
+        times = []
+        for toatoms in [reference_toatoms, models.System._toatoms]:
+            times.append(min(timeit.repeat(
+                lambda: [toatoms(system, include_results)
+                         for system in systems],
+                number=1, repeat=repeat)) / len(systems) * 1e6)
+        print('include_results={}: {:.1f} us -> {:.1f} us ({:.1f}x)'
+              .format(include_results, times[0], times[1],
+                      times[0] / times[1]))
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:2]])
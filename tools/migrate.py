@@ -0,0 +1,229 @@
+#!/usr/bin/env python
+"""
+Apply the versioned schema migrations in migrations/::
+
+    python tools/migrate.py
+
+Migrations are SQL files named <version>_<name>.sql and are applied
+in the order of their versions. Applied versions are recorded in
+public.schema_migrations, so every migration runs once. Statements run
+outside of transactions, which allows CREATE INDEX CONCURRENTLY, and
+should be idempotent (IF NOT EXISTS) since a failed migration is rerun
+from the start.
+
+A failed CREATE INDEX CONCURRENTLY leaves an invalid index behind,
+which IF NOT EXISTS would then skip. Invalid indexes of a migration
+are therefore dropped before it runs, and indexes that are invalid
+after it ran are dropped and built once more before the version is
+recorded.
+
+A header line `-- requires: <extension>, ...` names extensions the
+migration needs. Missing extensions are created if possible.
+Otherwise, e.g. without the privileges for CREATE EXTENSION, the
+migration is skipped with a message and retried on the next run.
+
+A header line `-- schemas: public, upload` applies the migration to
+each of the listed schemas that exist, with `public.` replaced by the
+schema name. Statements may contain $$ quoted function bodies.
+
+The database URL can be set with DATABASE_URL.
+"""
+import collections
+import os
+import re
+import sys
+
+import sqlalchemy
+
+DATABASE_URL = os.environ.get(
+    'DATABASE_URL', 'postgresql://postgres@localhost:5432/travis_ci_test')
+
+MIGRATIONS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                              '..', 'migrations')
+
+VERSION_TABLE = 'public.schema_migrations'
+
+INDEX_PATTERN = re.compile(
+    r'CREATE\s+(?:UNIQUE\s+)?INDEX\s+(?:CONCURRENTLY\s+)?'
+    r'(?:IF\s+NOT\s+EXISTS\s+)?(\w+)\s+ON\s+(?:ONLY\s+)?(?:(\w+)\.)?',
+    re.IGNORECASE)
+
+
+class Migration(object):
+
+    def __init__(self, path):
+        self.path = path
+        self.name = os.path.splitext(os.path.basename(path))[0]
+        self.version = self.name.split('_', 1)[0]
+        with open(path) as sql_file:
+            sql = sql_file.read()
+        self.requires = get_header(sql, 'requires')
+        self.schemas = get_header(sql, 'schemas') or ['public']
+        self.statements = split_statements(sql)
+
+    def get_statements(self, schema='public'):
+        """The statements of the migration applied to `schema`."""
+        return [re.sub(r'\bpublic\.', schema + '.', statement)
+                for statement in self.statements]
+
+
+def get_header(sql, name):
+    """Comma separated values of the header line `-- <name>: ...`."""
+    match = re.search(r'^--\s*{}:(.*)$'.format(name), sql, re.MULTILINE)
+    return [value.strip() for value in match.group(1).split(',')
+            if value.strip()] if match else []
+
+
+def split_statements(sql):
+    """Split `sql` at semicolons ending a line, except in $$ quotes."""
+    statements = []
+    lines = []
+    quote = None
+    for line in sql.splitlines(True):
+        lines.append(line)
+        for tag in re.findall(r'\$\w*\$', re.sub(r'--.*', '', line)):
+            if quote is None:
+                quote = tag
+            elif tag == quote:
+                quote = None
+        if quote is None and re.search(r';\s*$', line):
+            statements.append(''.join(lines))
+            lines = []
+    statements.append(''.join(lines))
+    return [re.sub(r';\s*$', '', statement).strip()
+            for statement in statements
+            if re.sub(r'--.*', '', statement).strip()]
+
+
+def get_indexes(statements):
+    """(schema, name) of the indexes created by `statements`, mapped to
+    the creating statement.
+    """
+    indexes = collections.OrderedDict()
+    for statement in statements:
+        match = INDEX_PATTERN.search(statement)
+        if match:
+            indexes[(match.group(2) or 'public', match.group(1))] = statement
+    return indexes
+
+
+def get_migrations(directory=MIGRATIONS_DIR):
+    return sorted((Migration(os.path.join(directory, name))
+                   for name in os.listdir(directory)
+                   if re.match(r'\d+_.*\.sql$', name)),
+                  key=lambda migration: int(migration.version))
+
+
+def get_invalid_indexes(connection, indexes):
+    """The (schema, name) pairs of `indexes` that exist but are
+    invalid, e.g. after a failed CREATE INDEX CONCURRENTLY.
+    """
+    if not indexes:
+        return []
+    invalid = set(tuple(row) for row in connection.execute(
+        'SELECT n.nspname, c.relname FROM pg_index i '
+        'JOIN pg_class c ON c.oid = i.indexrelid '
+        'JOIN pg_namespace n ON n.oid = c.relnamespace '
+        'WHERE NOT i.indisvalid'))
+    return [index for index in indexes if index in invalid]
+
+
+def drop_indexes(connection, indexes):
+    for schema, name in indexes:
+        print('Dropping invalid index {}.{}'.format(schema, name),
+              file=sys.stderr)
+        connection.execute('DROP INDEX CONCURRENTLY IF EXISTS {}.{}'
+                           .format(schema, name))
+
+
+def create_extensions(connection, names):
+    """Create the extensions `names` that are not installed yet and
+    return those that could not be created.
+    """
+    installed = set(row[0] for row in connection.execute(
+        'SELECT extname FROM pg_extension'))
+    failed = []
+    for name in names:
+        if name in installed:
+            continue
+        try:
+            connection.execute('CREATE EXTENSION IF NOT EXISTS {}'
+                               .format(name))
+        except sqlalchemy.exc.DBAPIError as e:
+            print('Could not create extension {}: {}'.format(
+                name, str(e.orig).strip()), file=sys.stderr)
+            failed.append(name)
+    return failed
+
+
+def apply_statements(connection, name, statements):
+    """Run the `statements` of migration `name` and make sure that the
+    indexes they create are valid.
+    """
+    indexes = get_indexes(statements)
+    drop_indexes(connection, get_invalid_indexes(connection, indexes))
+    for statement in statements:
+        connection.execute(sqlalchemy.text(statement))
+    invalid = get_invalid_indexes(connection, indexes)
+    drop_indexes(connection, invalid)
+    for index in invalid:
+        connection.execute(sqlalchemy.text(indexes[index]))
+    invalid = get_invalid_indexes(connection, indexes)
+    if invalid:
+        raise RuntimeError('Migration {} left the invalid indexes {}'.format(
+            name, ', '.join('.'.join(index) for index in invalid)))
+
+
+def migrate(engine, directory=MIGRATIONS_DIR):
+    """Apply all pending migrations and return their names."""
+    applied = []
+    with engine.connect() as connection:
+        connection = connection.execution_options(
+            isolation_level='AUTOCOMMIT')
+        connection.execute(
+            'CREATE TABLE IF NOT EXISTS {} (version TEXT PRIMARY KEY, '
+            'name TEXT, applied TIMESTAMP DEFAULT now())'
+            .format(VERSION_TABLE))
+        done = set(row[0] for row in connection.execute(
+            'SELECT version FROM {}'.format(VERSION_TABLE)))
+        available = set(row[0] for row in connection.execute(
+            'SELECT name FROM pg_available_extensions'))
+        schemas = set(row[0] for row in connection.execute(
+            'SELECT nspname FROM pg_namespace'))
+        for migration in get_migrations(directory):
+            if migration.version in done:
+                continue
+            missing = [name for name in migration.requires
+                       if name not in available]
+            if missing:
+                print('Skipping {}, extensions {} are not available'
+                      .format(migration.name, ', '.join(missing)),
+                      file=sys.stderr)
+                continue
+            failed = create_extensions(connection, migration.requires)
+            if failed:
+                print('Skipping {}, it needs the extensions {}. Ask a '
+                      'superuser to run CREATE EXTENSION for them and '
+                      'migrate again.'.format(migration.name,
+                                              ', '.join(failed)),
+                      file=sys.stderr)
+                continue
+            for schema in migration.schemas:
+                if schema not in schemas:
+                    print('Skipping {} in schema {}, it does not exist'
+                          .format(migration.name, schema), file=sys.stderr)
+                    continue
+                apply_statements(connection, migration.name,
+                                 migration.get_statements(schema))
+            connection.execute(
+                sqlalchemy.text('INSERT INTO {} (version, name) '
+                                'VALUES (:version, :name)'
+                                .format(VERSION_TABLE)),
+                version=migration.version, name=migration.name)
+            applied.append(migration.name)
+    return applied
+
+
+if __name__ == '__main__':
+    for name in migrate(sqlalchemy.create_engine(DATABASE_URL)):
+        print('Applied {}'.format(name))
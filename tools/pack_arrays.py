@@ -0,0 +1,71 @@
+#!/usr/bin/env python
+"""
+Migration filling the systems_packed table with the per-atom arrays
+of models.PACKED_ARRAYS as little-endian float64 BYTEA buffers::
+
+    python tools/pack_arrays.py [batch size]
+
+The table is created if needed. Only systems without an up-to-date
+packed row are (re)packed, so the script can be rerun after uploads.
+The database URL can be set with DATABASE_URL.
+"""
+import os
+import sys
+
+import sqlalchemy
+import sqlalchemy.orm
+from sqlalchemy.dialects.postgresql import insert
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+import models  # noqa: E402
+
+DATABASE_URL = os.environ.get(
+    'DATABASE_URL', 'postgresql://postgres@localhost:5432/travis_ci_test')
+
+
+def pack_arrays(bind, batch_size=1000):
+    """Pack the arrays of all systems whose packed row is missing or
+    outdated. `bind` is an engine or a connection; with a connection
+    inside a transaction, the batches only commit with that transaction.
+    Returns the number of packed systems.
+    """
+    models.PackedArrays.__table__.create(bind, checkfirst=True)
+    System = models.System
+    Packed = models.PackedArrays
+    columns = [System.id, System.mtime] + \
+        [getattr(System, name) for name in models.PACKED_ARRAYS]
+    table = Packed.__table__
+    statement = insert(table)
+    statement = statement.on_conflict_do_update(
+        index_elements=[table.c.id],
+        set_={name: statement.excluded[name]
+              for name in ['mtime'] + list(models.PACKED_ARRAYS)})
+
+    session = sqlalchemy.orm.sessionmaker(bind=bind)()
+    count = 0
+    last_id = -1
+    while True:
+        rows = session.query(*columns) \
+            .outerjoin(Packed, Packed.id == System.id) \
+            .filter(System.id > last_id) \
+            .filter(sqlalchemy.or_(Packed.id.is_(None),
+                                   Packed.mtime != System.mtime)) \
+            .order_by(System.id).limit(batch_size).all()
+        if not rows:
+            break
+        session.execute(statement, [
+            dict(id=row[0], mtime=row[1],
+                 **{name: models.pack_array(value) for name, value
+                    in zip(models.PACKED_ARRAYS, row[2:])})
+            for row in rows])
+        session.commit()
+        count += len(rows)
+        last_id = rows[-1][0]
+    session.close()
+    return count
+
+
+if __name__ == '__main__':
+    engine = sqlalchemy.create_engine(DATABASE_URL)
+    print('Packed {} systems'.format(
+        pack_arrays(engine, *[int(arg) for arg in sys.argv[1:2]])))
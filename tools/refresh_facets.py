@@ -0,0 +1,26 @@
+#!/usr/bin/env python
+"""
+Refresh the distinct attribute values of facets.py after uploads::
+
+    python tools/refresh_facets.py
+
+Only rows that changed are written and the view stays readable
+during the refresh. Has to run as the owner of public.facets, e.g.
+from cron or right after data was loaded, since the read-only role
+of the web app cannot refresh it. The database URL can be set with
+DATABASE_URL.
+"""
+import os
+import sys
+
+import sqlalchemy
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+import facets  # noqa: E402
+
+DATABASE_URL = os.environ.get(
+    'DATABASE_URL', 'postgresql://postgres@localhost:5432/travis_ci_test')
+
+
+if __name__ == '__main__':
+    facets.refresh(sqlalchemy.create_engine(DATABASE_URL))
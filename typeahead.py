@@ -0,0 +1,220 @@
+"""
+In-memory prefix index for the search boxes of the frontend::
+
+    /typeahead?q=bajd&categories=authors,titles&limit=10
+
+returns completions, most frequent first::
+
+    [{"text": "Bajdich, Michal", "category": "authors", "count": 12}, ...]
+
+The index holds the surface compositions and reactant and product
+keys of reactions and the authors and titles of publications. Every
+word of a text is indexed, so "evol" completes "Oxygen evolution on
+...". Completions are looked up by bisecting sorted arrays, so
+keystrokes do not touch Postgres.
+
+The index is built on the first request of each worker process,
+not at import time, so that gunicorn --preload does not build it
+in the master only. A background check every TYPEAHEAD_CHECK_INTERVAL
+seconds rebuilds it once uploads changed the data; meanwhile the old
+index is served. cache.invalidate() forces the check on the next
+request.
+"""
+# global imports
+import bisect
+import collections
+import heapq
+import logging
+import os
+import re
+import threading
+import time
+
+import sqlalchemy
+import sqlalchemy.exc
+
+# local imports
+import cache
+import models
+
+TYPEAHEAD_CHECK_INTERVAL = float(
+    os.environ.get('TYPEAHEAD_CHECK_INTERVAL', 60))
+
+MAX_COMPLETIONS = 100
+
+# (text, count) rows of each category
+TYPEAHEAD_QUERIES = collections.OrderedDict([
+    ('surfaceComposition', """
+        SELECT surface_composition, count(*) FROM {schema}.reaction
+        WHERE surface_composition <> '' GROUP BY surface_composition"""),
+    ('reactants', """
+        SELECT key, count(*) FROM {schema}.reaction, jsonb_object_keys(
+            CASE WHEN jsonb_typeof(reactants) = 'object'
+            THEN reactants END) AS key
+        GROUP BY key"""),
+    ('products', """
+        SELECT key, count(*) FROM {schema}.reaction, jsonb_object_keys(
+            CASE WHEN jsonb_typeof(products) = 'object'
+            THEN products END) AS key
+        GROUP BY key"""),
+    ('authors', """
+        SELECT author, count(*) FROM {schema}.publication,
+            jsonb_array_elements_text(
+                CASE WHEN jsonb_typeof(authors) = 'array'
+                THEN authors END) AS author
+        GROUP BY author"""),
+    ('titles', """
+        SELECT title, count(*) FROM {schema}.publication
+        WHERE title <> '' GROUP BY title"""),
+])
+
+# changes whenever systems or publications are added or removed
+STAMP_QUERY = """
+    SELECT (SELECT max(mtime) FROM {schema}.systems),
+           (SELECT max(stime) FROM {schema}.publication),
+           (SELECT count(*) FROM {schema}.publication)"""
+
+WORD_RE = re.compile(r'\w+')
+
+Completion = collections.namedtuple('Completion', ['text', 'category',
+                                                   'count'])
+
+
+def normalize(text):
+    return text.strip().lower()
+
+
+class PrefixIndex(object):
+    """Completions of (category, text, count) entries by prefix.
+
+    Entries are stored ranked by count, so the best completions are
+    the smallest entry numbers among the keys starting with a prefix.
+    `keys` are the normalized texts from each word on, sorted, and
+    `refs` the entry numbers of the keys.
+    """
+
+    def __init__(self, entries=()):
+        self.entries = [Completion(text, category, count)
+                        for category, text, count in sorted(
+                            entries, key=lambda e: (-e[2], e[1], e[0]))]
+        keys = []
+        for i, entry in enumerate(self.entries):
+            text = normalize(entry.text)
+            starts = set(match.start() for match in WORD_RE.finditer(text))
+            starts.add(0)
+            keys.extend((text[start:], i) for start in starts)
+        keys.sort()
+        self.keys = [key for key, _ in keys]
+        self.refs = [i for _, i in keys]
+        self.results = cache.LRUCache(maxsize=4096)
+
+    def __len__(self):
+        return len(self.entries)
+
+    def complete(self, prefix, categories=None, limit=10):
+        """Best `limit` completions of `prefix` in `categories`."""
+        prefix = normalize(prefix)
+        if not prefix:
+            return []
+        key = (prefix, tuple(categories or ()), limit)
+        results = self.results.get(key)
+        if results is None:
+            start = bisect.bisect_left(self.keys, prefix)
+            stop = bisect.bisect_left(self.keys, prefix + '\uffff', start)
+            refs = set(self.refs[start:stop])
+            if categories:
+                refs = [i for i in refs
+                        if self.entries[i].category in categories]
+            results = [self.entries[i]
+                       for i in heapq.nsmallest(limit, refs)]
+            self.results.set(key, results)
+        return results
+
+
+def build_index(connection):
+    entries = []
+    for category, query in TYPEAHEAD_QUERIES.items():
+        for text, count in connection.execute(
+                query.format(schema=models.SCHEMA)):
+            entries.append((category, text, count))
+    return PrefixIndex(entries)
+
+
+class Typeahead(object):
+    """Current PrefixIndex of the database, rebuilt in the background
+    when the data changed.
+    """
+
+    def __init__(self, interval=TYPEAHEAD_CHECK_INTERVAL):
+        self.interval = interval
+        self.index = PrefixIndex()
+        self.stamp = None
+        self.checked = None
+        self.builds = 0
+        self.thread = None
+        self.lock = threading.Lock()
+        self.pid = os.getpid()
+
+    def reset_after_fork(self):
+        if self.pid != os.getpid():
+            # forked: the thread and its lock belong to the parent
+            self.lock = threading.Lock()
+            self.thread = None
+            self.checked = None
+            self.pid = os.getpid()
+
+    def start(self, engine):
+        """Check for changed data and rebuild the index in a
+        background thread, unless a check is running already.
+        """
+        self.reset_after_fork()
+        with self.lock:
+            if self.thread is not None and self.thread.is_alive():
+                return self.thread
+            thread = threading.Thread(target=self.update,
+                                      args=(engine, ), daemon=True)
+            thread.start()
+            # publish the thread before `checked`, which makes other
+            # requests skip start() and wait for it
+            self.thread = thread
+            self.checked = time.time()
+            return thread
+
+    def update(self, engine):
+        try:
+            with engine.connect() as connection:
+                stamp = tuple(connection.execute(
+                    STAMP_QUERY.format(schema=models.SCHEMA)).first())
+                if stamp != self.stamp:
+                    self.index = build_index(connection)
+                    self.stamp = stamp
+                    self.builds += 1
+        except sqlalchemy.exc.SQLAlchemyError:
+            logging.exception('Could not build the typeahead index')
+
+    def complete(self, engine, prefix, categories=None, limit=10):
+        self.reset_after_fork()
+        if self.checked is None or \
+                time.time() - self.checked > self.interval:
+            self.start(engine)
+        if self.stamp is None:
+            # nothing to serve before the first build
+            with self.lock:
+                thread = self.thread
+            if thread is not None:
+                thread.join()
+        return self.index.complete(prefix, categories, limit)
+
+    def clear(self):
+        self.checked = None
+
+    def stats(self):
+        return {
+            'size': len(self.index),
+            'builds': self.builds,
+            'age': None if self.checked is None
+            else time.time() - self.checked,
+        }
+
+
+TYPEAHEAD = cache.register('typeahead', Typeahead())